@@ -43,7 +43,8 @@ RUN pip3 --no-cache-dir install \
         daphne==2.2.5 gunicorn==20.0.0 django_admin_json_editor==0.2.0 django-ltree==0.4 \
         requests==2.22.0 python-dateutil==2.8.1 ujson==1.35 slackclient==2.3.1 \
         google-auth==1.6.3 elasticsearch==7.1.0 progressbar2==3.47.0 \
-        gevent==1.4.0 uritemplate==3.0.1
+        gevent==1.4.0 uritemplate==3.0.1 pyarrow==0.17.1 \
+        fastjsonschema==2.15.3
 
 # Install fork of openapi-core that works in DRF views
 WORKDIR /working
@@ -68,3 +69,8 @@ RUN python3 setup.py install
 COPY . /tator_online
 WORKDIR /tator_online
 RUN rm -rf helm
+
+# Prebuild the spec used to parse requests
+RUN DJANGO_SECRET_KEY=build TATOR_DEBUG=false TATOR_USE_MIN_JS=false \
+    ELASTICSEARCH_HOST=127.0.0.1 python3 manage.py buildparserspec && \
+    test -s main/schema/parser_spec.json
@@ -1,10 +1,72 @@
+from collections import OrderedDict
+import threading
 import redis
 import json
+import hashlib
+import shutil
+import ujson
+import zlib
+import time
 import os
 import logging
 
+from rest_framework.utils.encoders import JSONEncoder
+
 logger = logging.getLogger(__name__)
 
+CACHE_FAMILIES = {
+    'media': {'ttl': 3600, 'budget': 256 * 1024 * 1024, 'max_entry': 16 * 1024 * 1024},
+    'localization': {'ttl': 3600, 'budget': 512 * 1024 * 1024, 'max_entry': 8 * 1024 * 1024},
+    'treeleaf': {'ttl': 3600, 'budget': 64 * 1024 * 1024, 'max_entry': 4 * 1024 * 1024},
+    'creds': {'ttl': 600, 'budget': 16 * 1024 * 1024, 'max_entry': 1024},
+    'project': {'ttl': 600, 'budget': 16 * 1024 * 1024, 'max_entry': 64 * 1024},
+}
+""" Per family cache settings. `ttl` is the lifetime of a group in seconds,
+    `budget` is the total compressed size in bytes of a family before least
+    recently used groups are evicted, and `max_entry` is the largest compressed
+    response that will be cached. Each setting may be overridden with an
+    environment variable such as `TATOR_CACHE_LOCALIZATION_BUDGET`.
+"""
+
+STATS_KEY = 'cache_stats'
+
+INVALIDATE_CHANNEL = 'cache_invalidate'
+""" Pub/sub channel on which invalidated group names are published so that
+    every process can drop them from its local cache.
+"""
+
+ATTRIBUTE_INDEXES_DIRTY_KEY = 'attribute_indexes_dirty'
+""" Set when an entity type changes, cleared by the index worker once it has
+    updated attribute indexes.
+"""
+
+LOCAL_CACHE_TTL = int(os.getenv('TATOR_LOCAL_CACHE_TTL', 30))
+LOCAL_CACHE_SIZE = int(os.getenv('TATOR_LOCAL_CACHE_SIZE', 4096))
+
+FRAME_CACHE_DIR = os.getenv('TATOR_FRAME_CACHE_DIR', '/data/media/frame_cache')
+FRAME_CACHE_BUDGET = int(os.getenv('TATOR_FRAME_CACHE_BUDGET', 4 * 1024 * 1024 * 1024))
+""" Directory and total size in bytes of the rendered frame cache. The directory
+    should be shared by all processes using the same redis.
+"""
+
+def get_family_setting(family, setting):
+    value = os.getenv(f'TATOR_CACHE_{family.upper()}_{setting.upper()}')
+    if value is None:
+        value = CACHE_FAMILIES[family][setting]
+    return int(value)
+
+def get_lru_key(family):
+    return f'cache_lru_{family}'
+
+def get_sizes_key(family):
+    return f'cache_sizes_{family}'
+
+def get_total_key(family):
+    return f'cache_total_{family}'
+
+def get_frame_paths_key(media_id):
+    return f'frame_paths_{media_id}'
+
 def get_media_list_hash(project_id, query_params):
     group = f"media_{project_id}"
     key = json.dumps(query_params, sort_keys=True)
@@ -20,8 +82,114 @@ def get_treeleaf_list_hash(ancestor, query_params):
     key = json.dumps(query_params, sort_keys=True)
     return (group, key)
 
+def get_cred_hash(user_id, project_id):
+    group = f'creds_{project_id}'
+    key = f'creds_{project_id}_{user_id}'
+    return (group, key)
+
+def get_cred_generation_key(project_id):
+    return f'creds_generation_{project_id}'
+
+def get_project_hash(project_id):
+    group = f'project_{project_id}'
+    key = f'project_{project_id}'
+    return (group, key)
+
+def get_attribute_catalog_key(project_id):
+    return f'attribute_catalog_{project_id}'
+
+def get_frame_cache_path(media, query_params, render_format):
+    """ Returns the path of a rendered frame. The name is a digest of the media
+        files and rendering parameters, so renders made before a media is
+        re-transcoded are never returned.
+    """
+    files = json.dumps([str(media.file), media.media_files], sort_keys=True)
+    params = json.dumps(query_params, sort_keys=True)
+    digest = hashlib.md5(f"{files}{params}".encode()).hexdigest()
+    return os.path.join(FRAME_CACHE_DIR, str(media.id), f"{digest}.{render_format}")
+
+class LocalCache:
+    """In-process LRU cache with a short TTL that sits in front of redis for
+       small, hot entries such as permission checks.
+
+       Each process subscribes to the invalidation channel and drains pending
+       messages before every lookup, so no background thread is needed. The
+       subscription is recreated after a fork or connection error, and the local
+       entries are dropped whenever that happens since invalidations may have
+       been missed.
+    """
+    def __init__(self, rds, max_size, ttl):
+        self._rds = rds
+        self._max_size = max_size
+        self._ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._pubsub = None
+
+    def _poll(self):
+        """Applies invalidations published by other processes.
+        """
+        try:
+            if self._pid != os.getpid():
+                self._data.clear()
+                self._pubsub = self._rds.pubsub(ignore_subscribe_messages=True)
+                self._pubsub.subscribe(INVALIDATE_CHANNEL)
+                self._pid = os.getpid()
+            while True:
+                msg = self._pubsub.get_message()
+                if msg is None:
+                    break
+                self._invalidate_group(msg['data'].decode())
+        except redis.ConnectionError:
+            logger.warning("Lost cache invalidation subscription, clearing local cache.")
+            self._data.clear()
+            self._pid = None
+
+    def _invalidate_group(self, group):
+        for cache_key in [cache_key for cache_key in self._data if cache_key[0] == group]:
+            del self._data[cache_key]
+
+    def get(self, group, key):
+        """Returns a cached value or None if it is not cached or expired.
+        """
+        with self._lock:
+            self._poll()
+            entry = self._data.get((group, key))
+            if entry is None:
+                return None
+            expires, val = entry
+            if expires < time.monotonic():
+                del self._data[(group, key)]
+                return None
+            self._data.move_to_end((group, key))
+            return val
+
+    def set(self, group, key, val):
+        with self._lock:
+            self._poll()
+            self._data[(group, key)] = (time.monotonic() + self._ttl, val)
+            self._data.move_to_end((group, key))
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, group):
+        """Drops a group from this process and publishes the invalidation to
+           all other processes.
+        """
+        with self._lock:
+            self._invalidate_group(group)
+        self._rds.publish(INVALIDATE_CHANNEL, group)
+
 class TatorCache:
     """Interface for caching responses.
+
+       Responses are stored compressed in redis hashes, one hash per group. Groups
+       belong to a family (media, localization, treeleaf, creds, project) and
+       expire after the family TTL. Each family tracks its groups in a sorted set
+       ordered by last access and evicts the least recently used groups when its
+       memory budget is exceeded. Hit, miss, eviction and oversize counters are
+       kept per family and can be read with `get_stats`.
     """
     @classmethod
     def setup_redis(cls):
@@ -29,121 +197,393 @@ class TatorCache:
             host=os.getenv('REDIS_HOST'),
             health_check_interval=30,
         )
+        cls.local = LocalCache(cls.rds, LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
+
+    def _get(self, family, group, key):
+        """Returns a cached value or None if it is not cached.
+        """
+        val = self.rds.hget(group, key)
+        pipe = self.rds.pipeline(transaction=False)
+        if val is not None:
+            try:
+                val = ujson.loads(zlib.decompress(val).decode('utf-8'))
+            except (zlib.error, ValueError):
+                # Entry was written in an older format, treat it as a miss.
+                val = None
+        if val is None:
+            pipe.hincrby(STATS_KEY, f'{family}_misses')
+        else:
+            pipe.hincrby(STATS_KEY, f'{family}_hits')
+            pipe.zadd(get_lru_key(family), {group: time.time()}, xx=True)
+        pipe.execute()
+        return val
+
+    def _set(self, family, group, key, val):
+        """Caches a value, evicting least recently used groups in the family
+           if its budget is exceeded.
+        """
+        # Encode the way the JSON renderer does, so cached and uncached
+        # responses match (ujson writes datetimes as epoch integers).
+        data = zlib.compress(json.dumps(val, cls=JSONEncoder).encode('utf-8'))
+        if len(data) > get_family_setting(family, 'max_entry'):
+            self.rds.hincrby(STATS_KEY, f'{family}_oversize')
+            return
+        # The size of the entry being replaced is read in the same transaction
+        # as the write, so rewriting a key only counts the change in size.
+        pipe = self.rds.pipeline(transaction=True)
+        pipe.exists(group)
+        pipe.hstrlen(group, key)
+        pipe.hset(group, key, data)
+        pipe.expire(group, get_family_setting(family, 'ttl'))
+        pipe.zadd(get_lru_key(family), {group: time.time()})
+        existed, old_size, _, _, _ = pipe.execute()
+        sizes_key = get_sizes_key(family)
+        pipe = self.rds.pipeline(transaction=False)
+        if existed:
+            delta = len(data) - old_size
+            pipe.hincrby(sizes_key, group, delta)
+        else:
+            # The group expired, so its recorded size is stale.
+            delta = len(data) - int(self.rds.hget(sizes_key, group) or 0)
+            pipe.hset(sizes_key, group, len(data))
+        pipe.incrby(get_total_key(family), delta)
+        total = pipe.execute()[-1]
+        budget = get_family_setting(family, 'budget')
+        if total > budget:
+            self._evict(family, total, budget)
+
+    def _evict(self, family, total, budget):
+        """Evicts least recently used groups until the family is within budget.
+           Groups that already expired are the oldest, so they are reclaimed first.
+        """
+        lru_key = get_lru_key(family)
+        sizes_key = get_sizes_key(family)
+        total_key = get_total_key(family)
+        while total > budget:
+            popped = self.rds.zpopmin(lru_key)
+            if not popped:
+                self.rds.set(total_key, 0)
+                break
+            group = popped[0][0]
+            size = int(self.rds.hget(sizes_key, group) or 0)
+            pipe = self.rds.pipeline(transaction=False)
+            pipe.delete(group)
+            pipe.hdel(sizes_key, group)
+            pipe.hincrby(STATS_KEY, f'{family}_evictions')
+            pipe.decrby(total_key, size)
+            total = pipe.execute()[-1]
+
+    def _invalidate(self, family, groups):
+        """Clears a collection of groups belonging to a family.
+        """
+        groups = list(set(groups))
+        if not groups:
+            return
+        sizes_key = get_sizes_key(family)
+        sizes = self.rds.hmget(sizes_key, groups)
+        pipe = self.rds.pipeline(transaction=False)
+        pipe.delete(*groups)
+        pipe.zrem(get_lru_key(family), *groups)
+        pipe.hdel(sizes_key, *groups)
+        pipe.decrby(get_total_key(family), sum([int(size) for size in sizes if size]))
+        pipe.execute()
 
     def get_media_list_cache(self, project_id, query_params):
         """Returns media list cache or None if it is not cached.
         """
         group, key = get_media_list_hash(project_id, query_params)
-        val = None
-        if self.rds.hexists(group, key):
-            val = json.loads(self.rds.hget(group, key))
-        return val
+        return self._get('media', group, key)
 
     def set_media_list_cache(self, project_id, query_params, val):
         """Caches a media list response.
         """
         group, key = get_media_list_hash(project_id, query_params)
-        self.rds.hset(group, key, json.dumps(val))
+        self._set('media', group, key, val)
 
     def invalidate_media_list_cache(self, project_id):
         """Clears media list cache.
         """
         group, _ = get_media_list_hash(project_id, {})
-        self.rds.delete(group)
+        self._invalidate('media', [group])
 
     def get_localization_list_cache(self, media_id, entity_type_id, query_params):
         """Returns localization list cache or None if it is not cached.
         """
         group, key = get_localization_list_hash(media_id, entity_type_id, query_params)
-        val = None
-        if self.rds.hexists(group, key):
-            val = json.loads(self.rds.hget(group, key))
-        return val
+        return self._get('localization', group, key)
 
     def set_localization_list_cache(self, media_id, entity_type_id, query_params, val):
         """Caches an localization list response.
         """
         group, key = get_localization_list_hash(media_id, entity_type_id, query_params)
-        self.rds.hset(group, key, json.dumps(val))
+        self._set('localization', group, key, val)
 
     def invalidate_localization_list_cache(self, media_id, entity_type_id):
         """Clears localization list cache.
         """
         group, _ = get_localization_list_hash(media_id, entity_type_id, {})
-        self.rds.delete(group)
+        self._invalidate('localization', [group])
+
+    def invalidate_localization_list_caches(self, keys):
+        """Clears localization list caches for an iterable of (media_id, entity_type_id)
+           tuples in a single round trip.
+        """
+        groups = [get_localization_list_hash(media_id, entity_type_id, {})[0]
+                  for media_id, entity_type_id in keys]
+        self._invalidate('localization', groups)
 
     def get_treeleaf_list_cache(self, ancestor, query_params):
         """Returns tree leaf list cache or None if it is not cached.
         """
         group, key = get_treeleaf_list_hash(ancestor, query_params)
-        val = None
-        if self.rds.hexists(group, key):
-            val = json.loads(self.rds.hget(group, key))
-        return val
+        return self._get('treeleaf', group, key)
 
     def set_treeleaf_list_cache(self, ancestor, query_params, val):
         """Caches a suggestion response.
         """
         group, key = get_treeleaf_list_hash(ancestor, query_params)
-        self.rds.hset(group, key, json.dumps(val))
+        self._set('treeleaf', group, key, val)
 
     def invalidate_treeleaf_list_cache(self, ancestor):
         """Clears treeleaf list cache.
         """
         group, _ = get_treeleaf_list_hash(ancestor, {})
-        self.rds.delete(group)
+        self._invalidate('treeleaf', [group])
 
     def get_cred_cache(self, user_id, project_id):
-        group = f'creds_{project_id}'
-        key = f'creds_{project_id}_{user_id}'
-        val = None
-        if self.rds.hexists(group, key):
-            val = self.rds.hget(group,key)
-            if val == 'True':
-                val = True
-            else:
-                val = False
+        """Returns the cached permission of a user in a project, checking the
+           local cache before redis. Returns None if it is not cached.
+        """
+        group, key = get_cred_hash(user_id, project_id)
+        val = self.local.get(group, key)
+        if val is None:
+            val = self._get('creds', group, key)
+            if val is not None:
+                self.local.set(group, key, val)
         return val
 
-    def set_cred_cache(self, user_id, project_id, val):
-        group = f'creds_{project_id}'
-        key = f'creds_{project_id}_{user_id}'
-        self.rds.hset(group, key, str(val))
+    def get_cred_generation(self, project_id):
+        """Returns the number of times cached permissions for a project were
+           invalidated.
+        """
+        return int(self.rds.get(get_cred_generation_key(project_id)) or 0)
+
+    def set_cred_cache(self, user_id, project_id, val, generation):
+        """Caches the permission of a user in a project in both the local cache
+           and redis. `generation` is the result of `get_cred_generation` from
+           before the permission was read. The permission is not cached if the
+           project's permissions were invalidated since then, and is cleared if
+           they were invalidated while it was being written.
+        """
+        group, key = get_cred_hash(user_id, project_id)
+        if self.get_cred_generation(project_id) != generation:
+            return
+        self._set('creds', group, key, val)
+        self.local.set(group, key, val)
+        if self.get_cred_generation(project_id) != generation:
+            self._invalidate('creds', [group])
+            self.local.invalidate(group)
 
     def invalidate_cred_cache(self, project_id):
-        group = f'creds_{project_id}'
-        self.rds.delete(group)
+        """Clears cached permissions for a project in redis and in the local
+           cache of every process. The generation is bumped first, so writes of
+           permissions read before this are either rejected or cleared here.
+        """
+        group, _ = get_cred_hash(None, project_id)
+        self.rds.incr(get_cred_generation_key(project_id))
+        self._invalidate('creds', [group])
+        self.local.invalidate(group)
 
     def get_project_cache(self, project_id):
-        group = f'project_{project_id}'
-        key = f'project_{project_id}'
-        val = None
-        if self.rds.hexists(group, key):
-            val = self.rds.hget(group,key)
-        if val:
-            val=eval(val)
-        return val
+        group, key = get_project_hash(project_id)
+        return self._get('project', group, key)
 
     def set_project_cache(self, project_id, val):
-        group = f'project_{project_id}'
-        key = f'project_{project_id}'
-        self.rds.hset(group, key, str(val))
+        group, key = get_project_hash(project_id)
+        self._set('project', group, key, val)
 
     def invalidate_project_cache(self, project_id):
-        group = f'project_{project_id}'
-        self.rds.delete(group)
+        group, _ = get_project_hash(project_id)
+        self._invalidate('project', [group])
+
+    def get_attribute_catalog_version(self, project_id):
+        """Returns the version of the attribute catalog of a project.
+        """
+        return int(self.rds.get(get_attribute_catalog_key(project_id)) or 0)
+
+    def invalidate_attribute_catalog(self, project_id):
+        """Bumps the version of the attribute catalog of a project so that every
+           process rebuilds it, and flags attribute indexes for an update.
+        """
+        pipe = self.rds.pipeline(transaction=False)
+        pipe.incr(get_attribute_catalog_key(project_id))
+        pipe.set(ATTRIBUTE_INDEXES_DIRTY_KEY, 1)
+        pipe.execute()
+
+    def get_stats(self):
+        """Returns hit, miss, eviction and oversize counters along with the
+           number of groups and bytes used for each cache family.
+        """
+        counters = {key.decode(): int(val) for key, val in self.rds.hgetall(STATS_KEY).items()}
+        stats = {}
+        for family in CACHE_FAMILIES:
+            stats[family] = {
+                counter: counters.get(f'{family}_{counter}', 0)
+                for counter in ['hits', 'misses', 'evictions', 'oversize']
+            }
+            stats[family]['groups'] = self.rds.zcard(get_lru_key(family))
+            stats[family]['bytes'] = int(self.rds.get(get_total_key(family)) or 0)
+            stats[family]['budget'] = get_family_setting(family, 'budget')
+        return stats
+
+    def reset_stats(self):
+        """Resets hit, miss, eviction and oversize counters.
+        """
+        self.rds.delete(STATS_KEY)
 
     def invalidate_all(self):
         """Invalidates all caches.
         """
-        for prefix in ['media_',
-                       'localization_',
-                       'treeleaf_',
-                       'creds_',
-                       'project_']:
-            for key in self.rds.scan_iter(match=prefix + '*'):
-                logger.info(f"Deleting cache key {key}...")
-                self.rds.delete(key)
+        for family in CACHE_FAMILIES:
+            lru_key = get_lru_key(family)
+            groups = self.rds.zrange(lru_key, 0, -1)
+            for idx in range(0, len(groups), 1000):
+                self.rds.delete(*groups[idx:idx+1000])
+            self.rds.delete(lru_key, get_sizes_key(family), get_total_key(family))
+            logger.info(f"Deleted {len(groups)} {family} cache groups...")
         logger.info("Cache cleared!")
 
+class FrameCache:
+    """Interface for caching rendered frames, tiles and animations on disk.
+
+       Files are stored in a directory per media. Their paths are tracked in redis
+       in a set per media and in a sorted set ordered by last access, and least
+       recently used files are
+       deleted when the total size exceeds `FRAME_CACHE_BUDGET`. Counters are kept
+       in the same stats hash as `TatorCache` under the frame family.
+    """
+    lru_key = get_lru_key('frame')
+    sizes_key = get_sizes_key('frame')
+    total_key = get_total_key('frame')
+
+    def __init__(self):
+        self.rds = TatorCache.rds
+
+    def get(self, media, query_params, render_format):
+        """Returns a cached render or None if it is not cached.
+        """
+        path = get_frame_cache_path(media, query_params, render_format)
+        pipe = self.rds.pipeline(transaction=False)
+        try:
+            with open(path, 'rb') as data_file:
+                data = data_file.read()
+        except FileNotFoundError:
+            data = None
+        if data is None:
+            pipe.hincrby(STATS_KEY, 'frame_misses')
+        else:
+            pipe.hincrby(STATS_KEY, 'frame_hits')
+            pipe.zadd(self.lru_key, {path: time.time()}, xx=True)
+        pipe.execute()
+        return data
+
+    def set(self, media, query_params, render_format, data):
+        """Caches a render, evicting least recently used renders if the budget is
+           exceeded.
+        """
+        if len(data) > FRAME_CACHE_BUDGET:
+            self.rds.hincrby(STATS_KEY, 'frame_oversize')
+            return
+        path = get_frame_cache_path(media, query_params, render_format)
+        if self.rds.hsetnx(self.sizes_key, path, len(data)) == 0:
+            # Another request already rendered this.
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.tmp"
+            with open(temp_path, 'wb') as data_file:
+                data_file.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            logger.warning(f"Could not write rendered frame to {path}")
+            self.rds.hdel(self.sizes_key, path)
+            return
+        pipe = self.rds.pipeline(transaction=False)
+        pipe.sadd(get_frame_paths_key(media.id), path)
+        pipe.zadd(self.lru_key, {path: time.time()})
+        pipe.incrby(self.total_key, len(data))
+        total = pipe.execute()[-1]
+        if total > FRAME_CACHE_BUDGET:
+            self._evict(total)
+
+    def _evict(self, total):
+        """Deletes least recently used renders until the cache is within budget.
+        """
+        while total > FRAME_CACHE_BUDGET:
+            popped = self.rds.zpopmin(self.lru_key)
+            if not popped:
+                self.rds.set(self.total_key, 0)
+                break
+            path = popped[0][0].decode()
+            size = int(self.rds.hget(self.sizes_key, path) or 0)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            media_id = os.path.basename(os.path.dirname(path))
+            pipe = self.rds.pipeline(transaction=False)
+            pipe.srem(get_frame_paths_key(media_id), path)
+            pipe.hdel(self.sizes_key, path)
+            pipe.hincrby(STATS_KEY, 'frame_evictions')
+            pipe.decrby(self.total_key, size)
+            total = pipe.execute()[-1]
+
+    def invalidate(self, media_id):
+        """Deletes all renders of a media.
+        """
+        media_dir = os.path.join(FRAME_CACHE_DIR, str(media_id))
+        self._forget([media_id])
+        shutil.rmtree(media_dir, ignore_errors=True)
+
+    def invalidate_many(self, media_ids):
+        """Forgets renders of many media. Returns the render directories, which
+           the caller should remove.
+        """
+        self._forget(media_ids)
+        return list(set([os.path.join(FRAME_CACHE_DIR, str(media_id))
+                         for media_id in media_ids]))
+
+    def _forget(self, media_ids):
+        """Removes renders of media from the LRU and size tracking, reading their
+           paths from the set of each media.
+        """
+        keys = [get_frame_paths_key(media_id) for media_id in media_ids]
+        if not keys:
+            return
+        pipe = self.rds.pipeline(transaction=False)
+        for key in keys:
+            pipe.smembers(key)
+        paths = [path for members in pipe.execute() for path in members]
+        pipe = self.rds.pipeline(transaction=False)
+        if paths:
+            pipe.hmget(self.sizes_key, paths)
+            pipe.zrem(self.lru_key, *paths)
+            pipe.hdel(self.sizes_key, *paths)
+        pipe.delete(*keys)
+        results = pipe.execute()
+        if paths:
+            self.rds.decrby(self.total_key, sum([int(size) for size in results[0] if size]))
+
+    def get_stats(self):
+        """Returns counters and usage in the same format as `TatorCache.get_stats`.
+        """
+        counters = self.rds.hmget(STATS_KEY, [f'frame_{counter}' for counter in
+                                              ['hits', 'misses', 'evictions', 'oversize']])
+        stats = {counter: int(val or 0) for counter, val in
+                 zip(['hits', 'misses', 'evictions', 'oversize'], counters)}
+        stats['groups'] = self.rds.zcard(self.lru_key)
+        stats['bytes'] = int(self.rds.get(self.total_key) or 0)
+        stats['budget'] = FRAME_CACHE_BUDGET
+        return stats
+
 TatorCache.setup_redis()
@@ -166,7 +166,7 @@ class ProgressConsumer(JsonWebsocketConsumer):
         # Join all project groups that this user is a member of
         projects = Project.objects.filter(membership__user=self.scope['user'])
         for project in projects:
-            for prefix in ['algorithm', 'upload', 'download']:
+            for prefix in ['algorithm', 'upload', 'download', 'delete']:
                 self._join_and_update(prefix, project.id)
 
     def progress(self, content):
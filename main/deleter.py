@@ -0,0 +1,322 @@
+import logging
+import os
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Count
+from django.db.models import Sum
+
+from .models import DeleteJob
+from .models import IndexOutbox
+from .models import Leaf
+from .models import Localization
+from .models import Media
+from .models import Project
+from .models import State
+from .models import User
+from .models import safe_delete
+from .models import adjust_project_totals
+from .search import TatorSearch
+from .indexer import IndexQueue
+from .cache import TatorCache
+from .cache import FrameCache
+from .consumers import ProgressProducer
+
+logger = logging.getLogger(__name__)
+
+DELETE_BATCH_SIZE = int(os.getenv('TATOR_DELETE_BATCH_SIZE', 1000))
+DELETE_FILE_THREADS = int(os.getenv('TATOR_DELETE_FILE_THREADS', 16))
+DELETE_MAX_ATTEMPTS = int(os.getenv('TATOR_DELETE_MAX_ATTEMPTS', 5))
+DELETE_POLL_INTERVAL = int(os.getenv('TATOR_DELETE_POLL_INTERVAL', 5))
+""" Number of rows deleted per transaction, number of threads unlinking
+    files, number of times a job is tried before it is left for inspection and
+    seconds between checks for new jobs.
+"""
+
+DELETE_PARENTS_PER_QUERY = 500
+""" Number of media whose child documents are deleted by one elasticsearch
+    query, which keeps queries below the default limit of 1024 clauses.
+"""
+
+DELETE_LOCK_KEY = 7361
+""" First key of the advisory locks held by delete workers on jobs. """
+
+def async_deletes_enabled():
+    """ Delete jobs are run inline if `TATOR_ASYNC_DELETES` is false, which is
+        useful for tests and deployments without a delete worker.
+    """
+    return os.getenv('TATOR_ASYNC_DELETES', 'true').lower() not in ['false', '0']
+
+def _raw_delete(qs):
+    qs._raw_delete(qs.db)
+
+def id_batches(qs, batch_size=DELETE_BATCH_SIZE):
+    """ Yields lists of ids from a queryset until it is empty. Each batch must
+        be deleted before the next is requested.
+    """
+    while True:
+        ids = list(qs.order_by('id').values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        yield ids
+
+def delete_states(ids):
+    """ Deletes states and their media and localization associations.
+    """
+    with transaction.atomic():
+        _raw_delete(State.media.through.objects.filter(state__in=ids))
+        _raw_delete(State.localizations.through.objects.filter(state__in=ids))
+        _raw_delete(State.objects.filter(pk__in=ids))
+
+def delete_localizations(ids):
+    """ Deletes localizations and their state associations. Clones of these
+        localizations lose their parent.
+    """
+    with transaction.atomic():
+        _raw_delete(State.localizations.through.objects.filter(localization__in=ids))
+        Localization.objects.filter(parent__in=ids).update(parent=None)
+        _raw_delete(Localization.objects.filter(pk__in=ids))
+
+def delete_leaves(ids):
+    """ Deletes leaves. Children of these leaves lose their parent.
+    """
+    with transaction.atomic():
+        Leaf.objects.filter(parent__in=ids).update(parent=None)
+        _raw_delete(Leaf.objects.filter(pk__in=ids))
+
+def _media_paths(media):
+    """ Returns paths of the files of a media, as removed by the media
+        pre_delete receiver.
+    """
+    paths = []
+    for field in ['file', 'thumbnail', 'thumbnail_gif']:
+        if media[field]:
+            paths.append(default_storage.path(media[field]))
+    if media['original']:
+        paths.append(str(media['original']))
+    media_files = media['media_files'] or {}
+    for obj in media_files.get('streaming', []):
+        paths.append("/data" + obj['path'])
+        paths.append("/data" + obj['segment_info'])
+    for obj in media_files.get('archival', []):
+        paths.append(obj['path'])
+    return paths
+
+def delete_media(ids):
+    """ Deletes media along with their files, rendered frames, localizations and
+        state associations. Files are removed before rows, so a batch that is
+        interrupted is retried in full.
+    """
+    for loc_ids in id_batches(Localization.objects.filter(media__in=ids)):
+        delete_localizations(loc_ids)
+    rows = Media.objects.filter(pk__in=ids).values('id', 'file', 'original', 'thumbnail',
+                                                   'thumbnail_gif', 'media_files')
+    paths = [path for media in rows for path in _media_paths(media)]
+    frame_dirs = FrameCache().invalidate_many(ids)
+    with ThreadPoolExecutor(DELETE_FILE_THREADS) as pool:
+        list(pool.map(safe_delete, paths))
+        list(pool.map(lambda path: shutil.rmtree(path, ignore_errors=True), frame_dirs))
+    totals = Media.objects.filter(pk__in=ids, project__isnull=False).values('project')\
+                          .annotate(num_files=Count('id'), size=Sum('total_size'))
+    with transaction.atomic():
+        for total in totals:
+            adjust_project_totals(total['project'], -total['num_files'], -(total['size'] or 0))
+        Localization.objects.filter(thumbnail_image__in=ids).update(thumbnail_image=None)
+        State.objects.filter(extracted__in=ids).update(extracted=None)
+        _raw_delete(State.media.through.objects.filter(media__in=ids))
+        _raw_delete(Media.objects.filter(pk__in=ids))
+
+def _media_documents_query(media):
+    """ Returns a query matching documents of media and their annotations,
+        given (id, dtype) pairs.
+    """
+    doc_ids = [f'{dtype}_{id_}' for id_, dtype in media]
+    should = [{'ids': {'values': doc_ids}}]
+    should += [{'parent_id': {'type': 'annotation', 'id': doc_id}} for doc_id in doc_ids]
+    return {'query': {'bool': {'should': should}}}
+
+def delete_project_media(project, ids):
+    """ Deletes media of a project that remains in use, along with their
+        documents. States left without media are deleted and other states
+        associated with these media are reindexed.
+    """
+    media = list(Media.objects.filter(pk__in=ids).values_list('id', 'meta__dtype'))
+    loc_keys = list(Localization.objects.filter(media__in=ids).values_list('media', 'meta')\
+                                        .distinct())
+    caches = {'media': True, 'localization': loc_keys}
+    for idx in range(0, len(media), DELETE_PARENTS_PER_QUERY):
+        IndexQueue().delete(project, _media_documents_query(media[idx:idx+DELETE_PARENTS_PER_QUERY]),
+                            caches=caches)
+    state_ids = set(State.media.through.objects.filter(media__in=ids)\
+                                               .values_list('state', flat=True))
+    delete_media(ids)
+    orphans = set(State.objects.filter(pk__in=state_ids, media__isnull=True)\
+                               .values_list('id', flat=True))
+    if orphans:
+        delete_states(list(orphans))
+    IndexQueue().enqueue('state', state_ids - orphans)
+
+def project_stages(project):
+    """ Returns (name, queryset, delete function) for each table deleted in
+        bulk with a project, in dependency order.
+    """
+    return [
+        ('states', State.objects.filter(project=project), delete_states),
+        ('localizations', Localization.objects.filter(project=project), delete_localizations),
+        ('leaves', Leaf.objects.filter(project=project), delete_leaves),
+        ('media', Media.objects.filter(project=project), delete_media),
+    ]
+
+class DeleteQueue:
+    """Runs bulk deletions in the background.
+
+       Jobs are rows of `DeleteJob`. A delete worker holds a postgres advisory
+       lock on the job it is running, so a job whose worker died is picked up by
+       another worker. Jobs that fail `DELETE_MAX_ATTEMPTS` times are left in
+       place for inspection.
+    """
+    def submit(self, kind, project, user, media_ids=None):
+        """Creates a delete job. If async deletes are disabled the job runs
+           before this returns.
+        """
+        job = DeleteJob.objects.create(
+            kind=kind,
+            project=project,
+            user=user.pk,
+            uid=str(uuid.uuid1()),
+            gid=str(uuid.uuid1()),
+            media_ids=media_ids,
+            total=len(media_ids) if media_ids else 0,
+        )
+        if not async_deletes_enabled():
+            self.run(job)
+        return job
+
+    def _progress(self, job, name):
+        user = User.objects.filter(pk=job.user).first()
+        return ProgressProducer('delete', job.project, job.gid, job.uid, name, user)
+
+    def run(self, job):
+        """Runs a job to completion and deletes it.
+        """
+        if job.kind == 'project':
+            self._run_project(job)
+        elif job.kind == 'media':
+            self._run_media(job)
+        else:
+            raise Exception(f"Unknown delete job kind {job.kind}!")
+
+    def _report(self, prog, job, name, percent):
+        """Records progress of a job after a batch and sends a progress message
+           if the percentage changed. Returns the new percentage.
+        """
+        job.save(update_fields=['deleted'])
+        new_percent = min(int(100 * job.deleted / max(job.total, 1)), 99)
+        if new_percent != percent:
+            prog.progress(f'Deleting {name}...', new_percent)
+        return new_percent
+
+    def _run_media(self, job):
+        if not Project.objects.filter(pk=job.project).exists():
+            job.delete()
+            return
+        prog = self._progress(job, f'Delete {job.total} media')
+        try:
+            if job.deleted == 0:
+                prog.queued(f'Deleting {job.total} media...')
+            percent = None
+            # Batches are taken from the stored list, starting after those
+            # already deleted, rather than querying on the whole list.
+            while job.deleted < len(job.media_ids):
+                batch = job.media_ids[job.deleted:job.deleted+DELETE_BATCH_SIZE]
+                ids = list(Media.objects.filter(project=job.project, pk__in=batch)\
+                                        .values_list('id', flat=True))
+                if ids:
+                    delete_project_media(job.project, ids)
+                job.deleted += len(batch)
+                percent = self._report(prog, job, 'media', percent)
+            TatorCache().invalidate_media_list_cache(job.project)
+            job.delete()
+            prog.finished(f'Deleted {job.total} media!')
+        except Exception:
+            if job.attempts + 1 >= DELETE_MAX_ATTEMPTS:
+                prog.failed(f'Failed to delete {job.total} media!')
+            raise
+
+    def _run_project(self, job):
+        project = Project.objects.filter(pk=job.project).first()
+        if project is None:
+            job.delete()
+            return
+        stages = project_stages(project.pk)
+        prog = self._progress(job, f'Delete project {project.name}')
+        try:
+            # Documents are dropped first so deleted data stops appearing in
+            # searches right away.
+            TatorSearch().delete_index(project.pk)
+            _raw_delete(IndexOutbox.objects.filter(project=project.pk))
+            if job.total == 0:
+                job.total = sum([qs.count() for _, qs, _ in stages])
+                job.save(update_fields=['total'])
+                prog.queued(f'Deleting {job.total} entities...')
+            percent = None
+            for name, qs, delete_fn in stages:
+                for ids in id_batches(qs):
+                    delete_fn(ids)
+                    job.deleted += len(ids)
+                    percent = self._report(prog, job, name, percent)
+            # Remaining rows are few, so the ORM cascade handles them.
+            project.delete()
+            TatorCache().invalidate_media_list_cache(job.project)
+            job.delete()
+            prog.finished(f'Deleted project {job.project}!')
+        except Exception:
+            if job.attempts + 1 >= DELETE_MAX_ATTEMPTS:
+                prog.failed(f'Failed to delete project {job.project}!')
+            raise
+
+    def _try_lock(self, job_id):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_lock(%s, %s)', [DELETE_LOCK_KEY, job_id])
+            return cursor.fetchone()[0]
+
+    def _unlock(self, job_id):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_unlock(%s, %s)', [DELETE_LOCK_KEY, job_id])
+
+    def _run_next(self):
+        """Runs the oldest job that no other worker holds. Returns whether a job
+           was found.
+        """
+        job_ids = DeleteJob.objects.filter(attempts__lt=DELETE_MAX_ATTEMPTS)\
+                                   .order_by('id').values_list('id', flat=True)
+        for job_id in job_ids:
+            if not self._try_lock(job_id):
+                continue
+            try:
+                # Another worker may have finished the job before the lock.
+                job = DeleteJob.objects.filter(pk=job_id).first()
+                if job is not None:
+                    logger.info(f"Running {job.kind} delete job {job.id} on project {job.project}.")
+                    self.run(job)
+            except Exception:
+                logger.error(f"Delete job {job_id} failed!", exc_info=True)
+                DeleteJob.objects.filter(pk=job_id).update(attempts=F('attempts') + 1)
+            finally:
+                self._unlock(job_id)
+            return True
+        return False
+
+    def work(self):
+        """Runs delete jobs until interrupted.
+        """
+        logger.info("Delete worker started.")
+        while True:
+            if not self._run_next():
+                time.sleep(DELETE_POLL_INTERVAL)
@@ -0,0 +1,465 @@
+import datetime
+import json
+import logging
+import socket
+import time
+import os
+
+import redis
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from elasticsearch.helpers import bulk
+from elasticsearch.helpers import parallel_bulk
+from elasticsearch.exceptions import NotFoundError
+from elasticsearch.exceptions import TransportError
+
+from .search import TatorSearch
+from .search import id_mask
+from .cache import TatorCache
+from .cache import ATTRIBUTE_INDEXES_DIRTY_KEY
+
+logger = logging.getLogger(__name__)
+
+INDEX_MODELS = {
+    'media': 'Media',
+    'localization': 'Localization',
+    'state': 'State',
+    'leaf': 'Leaf',
+}
+""" Model names of entities that can be queued for indexing. """
+
+INDEX_BATCH_SIZE = int(os.getenv('TATOR_INDEX_BATCH_SIZE', 1000))
+INDEX_CHUNK_BYTES = int(os.getenv('TATOR_INDEX_CHUNK_BYTES', 10 * 1024 * 1024))
+INDEX_THREADS = int(os.getenv('TATOR_INDEX_THREADS', 4))
+INDEX_MAX_RETRIES = int(os.getenv('TATOR_INDEX_MAX_RETRIES', 5))
+INDEX_RETRY_IDLE = int(os.getenv('TATOR_INDEX_RETRY_IDLE', 60000))
+""" Number of ids per queue entry, maximum size in bytes of a bulk request,
+    number of bulk requests in flight per worker, number of attempts before an
+    entry is moved to the dead letter stream and time in milliseconds before an
+    unacknowledged entry is retried by another worker.
+"""
+
+INDEX_MAX_BACKOFF = int(os.getenv('TATOR_INDEX_MAX_BACKOFF', 60))
+""" Maximum time in seconds a worker waits before retrying after an error. """
+
+def async_indexing_enabled():
+    """ Indexing is done inline if `TATOR_ASYNC_INDEXING` is false, which is
+        useful for tests and deployments without an index worker.
+    """
+    return os.getenv('TATOR_ASYNC_INDEXING', 'true').lower() not in ['false', '0']
+
+def invalidate_list_caches(project, caches):
+    """ Clears list caches affected by a bulk operation on a project. `caches`
+        may set `media` or `treeleaf` to clear media or leaf lists of the
+        project, and `localization` to a list of (media, type) pairs whose
+        localization lists are cleared.
+    """
+    if not caches:
+        return
+    cache = TatorCache()
+    if caches.get('localization'):
+        cache.invalidate_localization_list_caches([tuple(key) for key in caches['localization']])
+    if caches.get('media'):
+        cache.invalidate_media_list_cache(project)
+    if caches.get('treeleaf'):
+        cache.invalidate_treeleaf_list_cache(project)
+
+class IndexQueue:
+    """Durable queue of entities to be indexed in elasticsearch.
+
+       Ids are appended to a redis stream after the database transaction that
+       created them commits, and are drained by index workers in a consumer
+       group. Each entry is acknowledged and deleted once all of its documents
+       are indexed. Documents that fail are requeued with an incremented attempt
+       count, and entries held by a worker that died are reclaimed after
+       `INDEX_RETRY_IDLE` milliseconds. Entries that fail `INDEX_MAX_RETRIES` times
+       are moved to a dead letter stream.
+    """
+    @classmethod
+    def setup_redis(cls):
+        cls.rds = TatorCache.rds
+        cls.stream = f'{TatorSearch.prefix}index_queue'
+        cls.dead_stream = f'{TatorSearch.prefix}index_queue_dead'
+        cls.stats_key = f'{TatorSearch.prefix}index_stats'
+        cls.tasks_key = f'{TatorSearch.prefix}index_tasks'
+        cls.group = 'indexers'
+
+    def _ensure_group(self):
+        try:
+            self.rds.xgroup_create(self.stream, self.group, id='0', mkstream=True)
+        except redis.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def enqueue(self, model, ids, attempt=0):
+        """Queues entities for indexing once the current transaction commits. If
+           async indexing is disabled the entities are indexed immediately.
+        """
+        ids = [int(id_) for id_ in ids]
+        if not ids:
+            return
+        if not async_indexing_enabled():
+            self.index(model, ids)
+            return
+        def _enqueue():
+            pipe = self.rds.pipeline(transaction=False)
+            for idx in range(0, len(ids), INDEX_BATCH_SIZE):
+                batch = ids[idx:idx+INDEX_BATCH_SIZE]
+                pipe.xadd(self.stream, {
+                    'model': model,
+                    'ids': ','.join([str(id_) for id_ in batch]),
+                    'attempt': attempt,
+                })
+            pipe.hincrby(self.stats_key, 'enqueued', len(ids))
+            pipe.execute()
+        transaction.on_commit(_enqueue)
+
+    def update(self, project, query, attrs, caches=None):
+        """Updates attributes of documents matching a query once the current
+           transaction commits. The update runs as an elasticsearch task that
+           index workers track. If async indexing is disabled the update is
+           complete when this returns. List caches given by `caches` are
+           cleared after the commit and again once the update is searchable.
+        """
+        if not async_indexing_enabled():
+            TatorSearch().update(project, query, attrs)
+            invalidate_list_caches(project, caches)
+            return
+        def _update():
+            invalidate_list_caches(project, caches)
+            self._start_update(project, query, attrs, caches=caches)
+        transaction.on_commit(_update)
+
+    def _start_update(self, project, query, attrs, attempt=0, caches=None):
+        task = TatorSearch().update(project, query, attrs, wait_for_completion=False)
+        self.rds.hset(self.tasks_key, task, json.dumps({
+            'op': 'update',
+            'project': project,
+            'query': query,
+            'attrs': attrs,
+            'attempt': attempt,
+            'caches': caches,
+        }))
+
+    def delete(self, project, query, caches=None):
+        """Deletes documents matching a query once the current transaction
+           commits. Like updates, the delete runs as an elasticsearch task that
+           index workers track, and list caches are cleared once it is
+           searchable.
+        """
+        if not async_indexing_enabled():
+            TatorSearch().delete(project, query)
+            invalidate_list_caches(project, caches)
+            return
+        def _delete():
+            invalidate_list_caches(project, caches)
+            self._start_delete(project, query, caches=caches)
+        transaction.on_commit(_delete)
+
+    def _start_delete(self, project, query, attempt=0, caches=None):
+        task = TatorSearch().delete(project, query, wait_for_completion=False)
+        self.rds.hset(self.tasks_key, task, json.dumps({
+            'op': 'delete',
+            'project': project,
+            'query': query,
+            'attempt': attempt,
+            'caches': caches,
+        }))
+
+    def _check_tasks(self):
+        """Checks update and delete tasks that have completed. Tasks that failed
+           are restarted until they have been tried `INDEX_MAX_RETRIES` times.
+        """
+        ts = TatorSearch()
+        for task, spec in self.rds.hgetall(self.tasks_key).items():
+            task = task.decode()
+            try:
+                result = ts.es.tasks.get(task_id=task)
+            except NotFoundError:
+                result = {'completed': True, 'error': {'reason': 'Task not found.'}}
+            except TransportError:
+                logger.warning(f"Could not get status of update task {task}.", exc_info=True)
+                continue
+            if not result['completed']:
+                continue
+            if not self.rds.hdel(self.tasks_key, task):
+                # Another worker handled this task.
+                continue
+            spec = json.loads(spec)
+            op = spec.get('op', 'update')
+            response = result.get('response', {})
+            error = result.get('error') or response.get('failures')
+            if error:
+                attempt = spec['attempt'] + 1
+                if attempt >= INDEX_MAX_RETRIES:
+                    logger.error(f"Giving up {op} task on project {spec['project']} after "
+                                 f"{attempt} attempts: {error}")
+                    self.rds.hincrby(self.stats_key, 'task_dead', 1)
+                else:
+                    logger.warning(f"{op.capitalize()} task {task} failed, restarting: {error}")
+                    self.rds.hincrby(self.stats_key, 'task_failed', 1)
+                    if op == 'delete':
+                        self._start_delete(spec['project'], spec['query'], attempt,
+                                           spec.get('caches'))
+                    else:
+                        self._start_update(spec['project'], spec['query'], spec['attrs'],
+                                           attempt, spec.get('caches'))
+                    continue
+            elif op == 'delete':
+                self.rds.hincrby(self.stats_key, 'deleted', response.get('deleted', 0))
+            else:
+                self.rds.hincrby(self.stats_key, 'updated', response.get('updated', 0))
+            # Tasks refresh the index when they complete, so results are
+            # searchable by now.
+            invalidate_list_caches(spec['project'], spec.get('caches'))
+
+    def index(self, model, ids):
+        """Indexes entities and returns the ids whose documents failed. List
+           caches are cleared once the documents are visible to searches, so
+           lists read while indexing is in flight are not cached again.
+        """
+        ts = TatorSearch()
+        qs = apps.get_model('main', INDEX_MODELS[model]).objects.filter(pk__in=ids)
+        failed = set()
+        for ok, result in parallel_bulk(ts.es, ts.dual_write(ts.build_documents(qs)),
+                                        thread_count=INDEX_THREADS,
+                                        chunk_size=INDEX_BATCH_SIZE,
+                                        max_chunk_bytes=INDEX_CHUNK_BYTES,
+                                        raise_on_error=False,
+                                        raise_on_exception=False,
+                                        refresh='wait_for'):
+            if not ok:
+                action, result = result.popitem()
+                logger.warning(f"Failed to {action} document! {result}")
+                failed.add(int(result['_id'].split('_')[-1]) & id_mask)
+        self._invalidate_caches(model, ids)
+        return failed
+
+    def _invalidate_caches(self, model, ids):
+        """Clears list caches that may have been filled from search results before
+           these entities were indexed.
+        """
+        model_cls = apps.get_model('main', INDEX_MODELS[model])
+        cache = TatorCache()
+        if model == 'localization':
+            cache.invalidate_localization_list_caches(
+                model_cls.objects.filter(pk__in=ids).values_list('media', 'meta').distinct())
+        projects = model_cls.objects.filter(pk__in=ids).values_list('project', flat=True)
+        for project in set(projects):
+            if model == 'leaf':
+                cache.invalidate_treeleaf_list_cache(project)
+            else:
+                cache.invalidate_media_list_cache(project)
+
+    def _delete(self, deletes):
+        """Deletes documents given outbox rows and returns the entity ids whose
+           deletes failed. Documents that are already gone are ignored.
+        """
+        ts = TatorSearch()
+        actions = [{
+            '_op_type': 'delete',
+            '_index': ts.index_name(row['project']),
+            '_id': f"{row['dtype']}_{row['entity_id']}",
+            '_routing': 1,
+        } for row in deletes]
+        _, errors = bulk(ts.es, ts.dual_write(actions), raise_on_error=False,
+                         raise_on_exception=False, refresh='wait_for')
+        failed = set()
+        for error in errors:
+            _, result = error.popitem()
+            if result.get('status') != 404:
+                logger.warning(f"Failed to delete document! {result}")
+                failed.add(int(result['_id'].split('_')[-1]))
+        # List caches are cleared after the deletes are visible to searches.
+        cache = TatorCache()
+        for project in set([row['project'] for row in deletes]):
+            if deletes[0]['model'] == 'leaf':
+                cache.invalidate_treeleaf_list_cache(project)
+            else:
+                cache.invalidate_media_list_cache(project)
+        return failed
+
+    def drain_outbox(self, batch_size=INDEX_BATCH_SIZE):
+        """Applies a batch of outbox rows to elasticsearch and returns the number
+           of rows consumed. Rows for the same entity are coalesced so only the
+           latest change is applied. Rows are claimed in a short transaction
+           so workers draining concurrently skip each other's rows, and no
+           transaction is held while elasticsearch is written. Rows whose
+           change fails, or whose worker did not finish within
+           `INDEX_RETRY_IDLE`, are retried until `INDEX_MAX_RETRIES`.
+        """
+        IndexOutbox = apps.get_model('main', 'IndexOutbox')
+        now = timezone.now()
+        stale = now - datetime.timedelta(milliseconds=INDEX_RETRY_IDLE)
+        with transaction.atomic():
+            rows = list(IndexOutbox.objects.select_for_update(skip_locked=True)
+                                           .filter(Q(claimed_datetime__isnull=True)
+                                                   | Q(claimed_datetime__lt=stale))
+                                           .order_by('id')[:batch_size]
+                                           .values('id', 'model', 'entity_id', 'project',
+                                                   'dtype', 'op', 'attempts',
+                                                   'claimed_datetime'))
+            if not rows:
+                return 0
+            IndexOutbox.objects.filter(pk__in=[row['id'] for row in rows])\
+                               .update(claimed_datetime=now)
+        for row in rows:
+            # A claim that went stale was an attempt that did not finish.
+            if row['claimed_datetime'] is not None:
+                row['attempts'] += 1
+        latest = {}
+        for row in rows:
+            latest[(row['model'], row['entity_id'])] = row
+        failed = set()
+        for model in INDEX_MODELS:
+            ids = [row['entity_id'] for row in latest.values()
+                   if row['model'] == model and row['op'] == 'index']
+            if ids:
+                failed.update((model, id_) for id_ in self.index(model, ids))
+            deletes = [row for row in latest.values()
+                       if row['model'] == model and row['op'] == 'delete']
+            if deletes:
+                failed.update((model, id_) for id_ in self._delete(deletes))
+        retry = {row['id']: row['attempts'] + 1 for key, row in latest.items()
+                 if key in failed and row['attempts'] + 1 < INDEX_MAX_RETRIES}
+        dead = len(failed) - len(retry)
+        if dead:
+            logger.error(f"Giving up on {dead} outbox changes after {INDEX_MAX_RETRIES} attempts.")
+        with transaction.atomic():
+            for id_, attempts in retry.items():
+                IndexOutbox.objects.filter(pk=id_).update(attempts=attempts,
+                                                          claimed_datetime=None)
+            IndexOutbox.objects.filter(pk__in=[row['id'] for row in rows
+                                               if row['id'] not in retry]).delete()
+        pipe = self.rds.pipeline(transaction=False)
+        pipe.hincrby(self.stats_key, 'coalesced', len(rows) - len(latest))
+        pipe.hincrby(self.stats_key, 'indexed', len(latest) - len(failed))
+        pipe.hincrby(self.stats_key, 'failed', len(failed))
+        pipe.hincrby(self.stats_key, 'dead', dead)
+        pipe.execute()
+        return len(rows)
+
+    def _process(self, messages, times_delivered=None):
+        for message_id, fields in messages:
+            fields = {key.decode(): val.decode() for key, val in fields.items()}
+            model = fields['model']
+            ids = [int(id_) for id_ in fields['ids'].split(',')]
+            attempt = int(fields.get('attempt', 0))
+            if times_delivered is not None:
+                # Each earlier delivery ended without an acknowledgement.
+                attempt += times_delivered.get(message_id, 0)
+            pipe = self.rds.pipeline(transaction=False)
+            if attempt >= INDEX_MAX_RETRIES:
+                logger.error(f"Giving up indexing {len(ids)} {model} entities after {attempt} attempts.")
+                pipe.xadd(self.dead_stream, fields)
+                pipe.hincrby(self.stats_key, 'dead', len(ids))
+            else:
+                failed = self.index(model, ids)
+                if failed:
+                    pipe.xadd(self.stream, {
+                        'model': model,
+                        'ids': ','.join([str(id_) for id_ in failed]),
+                        'attempt': attempt + 1,
+                    })
+                    pipe.hincrby(self.stats_key, 'failed', len(failed))
+                pipe.hincrby(self.stats_key, 'indexed', len(ids) - len(failed))
+            pipe.xack(self.stream, self.group, message_id)
+            pipe.xdel(self.stream, message_id)
+            pipe.execute()
+
+    def _reclaim(self, consumer):
+        """Claims entries whose worker did not acknowledge them in time.
+        """
+        pending = self.rds.xpending_range(self.stream, self.group, '-', '+', INDEX_THREADS * 4)
+        stale = [entry for entry in pending
+                 if entry['time_since_delivered'] >= INDEX_RETRY_IDLE]
+        if not stale:
+            return
+        times_delivered = {entry['message_id']: entry['times_delivered'] for entry in stale}
+        messages = self.rds.xclaim(self.stream, self.group, consumer, INDEX_RETRY_IDLE,
+                                   list(times_delivered.keys()))
+        self._process(messages, times_delivered)
+
+    def _sync_attribute_indexes(self):
+        """Updates attribute indexes if an entity type changed.
+        """
+        # Imported here because models imports this module.
+        from .rest._attribute_router import sync_attribute_indexes
+        if self.rds.delete(ATTRIBUTE_INDEXES_DIRTY_KEY):
+            try:
+                sync_attribute_indexes()
+            except Exception:
+                logger.error("Failed to update attribute indexes!", exc_info=True)
+                self.rds.set(ATTRIBUTE_INDEXES_DIRTY_KEY, 1)
+
+    def work(self, consumer=None, block=1000, count=4):
+        """Drains the queue and the outbox until interrupted. Attribute indexes
+           are also updated and update and delete tasks checked here since they
+           can take a while.
+        """
+        if consumer is None:
+            consumer = f'{socket.gethostname()}_{os.getpid()}'
+        self._ensure_group()
+        logger.info(f"Index worker {consumer} started.")
+        backoff = 1
+        while True:
+            try:
+                self._reclaim(consumer)
+                self._sync_attribute_indexes()
+                self._check_tasks()
+                drained = self.drain_outbox()
+                # Only wait on the stream if the outbox is empty.
+                streams = self.rds.xreadgroup(self.group, consumer, {self.stream: '>'},
+                                              count=count, block=None if drained else block)
+                for _, messages in streams:
+                    self._process(messages)
+                backoff = 1
+            except redis.ConnectionError:
+                logger.warning(f"Lost connection to redis, retrying in {backoff}s...")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, INDEX_MAX_BACKOFF)
+            except Exception:
+                # Keep the worker alive through database or elasticsearch
+                # outages; unacknowledged entries are reclaimed on retry.
+                logger.error(f"Index worker {consumer} failed, retrying in {backoff}s...",
+                             exc_info=True)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, INDEX_MAX_BACKOFF)
+
+    def get_stats(self):
+        """Returns counters, queue depth and lag in seconds of the oldest entry
+           not yet indexed.
+        """
+        counters = {key.decode(): int(val) for key, val in self.rds.hgetall(self.stats_key).items()}
+        stats = {counter: counters.get(counter, 0)
+                 for counter in ['enqueued', 'indexed', 'coalesced', 'failed', 'dead',
+                                 'updated', 'deleted', 'task_failed', 'task_dead']}
+        stats['depth'] = 0
+        stats['pending'] = 0
+        stats['lag'] = 0.0
+        if self.rds.exists(self.stream):
+            # Acknowledged entries are deleted, so the first entry in the stream
+            # is the oldest one not yet indexed.
+            stats['depth'] = self.rds.xlen(self.stream)
+            oldest = self.rds.xrange(self.stream, count=1)
+            if oldest:
+                oldest_ms = int(oldest[0][0].decode().split('-')[0])
+                stats['lag'] = max(0.0, time.time() - oldest_ms / 1000.0)
+            self._ensure_group()
+            stats['pending'] = self.rds.xpending(self.stream, self.group)['pending']
+        stats['dead_depth'] = self.rds.xlen(self.dead_stream)
+        stats['tasks'] = self.rds.hlen(self.tasks_key)
+        outbox = apps.get_model('main', 'IndexOutbox').objects
+        stats['outbox_depth'] = outbox.count()
+        oldest = outbox.order_by('id').values_list('created_datetime', flat=True).first()
+        stats['outbox_lag'] = 0.0
+        if oldest is not None:
+            stats['outbox_lag'] = max(0.0, time.time() - oldest.timestamp())
+        return stats
+
+    def reset_stats(self):
+        self.rds.delete(self.stats_key)
+
+IndexQueue.setup_redis()
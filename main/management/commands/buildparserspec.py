@@ -0,0 +1,18 @@
+import json
+import logging
+
+from django.core.management.base import BaseCommand
+
+from main.schema._parse import build_spec
+from main.schema._parse import SPEC_PATH
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = 'Prebuilds the OpenAPI spec used to parse requests.'
+
+    def handle(self, *args, **options):
+        spec = build_spec()
+        with open(SPEC_PATH, 'w') as f:
+            json.dump(spec, f)
+        logger.info(f"Wrote parser spec to {SPEC_PATH}.")
@@ -5,6 +5,13 @@ class Command(BaseCommand):
 		def add_arguments(self, parser):
 				parser.add_argument('project_id', type=int)
 				parser.add_argument('section', type=str)
+				parser.add_argument('--processes', type=int, default=4,
+														help="Number of worker processes building documents.")
+				parser.add_argument('--range-size', type=int, default=100000,
+														help="Number of IDs in each range given to a worker.")
+				parser.add_argument('--restart', action='store_true',
+														help="Ignore ranges completed by a previous run.")
 
 		def handle(self, **options):
-				buildSearchIndices(options['project_id'], options['section'], 'index')
+				buildSearchIndices(options['project_id'], options['section'], 'index',
+													 options['processes'], options['range_size'], options['restart'])
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from main.cache import TatorCache
+from main.cache import FrameCache
+
+class Command(BaseCommand):
+    help = "Prints hit, miss and eviction counters and memory usage for each cache family."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true',
+                            help="Reset counters after printing them.")
+
+    def handle(self, *args, **options):
+        cache = TatorCache()
+        stats = cache.get_stats()
+        stats['frame'] = FrameCache().get_stats()
+        for family, counters in stats.items():
+            lookups = counters['hits'] + counters['misses']
+            hit_rate = counters['hits'] / lookups if lookups else 0.0
+            self.stdout.write(
+                f"{family}: hits={counters['hits']} misses={counters['misses']} "
+                f"hit_rate={hit_rate:.3f} evictions={counters['evictions']} "
+                f"oversize={counters['oversize']} groups={counters['groups']} "
+                f"bytes={counters['bytes']}/{counters['budget']}"
+            )
+        if options['reset']:
+            cache.reset_stats()
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+
+from main.deleter import DeleteQueue
+
+class Command(BaseCommand):
+    help = "Runs bulk delete jobs in the background."
+
+    def handle(self, *args, **options):
+        DeleteQueue().work()
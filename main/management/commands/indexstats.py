@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from main.indexer import IndexQueue
+
+class Command(BaseCommand):
+    help = "Prints counters, depth and lag of the elasticsearch index queue and outbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true',
+                            help="Reset counters after printing them.")
+
+    def handle(self, *args, **options):
+        queue = IndexQueue()
+        stats = queue.get_stats()
+        self.stdout.write(
+            f"enqueued={stats['enqueued']} indexed={stats['indexed']} "
+            f"coalesced={stats['coalesced']} failed={stats['failed']} dead={stats['dead']} "
+            f"depth={stats['depth']} pending={stats['pending']} lag={stats['lag']:.1f}s "
+            f"dead_depth={stats['dead_depth']} outbox_depth={stats['outbox_depth']} "
+            f"outbox_lag={stats['outbox_lag']:.1f}s updated={stats['updated']} "
+            f"deleted={stats['deleted']} tasks={stats['tasks']} task_failed={stats['task_failed']} "
+            f"task_dead={stats['task_dead']}"
+        )
+        if options['reset']:
+            queue.reset_stats()
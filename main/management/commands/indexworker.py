@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from main.indexer import IndexQueue
+
+class Command(BaseCommand):
+    help = "Drains the elasticsearch index queue."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--consumer', type=str, default=None,
+                            help="Consumer name, defaults to hostname and pid.")
+
+    def handle(self, *args, **options):
+        IndexQueue().work(options['consumer'])
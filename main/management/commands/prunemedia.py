@@ -1,9 +1,12 @@
 from django.core.management.base import BaseCommand
 from main.models import Media
+from main.deleter import id_batches
+from main.deleter import delete_media
 
 class Command(BaseCommand):
     help = 'Deletes any media files marked for deletion with null project.'
 
     def handle(self, **options):
         media = Media.objects.filter(project__isnull=True)
-        media.delete()
+        for ids in id_batches(media):
+            delete_media(ids)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from main.util import rebuildSearchIndex
+
+class Command(BaseCommand):
+		help = "Rebuilds the search index of a project into a new index and swaps it in."
+
+		def add_arguments(self, parser):
+				parser.add_argument('project_id', type=int)
+				parser.add_argument('--processes', type=int, default=4,
+														help="Number of worker processes building documents.")
+				parser.add_argument('--range-size', type=int, default=100000,
+														help="Number of IDs in each range given to a worker.")
+
+		def handle(self, **options):
+				rebuildSearchIndex(options['project_id'], options['processes'], options['range_size'])
@@ -0,0 +1,9 @@
+from django.core.management.base import BaseCommand
+
+from main.rest._attribute_router import sync_attribute_indexes
+
+class Command(BaseCommand):
+    help = "Creates and drops attribute indexes used to filter lists in postgres."
+
+    def handle(self, *args, **options):
+        sync_attribute_indexes()
@@ -1,4 +1,4 @@
-import time
+import os
 
 from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
@@ -7,9 +7,11 @@ from main.util import waitForMigrations
 from main.util import updateProjectTotals
 
 class Command(BaseCommand):
-    help = "Updates project totals periodically."
+    help = "Reconciles project totals periodically."
 
     def handle(self, *args, **options):
+        # Totals are maintained as files are added and removed, so this only
+        # catches drift and should yield to other work.
+        os.nice(19)
         waitForMigrations()
         updateProjectTotals()
-
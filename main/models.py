@@ -28,8 +28,12 @@ from django.contrib.postgres.fields import JSONField
 from django.core.validators import MinValueValidator
 from django.core.validators import RegexValidator
 from django.db.models import FloatField, Transform
+from django.db.models import Index
+from django.db.models import F
+from django.db import transaction
 from django.db.models.signals import post_save
 from django.db.models.signals import pre_delete
+from django.db.models.signals import post_delete
 from django.db.models.signals import m2m_changed
 from django.dispatch import receiver
 from django.conf import settings
@@ -39,6 +43,10 @@ from enumfields import EnumField
 from django_ltree.fields import PathField
 
 from .search import TatorSearch
+from .search import mediaFileSizes
+from .cache import TatorCache
+from .cache import FrameCache
+from .indexer import async_indexing_enabled
 
 from collections import UserDict
 
@@ -48,6 +56,7 @@ import logging
 import os
 import shutil
 import uuid
+import weakref
 
 # Load the main.view logger
 logger = logging.getLogger(__name__)
@@ -150,6 +159,9 @@ class Project(Model):
     """Size of all media in project in bytes.
     """
     num_files = IntegerField(default=0)
+    """Number of media and temporary files in project. Size and number of files
+       are counters adjusted as files are added and removed.
+    """
     summary = CharField(max_length=1024)
     filter_autocomplete = JSONField(null=True, blank=True)
     def has_user(self, user_id):
@@ -216,6 +228,7 @@ def project_save(sender, instance, created, **kwargs):
 @receiver(pre_delete, sender=Project)
 def delete_index_project(sender, instance, **kwargs):
     TatorSearch().delete_index(instance.pk)
+    TatorCache().invalidate_cred_cache(instance.pk)
 
 class Membership(Model):
     """Stores a user and their access level for a project.
@@ -226,6 +239,38 @@ class Membership(Model):
     def __str__(self):
         return f'{self.user} | {self.permission} | {self.project}'
 
+@receiver(post_save, sender=Membership)
+@receiver(post_delete, sender=Membership)
+def membership_changed(sender, instance, **kwargs):
+    # Caches are cleared again once the change commits, since permissions
+    # read by other connections until then are still the old ones.
+    project_id = instance.project_id
+    TatorCache().invalidate_cred_cache(project_id)
+    transaction.on_commit(lambda: TatorCache().invalidate_cred_cache(project_id))
+
+def get_user_permission(user_id, project_id):
+    """ Returns the permission of a user in a project, or None if the user is not
+        a member. Lookups go through the in-process and redis credential caches
+        before falling back to the database. Non-membership is cached as well, and
+        both are invalidated when a membership change commits. Results read
+        while a change was committing are not cached.
+    """
+    cache = TatorCache()
+    permission = cache.get_cred_cache(user_id, project_id)
+    if permission is None:
+        generation = cache.get_cred_generation(project_id)
+        qs = Membership.objects.filter(user=user_id, project=project_id)\
+                               .values_list('permission', flat=True)
+        permission = ''
+        for value in qs[:1]:
+            permission = Permission(value).value
+        cache.set_cred_cache(user_id, project_id, permission, generation)
+    if permission:
+        permission = Permission(permission)
+    else:
+        permission = None
+    return permission
+
 class EntityTypeBase(PolymorphicModel):
     """ .. deprecated :: Use MediaType, LocalizationType, or StateType object """
     project = ForeignKey(Project, on_delete=CASCADE, null=True, blank=True)
@@ -696,6 +741,8 @@ class TemporaryFile(Model):
     """ Time that the file was created """
     eol_datetime = DateTimeField()
     """ Time the file expires (reaches EoL) """
+    size = BigIntegerField(null=True, blank=True)
+    """ Size of the file in bytes """
 
     def expire(self):
         """ Set a given temporary file as expired """
@@ -722,12 +769,19 @@ class TemporaryFile(Model):
                                   path=destination_fp,
                                   lookup=lookup,
                                   created_datetime=now,
-                                  eol_datetime = eol)
+                                  eol_datetime = eol,
+                                  size=os.path.getsize(destination_fp))
         temp_file.save()
         return temp_file
 
+@receiver(post_save, sender=TemporaryFile)
+def temporary_file_save(sender, instance, created, **kwargs):
+    if created:
+        adjust_project_totals(instance.project_id, 1, instance.size or 0)
+
 @receiver(pre_delete, sender=TemporaryFile)
 def temporary_file_delete(sender, instance, **kwargs):
+    adjust_project_totals(instance.project_id, -1, -(instance.size or 0))
     if os.path.exists(instance.path):
         os.remove(instance.path)
 
@@ -782,6 +836,7 @@ class MediaType(Model):
 @receiver(post_save, sender=MediaType)
 def media_type_save(sender, instance, **kwargs):
     TatorSearch().create_mapping(instance)
+    TatorCache().invalidate_attribute_catalog(instance.project_id)
 
 class LocalizationType(Model):
     polymorphic = OneToOneField(EntityTypeBase, on_delete=SET_NULL, null=True, blank=True,
@@ -827,6 +882,7 @@ class LocalizationType(Model):
 @receiver(post_save, sender=LocalizationType)
 def localization_type_save(sender, instance, **kwargs):
     TatorSearch().create_mapping(instance)
+    TatorCache().invalidate_attribute_catalog(instance.project_id)
 
 class StateType(Model):
     polymorphic = OneToOneField(EntityTypeBase, on_delete=SET_NULL, null=True, blank=True,
@@ -875,6 +931,7 @@ class StateType(Model):
 @receiver(post_save, sender=StateType)
 def state_type_save(sender, instance, **kwargs):
     TatorSearch().create_mapping(instance)
+    TatorCache().invalidate_attribute_catalog(instance.project_id)
 
 class LeafType(Model):
     polymorphic = OneToOneField(EntityTypeBase, on_delete=SET_NULL, null=True, blank=True,
@@ -916,11 +973,89 @@ class LeafType(Model):
 @receiver(post_save, sender=LeafType)
 def leaf_type_save(sender, instance, **kwargs):
     TatorSearch().create_mapping(instance)
+    TatorCache().invalidate_attribute_catalog(instance.project_id)
+
 
+@receiver(post_delete, sender=MediaType)
+@receiver(post_delete, sender=LocalizationType)
+@receiver(post_delete, sender=StateType)
+@receiver(post_delete, sender=LeafType)
+def entity_type_delete(sender, instance, **kwargs):
+    TatorCache().invalidate_attribute_catalog(instance.project_id)
 
 # Entities (stores actual data)
 
-class Media(Model):
+class IndexedModel(Model):
+    """ Base class of entities that are indexed in elasticsearch. Saves are
+        atomic so the outbox entry written by the post_save receiver commits
+        with the entity.
+    """
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+
+class IndexOutbox(Model):
+    """ Pending elasticsearch changes to entities, written in the same
+        transaction as the change and applied in bulk by index workers.
+    """
+    model = CharField(max_length=16)
+    """ One of media, localization, state or leaf. """
+    entity_id = BigIntegerField()
+    project = IntegerField(null=True, blank=True)
+    dtype = CharField(max_length=16)
+    """ Entity dtype, needed to build the document ID after a delete. """
+    op = CharField(max_length=16, choices=[('index', 'index'), ('delete', 'delete')])
+    attempts = IntegerField(default=0)
+    created_datetime = DateTimeField(auto_now_add=True)
+    claimed_datetime = DateTimeField(null=True, blank=True)
+    """ Set while a worker applies the change, so other workers skip the row
+        until the claim is older than `TATOR_INDEX_RETRY_IDLE`.
+    """
+
+    class Meta:
+        indexes = [Index(fields=['model', 'entity_id'])]
+
+class DeleteJob(Model):
+    """ Bulk deletion run by delete workers. Rows are deleted in batches that
+        each commit on their own, so an interrupted job resumes where it
+        stopped.
+    """
+    kind = CharField(max_length=16, choices=[('project', 'project'), ('media', 'media')])
+    project = IntegerField()
+    """ Not a foreign key, since the project is deleted by the job. """
+    media_ids = JSONField(null=True, blank=True)
+    """ Media deleted by a media job. """
+    user = IntegerField(null=True, blank=True)
+    uid = CharField(max_length=36)
+    """ Progress message uid. """
+    gid = CharField(max_length=36)
+    """ Progress message group id. """
+    total = BigIntegerField(default=0)
+    deleted = BigIntegerField(default=0)
+    attempts = IntegerField(default=0)
+    created_datetime = DateTimeField(auto_now_add=True)
+
+def queue_index(instance, op='index'):
+    """ Records an elasticsearch change for an entity. If async indexing is
+        disabled the change is applied immediately.
+    """
+    if async_indexing_enabled():
+        IndexOutbox.objects.create(
+            model=instance._meta.model_name,
+            entity_id=instance.pk,
+            project=instance.project_id,
+            dtype=instance.meta.dtype,
+            op=op,
+        )
+    elif op == 'index':
+        TatorSearch().create_document(instance)
+    else:
+        TatorSearch().delete_document(instance)
+
+class Media(IndexedModel):
     """
     Fields:
 
@@ -1011,10 +1146,50 @@ class Media(Model):
     segment_info = FilePathField(path=settings.MEDIA_ROOT, null=True,
                                  blank=True)
     media_files = JSONField(null=True, blank=True)
+    total_size = BigIntegerField(null=True, blank=True)
+    """ Size of all files of this media in bytes, set by `update_media_size`.
+    """
+    download_size = BigIntegerField(null=True, blank=True)
+    """ Size of the file downloaded for this media in bytes.
+    """
+
+def adjust_project_totals(project_id, num_files=0, size=0):
+    """ Atomically adds to the number of files and size of a project.
+    """
+    if project_id is not None and (num_files or size):
+        Project.objects.filter(pk=project_id).update(num_files=F('num_files') + num_files,
+                                                     size=F('size') + size)
+
+def update_media_size(media):
+    """ Computes and stores the size of a saved media's files. This should be
+        called once the files are written rather than whenever sizes are
+        needed. The change in size is added to the project total.
+    """
+    total_size, download_size = mediaFileSizes(media)
+    delta = total_size - (media.total_size or 0)
+    media.total_size = total_size
+    media.download_size = download_size
+    Media.objects.filter(pk=media.pk).update(total_size=total_size, download_size=download_size)
+    adjust_project_totals(media.project_id, size=delta)
+
+def invalidate_media_caches(instance):
+    """ Clears list caches that may contain this media, including localization
+        lists filtered on media attributes.
+    """
+    if instance.project_id is not None:
+        cache = TatorCache()
+        cache.invalidate_media_list_cache(instance.project_id)
+        type_ids = LocalizationType.objects.filter(project=instance.project_id)\
+                                           .values_list('id', flat=True)
+        cache.invalidate_localization_list_caches([(instance.pk, type_id)
+                                                   for type_id in type_ids])
 
 @receiver(post_save, sender=Media)
 def media_save(sender, instance, created, **kwargs):
-    TatorSearch().create_document(instance)
+    if created:
+        adjust_project_totals(instance.project_id, 1, instance.total_size or 0)
+    queue_index(instance)
+    invalidate_media_caches(instance)
 
 def safe_delete(path):
     try:
@@ -1026,7 +1201,10 @@ def safe_delete(path):
 @receiver(pre_delete, sender=Media)
 def media_delete(sender, instance, **kwargs):
     if instance.project:
-        TatorSearch().delete_document(instance)
+        queue_index(instance, 'delete')
+        invalidate_media_caches(instance)
+        adjust_project_totals(instance.project_id, -1, -(instance.total_size or 0))
+    FrameCache().invalidate(instance.id)
     instance.file.delete(False)
     if instance.original != None:
         path = str(instance.original)
@@ -1046,7 +1224,7 @@ def media_delete(sender, instance, **kwargs):
     instance.thumbnail.delete(False)
     instance.thumbnail_gif.delete(False)
 
-class Localization(Model):
+class Localization(IndexedModel):
     polymorphic = OneToOneField(EntityBase, on_delete=SET_NULL, null=True, blank=True,
                                 related_name='localization_polymorphic')
     """ Temporary field for migration. """
@@ -1093,20 +1271,32 @@ class Localization(Model):
     parent = ForeignKey("self", on_delete=SET_NULL, null=True, blank=True,db_column='parent')
     """ Pointer to localization in which this one was generated from """
 
+def invalidate_annotation_caches(instance):
+    """ Clears list caches that may contain this annotation. Media lists are
+        included because they may be filtered on annotation attributes.
+    """
+    cache = TatorCache()
+    if isinstance(instance, Localization):
+        cache.invalidate_localization_list_cache(instance.media_id, instance.meta_id)
+    if instance.project_id is not None:
+        cache.invalidate_media_list_cache(instance.project_id)
+
 @receiver(post_save, sender=Localization)
 def localization_save(sender, instance, created, **kwargs):
     if getattr(instance,'_inhibit', False) == False:
-        TatorSearch().create_document(instance)
+        queue_index(instance)
     else:
         pass
+    invalidate_annotation_caches(instance)
 
 @receiver(pre_delete, sender=Localization)
 def localization_delete(sender, instance, **kwargs):
-    TatorSearch().delete_document(instance)
+    queue_index(instance, 'delete')
+    invalidate_annotation_caches(instance)
     if instance.thumbnail_image:
         instance.thumbnail_image.delete()
 
-class State(Model):
+class State(IndexedModel):
     """
     A State is an event that occurs, potentially independent, from that of
     a media element. It is associated with 0 (1 to be useful) or more media
@@ -1152,11 +1342,13 @@ class State(Model):
 
 @receiver(post_save, sender=State)
 def state_save(sender, instance, created, **kwargs):
-    TatorSearch().create_document(instance)
+    queue_index(instance)
+    invalidate_annotation_caches(instance)
 
 @receiver(pre_delete, sender=State)
 def state_delete(sender, instance, **kwargs):
-    TatorSearch().delete_document(instance)
+    queue_index(instance, 'delete')
+    invalidate_annotation_caches(instance)
 
 @receiver(m2m_changed, sender=State.localizations.through)
 def calc_segments(sender, **kwargs):
@@ -1186,7 +1378,7 @@ def calc_segments(sender, **kwargs):
         segmentList.append(current)
     instance.segments = segmentList
 
-class Leaf(Model):
+class Leaf(IndexedModel):
     polymorphic = OneToOneField(EntityBase, on_delete=SET_NULL, null=True, blank=True,
                                 related_name='leaf_polymorphic')
     """ Temporary field for migration. """
@@ -1235,11 +1427,13 @@ class Leaf(Model):
 
 @receiver(post_save, sender=Leaf)
 def leaf_save(sender, instance, **kwargs):
-    TatorSearch().create_document(instance)
+    queue_index(instance)
+    TatorCache().invalidate_treeleaf_list_cache(instance.project_id)
 
 @receiver(pre_delete, sender=Leaf)
 def leaf_delete(sender, instance, **kwargs):
-    TatorSearch().delete_document(instance)
+    queue_index(instance, 'delete')
+    TatorCache().invalidate_treeleaf_list_cache(instance.project_id)
 
 class Analysis(Model):
     polymorphic = OneToOneField(AnalysisBase, on_delete=SET_NULL, null=True, blank=True,
@@ -1272,15 +1466,16 @@ def make_dict(keys, row):
     return d
 
 def database_qs(qs):
-    return database_query(str(qs.query))
+    query, params = qs.query.sql_with_params()
+    return database_query(query, params)
 
-def database_query(query):
+def database_query(query, params=None):
     from django.db import connection
     import datetime
     with connection.cursor() as d_cursor:
         cursor = d_cursor.cursor
         bq=datetime.datetime.now()
-        cursor.execute(query)
+        cursor.execute(query, params)
         aq=datetime.datetime.now()
         l=[make_dict(cursor.description, x) for x in cursor]
         af=datetime.datetime.now()
@@ -1288,12 +1483,74 @@ def database_query(query):
         logger.info(f"List = {af-aq}")
     return l
 
-def database_query_ids(table, ids, order):
-    """ Given table name and list of IDs, do query using a subquery expression.
-        TODO: Is this faster than just using `database_qs()` in conjunction
-        with `database_query()`?
+ID_CHUNK_SIZE = int(os.getenv('TATOR_ID_CHUNK_SIZE', 10000))
+""" Number of IDs bound to each execution of an ID query. """
+
+_prepared_statements = weakref.WeakKeyDictionary()
+""" Names of statements prepared on each database connection. """
+
+def _execute_prepared(cursor, name, query, params):
+    """ Executes a query with `$n` placeholders as a prepared statement, so
+        repeated executions on a connection reuse its plan.
+    """
+    prepared = _prepared_statements.setdefault(cursor.connection, set())
+    if name not in prepared:
+        cursor.execute(f'PREPARE {name} AS {query}')
+        prepared.add(name)
+    cursor.execute(f'EXECUTE {name} ({", ".join(["%s"] * len(params))})', params)
+
+def _ids_statement(table, order):
+    """ Returns name and text of a statement selecting rows of a table given an
+        array of IDs, ordered by a column or by position in the array.
     """
-    query = (f'SELECT * FROM \"{table}\" WHERE \"{table}\".\"id\" IN '
-             f'(VALUES ({"), (".join([str(id_) for id_ in ids])})) '
+    if order is None:
+        name = f'ids_{table}'
+        order = 'ids.ord'
+    else:
+        name = f'ids_{table}_{"".join([c for c in order if c.isalnum()])}'
+    query = (f'SELECT t.* FROM "{table}" t '
+             f'JOIN unnest($1::int[]) WITH ORDINALITY AS ids(id, ord) ON t.id = ids.id '
              f'ORDER BY {order}')
-    return database_query(query)
+    return name, query
+
+def database_query_ids(table, ids, order=None):
+    """ Given table name and list of IDs, returns rows in the order of the IDs,
+        or ordered by column `order` if given. IDs are bound as an array
+        parameter of a prepared statement, `ID_CHUNK_SIZE` at a time.
+    """
+    if order is None:
+        return [row for chunk in database_query_ids_stream(table, ids) for row in chunk]
+    return [row for chunk in database_query_ids_stream(table, ids, order, max(len(ids), 1))
+            for row in chunk]
+
+def database_qs_stream(qs, chunk_size=1000):
+    query, params = qs.query.sql_with_params()
+    return database_query_stream(query, chunk_size, params)
+
+def database_query_stream(query, chunk_size=1000, params=None):
+    """ Generator version of `database_query()`. Rows are read from a server-side
+        cursor and yielded as lists of at most `chunk_size` dicts, so memory use
+        does not depend on the size of the result.
+    """
+    from django.db import connection
+    with connection.chunked_cursor() as d_cursor:
+        cursor = d_cursor.cursor
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [make_dict(cursor.description, x) for x in rows]
+
+def database_query_ids_stream(table, ids, order=None, chunk_size=ID_CHUNK_SIZE):
+    """ Generator version of `database_query_ids()`. IDs are queried `chunk_size`
+        at a time in the order given, so if `order` is given it only applies
+        within each chunk.
+    """
+    from django.db import connection
+    name, query = _ids_statement(table, order)
+    with connection.cursor() as d_cursor:
+        cursor = d_cursor.cursor
+        for idx in range(0, len(ids), chunk_size):
+            _execute_prepared(cursor, name, query, [list(ids[idx:idx + chunk_size])])
+            yield [make_dict(cursor.description, x) for x in cursor]
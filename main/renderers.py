@@ -1,12 +1,28 @@
 from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+from django.http import StreamingHttpResponse
+from dateutil.parser import isoparse
 
 import csv
+import datetime
 import io
+import json
 import ujson
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from collections import OrderedDict
 from pprint import pprint
 
+def _flatten(entry, field_names):
+    row_object={}
+    for field in field_names:
+        if type(entry[field]) in [OrderedDict, dict]:
+            row_object.update(entry[field])
+        else:
+            row_object[field] = entry[field]
+    return row_object
+
 class CsvRenderer(BaseRenderer):
     """ renders an object (list of objects) to a CSV file """
     media_type = 'text/plain'
@@ -21,13 +37,7 @@ class CsvRenderer(BaseRenderer):
             if len(listObj) > 0:
                 field_names=listObj[0].keys()
                 for entry in listObj:
-                    row_object={}
-                    for field in field_names:
-                        if type(entry[field]) in [OrderedDict, dict]:
-                            row_object.update(entry[field])
-                        else:
-                            row_object[field] = entry[field]
-                    temp_list.append(row_object)
+                    temp_list.append(_flatten(entry, field_names))
                 field_names=temp_list[0].keys()
                 writer=csv.DictWriter(temp_file,
                                       fieldnames=field_names,
@@ -40,6 +50,56 @@ class CsvRenderer(BaseRenderer):
         finally:
             return return_value
 
+def stream_csv(chunks):
+    """ Incremental version of `CsvRenderer`. Consumes an iterable of lists of
+        objects and yields CSV text one chunk at a time. Columns are determined by
+        the first object, as in `CsvRenderer`.
+    """
+    temp_file=io.StringIO()
+    writer=None
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        if writer is None:
+            row_fields=chunk[0].keys()
+            field_names=_flatten(chunk[0], row_fields).keys()
+            writer=csv.DictWriter(temp_file,
+                                  fieldnames=field_names,
+                                  extrasaction='ignore')
+            writer.writeheader()
+        writer.writerows([_flatten(entry, row_fields) for entry in chunk])
+        yield temp_file.getvalue()
+        temp_file.seek(0)
+        temp_file.truncate()
+    if writer is None:
+        yield "No Records found."
+
+def stream_json(chunks):
+    """ Incremental version of the JSON renderer. Consumes an iterable of lists of
+        objects and yields a single JSON array one chunk at a time.
+    """
+    first=True
+    yield '['
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        encoded=json.dumps(chunk, cls=JSONEncoder, ensure_ascii=False, separators=(',', ':'))
+        if not first:
+            yield ','
+        yield encoded[1:-1]
+        first=False
+    yield ']'
+
+def streaming_response(chunks, format):
+    """ Returns a `StreamingHttpResponse` for an iterable of lists of objects in
+        the given format, which must be json or csv.
+    """
+    if format == 'csv':
+        return StreamingHttpResponse(stream_csv(chunks),
+                                     content_type=CsvRenderer.media_type)
+    return StreamingHttpResponse(stream_json(chunks),
+                                 content_type='application/json')
+
 class PprintRenderer(BaseRenderer):
     """ renders an object (list of objects) to a CSV file """
     media_type = 'application/json'
@@ -60,6 +120,140 @@ class UJsonRenderer(BaseRenderer):
     def render(self, obj, media_type=None, renderer_context=None):
         return ujson.dumps(obj, ensure_ascii=True, escape_forward_slashes=False)
 
+def _to_utc(value):
+    if isinstance(value, str):
+        value = isoparse(value)
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+ARROW_TYPES = {
+    'bool': (pa.bool_(), bool),
+    'int': (pa.int64(), int),
+    'float': (pa.float64(), float),
+    'enum': (pa.string(), str),
+    'string': (pa.string(), str),
+    'datetime': (pa.timestamp('us'), _to_utc),
+    'geopos': (pa.list_(pa.float64()), lambda value: [float(v) for v in value]),
+}
+""" Arrow type and value conversion for each attribute dtype. Datetimes are
+    stored in UTC.
+"""
+
+FIELD_DTYPES = {
+    'AutoField': 'int',
+    'IntegerField': 'int',
+    'BigIntegerField': 'int',
+    'PositiveIntegerField': 'int',
+    'ForeignKey': 'int',
+    'OneToOneField': 'int',
+    'FloatField': 'float',
+    'BooleanField': 'bool',
+    'DateTimeField': 'datetime',
+    'CharField': 'string',
+    'TextField': 'string',
+    'SlugField': 'string',
+}
+""" Attribute dtype used for each type of model field in arrow output. Fields
+    of other types have their arrow type inferred from values.
+"""
+
+def get_arrow_columns(model, attribute_types):
+    """ Returns a list of (column, source, dtype, is_attribute) tuples describing the
+        typed columns of arrow output for a model and a list of attribute types.
+        Attributes defined with different dtypes by different types are exported
+        as strings.
+    """
+    columns = []
+    for field in model._meta.concrete_fields:
+        dtype = FIELD_DTYPES.get(field.get_internal_type(), None)
+        if dtype is not None:
+            columns.append((field.column, field.column, dtype, False))
+    field_names = set([column[0] for column in columns])
+    attr_dtypes = OrderedDict()
+    for attr_type in attribute_types:
+        name = attr_type['name']
+        dtype = attr_type['dtype']
+        if dtype not in ARROW_TYPES:
+            dtype = 'string'
+        if attr_dtypes.get(name, dtype) != dtype:
+            dtype = 'string'
+        attr_dtypes[name] = dtype
+    for name, dtype in attr_dtypes.items():
+        column = f'attributes.{name}' if name in field_names else name
+        columns.append((column, name, dtype, True))
+    return columns
+
+def _make_array(values, dtype):
+    arrow_type, convert = ARROW_TYPES[dtype]
+    converted = []
+    for value in values:
+        try:
+            converted.append(None if value is None else convert(value))
+        except (TypeError, ValueError):
+            converted.append(None)
+    return pa.array(converted, type=arrow_type)
+
+def make_arrow_table(data, columns):
+    """ Converts a list of objects to an arrow table. Attributes are flattened into
+        one column per attribute, and columns described by `get_arrow_columns` are
+        typed accordingly. A single object, such as a count or error message, is
+        converted to a table with one row.
+    """
+    if isinstance(data, dict):
+        return pa.Table.from_arrays([pa.array([value]) for value in data.values()],
+                                    names=list(data.keys()))
+    typed = {column[1]: column[2] for column in columns if not column[3]}
+    if len(data) > 0:
+        field_names = [key for key in data[0].keys() if key != 'attributes']
+    else:
+        field_names = list(typed.keys())
+    names = []
+    arrays = []
+    for field in field_names:
+        values = [entry.get(field) for entry in data]
+        names.append(field)
+        if field in typed:
+            arrays.append(_make_array(values, typed[field]))
+        else:
+            arrays.append(pa.array(values))
+    for column, source, dtype, is_attribute in columns:
+        if is_attribute:
+            values = [(entry.get('attributes') or {}).get(source) for entry in data]
+            names.append(column)
+            arrays.append(_make_array(values, dtype))
+    return pa.Table.from_arrays(arrays, names=names)
+
+def _arrow_columns(renderer_context):
+    view = (renderer_context or {}).get('view', None)
+    return getattr(view, 'arrow_columns', [])
+
+class ArrowRenderer(BaseRenderer):
+    """ renders an object (list of objects) to an Arrow IPC stream """
+    media_type = 'application/vnd.apache.arrow.stream'
+    charset = None
+    format = 'arrow'
+
+    def render(self, data, media_type=None, renderer_context=None):
+        table = make_arrow_table(data, _arrow_columns(renderer_context))
+        sink = pa.BufferOutputStream()
+        writer = pa.RecordBatchStreamWriter(sink, table.schema)
+        writer.write_table(table)
+        writer.close()
+        return sink.getvalue().to_pybytes()
+
+class ParquetRenderer(BaseRenderer):
+    """ renders an object (list of objects) to a Parquet file """
+    media_type = 'application/octet-stream'
+    charset = None
+    format = 'parquet'
+
+    def render(self, data, media_type=None, renderer_context=None):
+        table = make_arrow_table(data, _arrow_columns(renderer_context))
+        sink = pa.BufferOutputStream()
+        pq.write_table(table, sink)
+        return sink.getvalue().to_pybytes()
+
 class JpegRenderer(BaseRenderer):
     media_type = 'image/jpeg'
     charset = None
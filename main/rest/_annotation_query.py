@@ -1,6 +1,9 @@
 from collections import defaultdict
 import logging
 
+from django.db.models import Count
+
+from ..models import State
 from ..search import TatorSearch
 
 from ._media_query import query_string_to_media_ids
@@ -8,7 +11,7 @@ from ._attribute_query import get_attribute_query
 
 logger = logging.getLogger(__name__)
 
-def get_annotation_queryset(project, query_params, annotation_type):
+def get_annotation_queryset(project, query_params, annotation_type, dry_run=False):
     """Converts annotation query string into a list of IDs and a count.
        annotation_type: Should be one of `localization` or `state`.
     """
@@ -75,7 +78,48 @@ def get_annotation_queryset(project, query_params, annotation_type):
     query = get_attribute_query(query_params, query, media_bools, project, False,
                                 annotation_bools, modified)
 
+    if dry_run:
+        return [], [], query
+
     annotation_ids, annotation_count = TatorSearch().search(project, query)
 
     return annotation_ids, annotation_count, query
 
+def get_annotation_id_batches(project, query_params, annotation_type):
+    """Returns a generator of lists of IDs of annotations matching a query.
+       Pages are fetched from elasticsearch as the generator is consumed.
+    """
+    _, _, query = get_annotation_queryset(project, query_params, annotation_type, dry_run=True)
+    return TatorSearch().search_ids(project, query)
+
+def get_annotation_count(project, query_params, annotation_type):
+    """Returns the number of annotations matching a query without fetching
+       their IDs.
+    """
+    _, _, query = get_annotation_queryset(project, query_params, annotation_type, dry_run=True)
+    distinct = False
+    if annotation_type == 'state':
+        media_ids = None
+        if query_params.get('media_query', None) is None:
+            media_ids = query_params.get('media_id', None)
+        distinct = _states_have_duplicates(project, media_ids)
+    return TatorSearch().count(project, query, distinct=distinct)
+
+def _states_have_duplicates(project, media_ids=None):
+    """Returns true if any state in the project (or associated with the given
+       media) has more than one document in elasticsearch, i.e. it is
+       associated with multiple media or has an extracted image. Only then do
+       state counts need to collapse documents by id.
+    """
+    states = State.objects.filter(project=project)
+    if media_ids is not None:
+        states = states.filter(media__in=media_ids)
+    if states.filter(extracted__isnull=False).exists():
+        return True
+    return State.media.through.objects\
+        .filter(state__in=states.values('pk'))\
+        .values('state')\
+        .annotate(num_media=Count('media'))\
+        .filter(num_media__gt=1)\
+        .exists()
+
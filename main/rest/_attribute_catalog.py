@@ -0,0 +1,70 @@
+import logging
+import threading
+
+from ..models import MediaType
+from ..models import LocalizationType
+from ..models import StateType
+from ..models import LeafType
+from ..cache import TatorCache
+
+logger = logging.getLogger(__name__)
+
+ENTITY_TYPE_MODELS = [MediaType, LocalizationType, StateType, LeafType]
+ANNOTATION_TYPE_MODELS = [LocalizationType, StateType]
+
+class AttributeCatalog:
+    """ Entity types of a project and the attribute types they define, keyed
+        by attribute name.
+    """
+    def __init__(self, project, version):
+        self.version = version
+        self.entity_types = {model: {} for model in ENTITY_TYPE_MODELS}
+        self.attributes = {}
+        for model in ENTITY_TYPE_MODELS:
+            for entity_type in model.objects.filter(project=project):
+                self.entity_types[model][entity_type.pk] = entity_type
+                for attr_type in entity_type.attribute_types or []:
+                    entry = self.attributes.setdefault(attr_type['name'], {
+                        'dtypes': set(),
+                        'entity_types': [],
+                        'relation': 'media',
+                    })
+                    entry['dtypes'].add(attr_type['dtype'])
+                    entry['entity_types'].append(entity_type)
+                    if model in ANNOTATION_TYPE_MODELS:
+                        entry['relation'] = 'annotation'
+
+    def relation(self, name):
+        """ Returns 'annotation' if a state or localization type defines the
+            attribute, otherwise 'media'.
+        """
+        entry = self.attributes.get(name)
+        return 'media' if entry is None else entry['relation']
+
+    def get_entity_type(self, model, pk):
+        """ Returns an entity type of the project or None.
+        """
+        return self.entity_types[model].get(int(pk))
+
+    def get_attribute_types(self, model):
+        """ Returns attribute types of every entity type of a model.
+        """
+        return [attr_type for entity_type in self.entity_types[model].values()
+                for attr_type in entity_type.attribute_types or []]
+
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+def get_attribute_catalog(project):
+    """ Returns the attribute catalog of a project. Catalogs are kept in process
+        memory and rebuilt when the version stored in redis changes, which
+        happens whenever an entity type of the project is saved or deleted.
+    """
+    project = int(project)
+    version = TatorCache().get_attribute_catalog_version(project)
+    catalog = _catalogs.get(project)
+    if catalog is None or catalog.version != version:
+        catalog = AttributeCatalog(project, version)
+        with _catalogs_lock:
+            _catalogs[project] = catalog
+    return catalog
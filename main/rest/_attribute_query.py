@@ -2,10 +2,8 @@ from collections import defaultdict
 import copy
 import logging
 
-from ..models import LocalizationType
-from ..models import StateType
-
 from ._attributes import kv_separator
+from ._attribute_catalog import get_attribute_catalog
 
 logger = logging.getLogger(__name__)
 
@@ -22,12 +20,7 @@ def get_attribute_query(query_params, query, bools, project, is_media=True, anno
         'attribute_distance': query_params.get('attribute_distance', None),
         'attribute_null': query_params.get('attribute_null', None),
     }
-    child_attrs = []
-    for state_type in StateType.objects.filter(project=project).iterator():
-        child_attrs += state_type.attribute_types
-    for localization_type in LocalizationType.objects.filter(project=project).iterator():
-        child_attrs += localization_type.attribute_types
-    child_attrs = [attr['name'] for attr in child_attrs]
+    catalog = get_attribute_catalog(project)
     attr_query = {
         'media': {
             'must_not': [],
@@ -43,7 +36,7 @@ def get_attribute_query(query_params, query, bools, project, is_media=True, anno
             for kv_pair in attr_filter_params[op].split(','):
                 if op == 'attribute_distance':
                     key, dist_km, lat, lon = kv_pair.split(kv_separator)
-                    relation = 'annotation' if key in child_attrs else 'media'
+                    relation = catalog.relation(key)
                     attr_query[relation]['filter'].append({
                         'geo_distance': {
                             'distance': f'{dist_km}km',
@@ -52,7 +45,7 @@ def get_attribute_query(query_params, query, bools, project, is_media=True, anno
                     })
                 else:
                     key, val = kv_pair.split(kv_separator)
-                    relation = 'annotation' if key in child_attrs else 'media'
+                    relation = catalog.relation(key)
                     if op == 'attribute_eq':
                         attr_query[relation]['filter'].append({'match': {key: val}})
                     elif op == 'attribute_lt':
@@ -0,0 +1,175 @@
+import hashlib
+import logging
+import os
+import re
+import time
+
+from django.db import connection
+
+from ..models import Localization
+from ..models import State
+from ..models import Leaf
+from ..models import LocalizationType
+from ..models import StateType
+from ..models import LeafType
+
+logger = logging.getLogger(__name__)
+
+ROUTABLE_PARAMS = {
+    'attribute': 'attribute_eq',
+    'attribute_lt': 'attribute_lt',
+    'attribute_lte': 'attribute_lte',
+    'attribute_gt': 'attribute_gt',
+    'attribute_gte': 'attribute_gte',
+    'attribute_null': 'attribute_null',
+}
+""" Query parameters that can be compiled to JSONB predicates, and the filter
+    operation each corresponds to.
+"""
+
+ROUTABLE_SUFFIXES = {
+    'attribute_eq': '',
+    'attribute_lt': '__lt',
+    'attribute_lte': '__lte',
+    'attribute_gt': '__gt',
+    'attribute_gte': '__gte',
+}
+
+ROUTABLE_DTYPES = ('bool', 'int', 'float')
+""" Dtypes whose JSONB comparisons match elasticsearch semantics. String and
+    enum equality is a full text match in elasticsearch, and datetimes are
+    stored as strings, so those stay in elasticsearch.
+"""
+
+INDEXED_MODELS = {
+    Localization: LocalizationType,
+    State: StateType,
+    Leaf: LeafType,
+}
+
+ROUTER_SCAN_LIMIT = int(os.getenv('TATOR_ROUTER_SCAN_LIMIT', 100000))
+""" Tables with fewer estimated rows than this are filtered in postgres even if
+    the filtered attributes are not indexed.
+"""
+
+ROUTER_CATALOG_TTL = 60
+""" Seconds that index names and row estimates are cached in each process. """
+
+_name_regex = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+_table_stats = {}
+
+def attribute_index_name(table, name):
+    """ Returns the name of the expression index on an attribute.
+    """
+    digest = hashlib.md5(name.encode()).hexdigest()[:16]
+    return f'{table}_attr_{digest}'
+
+def _query_attribute_indexes(table):
+    """ Returns names of attribute indexes on a table and whether each is valid.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT c.relname, i.indisvalid FROM pg_index i '
+            'JOIN pg_class c ON c.oid = i.indexrelid '
+            'JOIN pg_class t ON t.oid = i.indrelid '
+            'WHERE t.relname = %s AND c.relname LIKE %s',
+            [table, f'{table}\\_attr\\_%'],
+        )
+        return dict(cursor.fetchall())
+
+def _get_table_stats(table):
+    """ Returns valid attribute index names and estimated row count of a table.
+    """
+    now = time.time()
+    stats = _table_stats.get(table)
+    if stats is None or now - stats[0] > ROUTER_CATALOG_TTL:
+        indexes = _query_attribute_indexes(table)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [table])
+            row = cursor.fetchone()
+        rows = 0 if row is None else row[0]
+        stats = (now, set(name for name, valid in indexes.items() if valid), rows)
+        _table_stats[table] = stats
+    return stats[1], stats[2]
+
+def _is_safe_name(model, name):
+    """ Attribute names are used as key transforms in ORM lookups, so they must
+        not contain separators or collide with lookup names.
+    """
+    if not _name_regex.match(name) or '__' in name:
+        return False
+    return model._meta.get_field('attributes').get_lookup(name) is None
+
+def get_attribute_filter(view, model, params, postgres_params):
+    """ Returns keyword arguments that filter a queryset of `model` by the
+        attribute filters of a request, or None if the request should be served
+        by elasticsearch. Should be called after `validate_attribute_filter`.
+
+        Filters are compiled when the entity type is given, every other
+        parameter is supported by the postgres path, every filter is
+        comparable in JSONB, and either the filtered attributes are indexed or
+        the table is small.
+    """
+    if not any([key in ROUTABLE_PARAMS for key in params]):
+        return None
+    if any([key not in postgres_params and key not in ROUTABLE_PARAMS for key in params]):
+        return None
+    if view.meta is None:
+        return None
+    kwargs = {}
+    indexed = True
+    indexes, rows = _get_table_stats(model._meta.db_table)
+    for attr_type, value, op in view.filter_type_and_vals:
+        if op == 'attribute_null':
+            name = attr_type
+            if not _is_safe_name(model, name):
+                return None
+            # Existence checks are not covered by expression indexes.
+            indexed = False
+            kwargs[f'attributes__{name}__isnull'] = bool(value)
+        elif op in ROUTABLE_SUFFIXES:
+            name = attr_type['name']
+            if attr_type['dtype'] not in ROUTABLE_DTYPES:
+                return None
+            if not _is_safe_name(model, name):
+                return None
+            if attribute_index_name(model._meta.db_table, name) not in indexes:
+                indexed = False
+            key = f'attributes__{name}{ROUTABLE_SUFFIXES[op]}'
+            if key in kwargs:
+                # Repeated filters on the same key are left to elasticsearch.
+                return None
+            kwargs[key] = value
+        else:
+            return None
+    if not indexed and rows > ROUTER_SCAN_LIMIT:
+        return None
+    return kwargs
+
+def sync_attribute_indexes():
+    """ Creates an index on (meta, attributes -> name) for every bool, int and
+        float attribute of localization, state and leaf types, and drops
+        indexes for attributes that no longer exist or failed to build.
+        Indexes are built concurrently, so this must not run in a transaction.
+    """
+    for model, type_model in INDEXED_MODELS.items():
+        table = model._meta.db_table
+        names = set()
+        for entity_type in type_model.objects.all():
+            for attr_type in entity_type.attribute_types or []:
+                if (attr_type['dtype'] in ROUTABLE_DTYPES
+                    and _is_safe_name(model, attr_type['name'])):
+                    names.add(attr_type['name'])
+        wanted = {attribute_index_name(table, name): name for name in names}
+        existing = _query_attribute_indexes(table)
+        with connection.cursor() as cursor:
+            for index, valid in existing.items():
+                if index not in wanted or not valid:
+                    logger.info(f"Dropping attribute index {index}...")
+                    cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{index}"')
+            for index, name in wanted.items():
+                if not existing.get(index, False):
+                    logger.info(f"Creating attribute index {index} on {table}.{name}...")
+                    cursor.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{index}" '
+                                   f'ON "{table}" ("meta", ("attributes" -> %s))', [name])
+    _table_stats.clear()
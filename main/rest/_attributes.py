@@ -1,3 +1,4 @@
+import json
 import logging
 
 from django.db.models.expressions import Func
@@ -6,27 +7,27 @@ from django.contrib.gis.geos import Point
 from django.shortcuts import get_object_or_404
 from dateutil.parser import parse as dateutil_parse
 
+from ._attribute_catalog import get_attribute_catalog
+
 logger = logging.getLogger(__name__)
 
 # Separator for key value pairs in attribute queries
 kv_separator = '::'
 
-class ReplaceValue(Func):
-    function = 'jsonb_set'
-    template = "%(function)s(%(expressions)s, '{\"%(keyname)s\"}','%(new_value)s', %(create_missing)s)"
+class MergeValues(Func):
+    """ Merges keys into a JSONB field. New values are passed as a single bound
+        parameter, so all keys are written in one update.
+    """
+    template = "COALESCE(%(expressions)s, '{}'::jsonb) || %%s::jsonb"
     arity = 1
 
-    def __init__(
-        self, expression: str, keyname: str, new_value: str,
-        create_missing: bool=False, **extra,
-    ):
-        super().__init__(
-            expression,
-            keyname=keyname,
-            new_value=new_value,
-            create_missing='true' if create_missing else 'false',
-            **extra,
-        )
+    def __init__(self, expression, new_values, **extra):
+        super().__init__(expression, **extra)
+        self.new_values = new_values
+
+    def as_sql(self, compiler, connection, **extra_context):
+        sql, params = super().as_sql(compiler, connection, **extra_context)
+        return sql, [*params, json.dumps(self.new_values)]
 
 def convert_attribute(attr_type, attr_val):
     """Attempts to convert an attribute to its expected datatype. Raises an
@@ -198,19 +199,8 @@ def patch_attributes(new_attrs, obj):
 def bulk_patch_attributes(new_attrs, qs):
     """Updates attribute values.
     """
-    for key in new_attrs:
-        if isinstance(new_attrs[key], str):
-            val = f"\"{new_attrs[key]}\""
-        elif isinstance(new_attrs[key], bool):
-            val = f"{str(new_attrs[key]).lower()}"
-        else:
-            val = new_attrs[key]
-        qs.update(attributes=ReplaceValue(
-            'attributes',
-            keyname=key,
-            new_value=val,
-            create_missing=True,
-        ))
+    if new_attrs:
+        qs.update(attributes=MergeValues('attributes', new_attrs))
 
 class AttributeFilterMixin:
     """Provides functions for filtering lists by attribute.
@@ -266,7 +256,12 @@ class AttributeFilterMixin:
             if requiresType:
                 raise Exception("Parameter 'type' is required for numerical attribute filtering!")
         else:
-            self.meta = get_object_or_404(self.entity_type, pk=meta_id)
+            project = query_params.get('project', None)
+            if project is not None:
+                self.meta = get_attribute_catalog(project).get_entity_type(self.entity_type,
+                                                                           meta_id)
+            if self.meta is None:
+                self.meta = get_object_or_404(self.entity_type, pk=meta_id)
         # Iterate through filter params and extract pairs of attribute type
         # and filter value.
         self.filter_type_and_vals = []
@@ -281,3 +276,13 @@ class AttributeFilterMixin:
         # Check for operations on the data.
         self.operation = query_params.get('operation', None)
 
+    def get_attribute_types(self, query_params):
+        """Returns the attribute types of the queried entity type, or of every
+           entity type in the project if no type was given. Should be called
+           after `validate_attribute_filter`.
+        """
+        if self.meta is not None:
+            return self.meta.attribute_types
+        return get_attribute_catalog(query_params['project'])\
+               .get_attribute_types(self.entity_type)
+
@@ -7,6 +7,7 @@ from rest_framework.exceptions import PermissionDenied
 from rest_framework import status
 from django.core.exceptions import ObjectDoesNotExist
 from django.http import response
+from django.http import StreamingHttpResponse
 
 from ..schema import parse
 
@@ -37,8 +38,13 @@ class GetMixin:
         response = Response({})
         params = parse(request)
         response_data = self._get(params)
-        response = Response(response_data, status=status.HTTP_200_OK)
-        return response
+        if not isinstance(response_data, StreamingHttpResponse):
+            response_data = Response(response_data, status=status.HTTP_200_OK)
+        # Report whether postgres or elasticsearch served a list.
+        engine = getattr(self, 'engine', None)
+        if engine is not None:
+            response_data['X-Tator-Engine'] = engine
+        return response_data
 
 class PostMixin:
     def post(self, request, format=None, **kwargs):
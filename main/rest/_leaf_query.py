@@ -7,7 +7,7 @@ from ._attributes import kv_separator
 
 logger = logging.getLogger(__name__)
 
-def get_leaf_queryset(query_params):
+def get_leaf_queryset(query_params, dry_run=False):
 
     # Get parameters.
     project = query_params['project']
@@ -104,5 +104,14 @@ def get_leaf_queryset(query_params):
         search_query = {'query_string': {'query': search}}
         query['query']['bool']['filter'].append(search_query)
 
+    if dry_run:
+        return [], [], query
+
     leaf_ids, leaf_count = TatorSearch().search(project, query)
     return leaf_ids, leaf_count, query
+
+def get_leaf_count(query_params):
+    """Returns the number of leaves matching a query without fetching their IDs.
+    """
+    _, _, query = get_leaf_queryset(query_params, dry_run=True)
+    return TatorSearch().count(query_params['project'], query)
@@ -70,6 +70,12 @@ def get_media_queryset(project, query_params, dry_run=False):
 
     return media_ids, media_count, query
 
+def get_media_count(project, query_params):
+    """Returns the number of media matching a query without fetching their IDs.
+    """
+    _, _, query = get_media_queryset(project, query_params, dry_run=True)
+    return TatorSearch().count(project, query)
+
 def query_string_to_media_ids(project_id, url):
     query_params = dict(urllib_parse.parse_qsl(urllib_parse.urlsplit(url).query))
     attribute_filter = AttributeFilterMixin()
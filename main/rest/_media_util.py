@@ -1,18 +1,110 @@
 import logging
 import os
+import errno
 import json
 import subprocess
 import math
 import io
 from PIL import Image, ImageDraw, ImageFont
 import textwrap
-import mmap
 import sys
+import threading
+from collections import OrderedDict
+from collections import namedtuple
 
+import numpy as np
 from django.conf import settings
 
 logger = logging.getLogger(__name__)
 
+SEGMENT_CACHE_BYTES = int(os.getenv('TATOR_SEGMENT_CACHE_BYTES', 64 * 1024 * 1024))
+""" Maximum size of parsed segment indexes kept in memory by each process. """
+
+SegmentIndex = namedtuple('SegmentIndex', ['offset', 'size', 'frame_start', 'frame_samples',
+                                           'moof_idx'])
+""" Parsed segment_info file. `offset`, `size`, `frame_start` and `frame_samples`
+    have one element per segment, with frame fields set to -1 for segments
+    that are not moofs. `moof_idx` holds the indices of moof segments.
+"""
+
+def _index_nbytes(index):
+    return sum([arr.nbytes for arr in index])
+
+def _parse_segment_info(path):
+    with open(path, 'r') as fp:
+        segments = json.load(fp)['segments']
+    offset = np.array([x['offset'] for x in segments], dtype=np.int64)
+    size = np.array([x['size'] for x in segments], dtype=np.int64)
+    frame_start = np.array([x.get('frame_start', -1) for x in segments], dtype=np.int64)
+    frame_samples = np.array([x.get('frame_samples', -1) for x in segments], dtype=np.int64)
+    moof_idx = np.array([i for i,x in enumerate(segments) if x['name'] == 'moof'],
+                        dtype=np.int64)
+    return SegmentIndex(offset, size, frame_start, frame_samples, moof_idx)
+
+def load_segment_index(path):
+    """ Returns the parsed segment index of a segment_info file. Indexes are
+        cached per process by path and modification time, and least recently
+        used indexes are dropped once `SEGMENT_CACHE_BYTES` is exceeded.
+    """
+    key = (path, os.stat(path).st_mtime_ns)
+    with load_segment_index.lock:
+        index = load_segment_index.cache.get(key)
+        if index is not None:
+            load_segment_index.cache.move_to_end(key)
+            return index
+    index = _parse_segment_info(path)
+    with load_segment_index.lock:
+        cache = load_segment_index.cache
+        # Drop indexes of older versions of this file.
+        for stale in [k for k in cache if k[0] == path]:
+            load_segment_index.nbytes -= _index_nbytes(cache.pop(stale))
+        cache[key] = index
+        load_segment_index.nbytes += _index_nbytes(index)
+        while load_segment_index.nbytes > SEGMENT_CACHE_BYTES and len(cache) > 1:
+            _, dropped = cache.popitem(last=False)
+            load_segment_index.nbytes -= _index_nbytes(dropped)
+    return index
+
+load_segment_index.cache = OrderedDict()
+load_segment_index.nbytes = 0
+load_segment_index.lock = threading.Lock()
+
+_COPY_FALLBACK_ERRNOS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                         errno.ENOTSUP}
+""" Errors raised when a copy method is not supported for a pair of files,
+    such as copy_file_range across filesystems on some kernels.
+"""
+
+def _copyFileRange(in_fd, out_fd, offset, count):
+    return os.copy_file_range(in_fd, out_fd, count, offset)
+
+def _sendfile(in_fd, out_fd, offset, count):
+    return os.sendfile(out_fd, in_fd, offset, count)
+
+def _readWrite(in_fd, out_fd, offset, count):
+    return os.write(out_fd, os.pread(in_fd, min(count, 1024 * 1024), offset))
+
+def _copyRange(in_fd, out_fd, offset, count):
+    """ Copies a byte range of one file to the end of another. The copy is done
+        in the kernel with copy_file_range or sendfile if possible, falling back
+        to reading and writing for whatever remains. """
+    methods = [_sendfile, _readWrite]
+    if hasattr(os, 'copy_file_range'):
+        methods.insert(0, _copyFileRange)
+    for method in methods:
+        try:
+            while count > 0:
+                copied = method(in_fd, out_fd, offset, count)
+                if copied == 0:
+                    raise Exception(f"Unexpected end of file copying {count} bytes at {offset}")
+                offset += copied
+                count -= copied
+            return
+        except OSError as e:
+            if e.errno not in _COPY_FALLBACK_ERRNOS or method is _readWrite:
+                raise
+            logger.debug(f"Could not copy with {method.__name__}, falling back: {e}")
+
 class MediaUtil:
     def __init__(self, video, temp_dir, quality=None):
         self._temp_dir = temp_dir
@@ -44,9 +136,9 @@ class MediaUtil:
             segment_file = video.media_files["streaming"][quality_idx]["segment_info"]
             segment_file = os.path.relpath(segment_file, settings.MEDIA_URL)
             segment_file = os.path.join(settings.MEDIA_ROOT, segment_file)
-            with open(segment_file, 'r') as fp:
-                self._segment_info = json.load(fp)
-                self._moof_data = [(i,x) for i,x in enumerate(self._segment_info['segments']) if x['name'] == 'moof']
+            self._segment_info = load_segment_index(segment_file)
+            self._moof_start = self._segment_info.frame_start[self._segment_info.moof_idx]
+            self._moof_samples = self._segment_info.frame_samples[self._segment_info.moof_idx]
 
 
         self._video_file = os.path.relpath(self._video_file, settings.MEDIA_URL)
@@ -58,42 +150,29 @@ class MediaUtil:
         if self._segment_info is None:
             return None
 
+        moof_idx = self._segment_info.moof_idx
+        frames = np.array([int(frame) for frame in frames], dtype=np.int64)
+        # Index of the last moof starting at or before each frame.
+        guess = np.searchsorted(self._moof_start, frames, side='right') - 1
+        last_frame = self._moof_start[-1] + self._moof_samples[-1]
 
         segment_list=[]
-        for frame_str in frames:
-            frame_seg=set()
-            frame_seg.add(0)
-            frame_seg.add(1)
+        for frame, guess_idx in zip(frames.tolist(), guess.tolist()):
             # We already load the header so ignore those segments
-            frame = int(frame_str)
-            min_idx = 0
-            max_idx = len(self._moof_data)-1
+            frame_seg={0, 1}
             # Handle frames and files with frame biases
-            if frame < self._moof_data[0][1]['frame_start']:
-                frame_seg.add(self._moof_data[0][0])
-                continue
-
-            last_segment = self._moof_data[max_idx][1] #Frame start/stop is in the moof
-            if frame >= last_segment['frame_start'] + last_segment['frame_samples']:
+            if guess_idx < 0 or frame >= last_frame:
                 continue
 
-            # Do a binary search for the segment in question
-            while min_idx <= max_idx:
-                guess_idx = math.floor((max_idx + min_idx) / 2)
-                moof = self._moof_data[guess_idx][1]
-                if frame < moof['frame_start']:
-                    max_idx = max_idx - 1
-                elif frame >= moof['frame_start'] + moof['frame_samples']:
-                    min_idx = min_idx + 1
-                else:
-                    frame_seg.add(self._moof_data[guess_idx][0])
-                    frame_seg.add(self._moof_data[guess_idx][0]+1)
-                    if frame - moof['frame_start'] > moof['frame_samples'] - 5:
-                        # Handle boundary conditions
-                        if guess_idx + 1 in self._moof_data:
-                            frame_seg.add(self._moof_data[guess_idx+1][0])
-                            frame_seg.add(self._moof_data[guess_idx+1][0]+1)
-                    break
+            frame_offset = frame - self._moof_start[guess_idx]
+            if frame_offset < self._moof_samples[guess_idx]:
+                frame_seg.add(int(moof_idx[guess_idx]))
+                frame_seg.add(int(moof_idx[guess_idx])+1)
+                if frame_offset > self._moof_samples[guess_idx] - 5:
+                    # Handle boundary conditions
+                    if guess_idx + 1 < len(moof_idx):
+                        frame_seg.add(int(moof_idx[guess_idx+1]))
+                        frame_seg.add(int(moof_idx[guess_idx+1])+1)
 
             frame_seg = list(frame_seg)
             frame_seg.sort()
@@ -125,38 +204,42 @@ class MediaUtil:
 
     def makeTemporaryVideos(self, segmentList):
         """ Return a temporary mp4 for each impacted segment to limit IO to
-            cloud storage """
+            cloud storage. Entries with the same segments share one file. """
         lookup = {}
-        for frame,segments in segmentList:
-            temp_video = os.path.join(self._temp_dir, f"{frame}.mp4")
-            preferred_block_size = 16*1024
-            sc_graph = [(0,0)]
-            segment_frame_start = sys.maxsize
-            # create a scatter/gather
-            for segment_idx in segments:
-                segment = self._segment_info['segments'][segment_idx]
-                last_io = sc_graph[len(sc_graph)-1]
-                if segment.get('frame_start',sys.maxsize) < segment_frame_start:
-                    segment_frame_start = segment['frame_start']
-                if last_io[0] + last_io[1] == segment['offset']:
-                    # merge contigous blocks
-                    sc_graph[len(sc_graph)-1] = (last_io[0], last_io[1] + segment['size'])
-                else:
-                    # A new block
-                    sc_graph.append((segment['offset'], segment['size']))
-
-            lookup[frame] = (segment_frame_start, temp_video)
-
-            logger.info(f"Scatter gather graph = {sc_graph}")
-            with open(self._video_file, "r+b") as vid_fp:
-                mm = mmap.mmap(vid_fp.fileno(),0)
+        made = {}
+        with open(self._video_file, "rb") as vid_fp:
+            for frame,segments in segmentList:
+                if tuple(segments) in made:
+                    lookup[frame] = made[tuple(segments)]
+                    continue
+                temp_video = os.path.join(self._temp_dir, f"{frame}.mp4")
+                sc_graph = [(0,0)]
+                segment_frame_start = sys.maxsize
+                # create a scatter/gather
+                for segment_idx in segments:
+                    offset = int(self._segment_info.offset[segment_idx])
+                    size = int(self._segment_info.size[segment_idx])
+                    frame_start = int(self._segment_info.frame_start[segment_idx])
+                    last_io = sc_graph[len(sc_graph)-1]
+                    if 0 <= frame_start < segment_frame_start:
+                        segment_frame_start = frame_start
+                    if last_io[0] + last_io[1] == offset:
+                        # merge contigous blocks
+                        sc_graph[len(sc_graph)-1] = (last_io[0], last_io[1] + size)
+                    else:
+                        # A new block
+                        sc_graph.append((offset, size))
+
+                lookup[frame] = (segment_frame_start, temp_video)
+                made[tuple(segments)] = lookup[frame]
+
+                logger.info(f"Scatter gather graph = {sc_graph}")
                 with open(temp_video, "wb") as out_fp:
                     for scatter in sc_graph:
-                        out_fp.write(mm[scatter[0]:scatter[0]+scatter[1]])
+                        _copyRange(vid_fp.fileno(), out_fp.fileno(), scatter[0], scatter[1])
 
         return lookup
 
-
     def _frameToTimeStr(self, frame, relativeTo=None):
         if relativeTo:
             frame -= relativeTo
@@ -166,49 +249,99 @@ class MediaUtil:
         seconds = total_seconds % 60
         return f"{hours}:{minutes}:{seconds}"
 
-    def _generateFrameImages(self, frames, rois=None, render_format="jpg", force_scale=None):
-        """ Generate a jpg for each requested frame and store in the working directory """
-        frames=[int(frame) for frame in frames]
-        crop_filter = None
+    def _frameFilters(self, frames, rois=None, force_scale=None):
+        """ Returns a list of ffmpeg filters to apply to each frame. Both `rois` and
+            `force_scale` may be given per frame; a single scale (width, height) is
+            applied to every frame.
+        """
+        if force_scale and not isinstance(force_scale[0], (list, tuple)):
+            force_scale = [force_scale] * len(frames)
+        frame_filters = [[] for _ in frames]
         if rois:
-            crop_filter=[]
-            for c in rois:
+            for frame_idx, c in enumerate(rois):
                 w = max(0,min(round(c[0]*self._width),self._width))
                 h = max(0,min(round(c[1]*self._height),self._height))
                 x = max(0,min(round(c[2]*self._width),self._width))
                 y = max(0,min(round(c[3]*self._height),self._height))
-                if force_scale:
-                    scale_w=force_scale[0]
-                    scale_h=force_scale[1]
-                    crop_filter.append(f"crop={w}:{h}:{x}:{y},scale={scale_w}:{scale_h}")
-                else:
-                    crop_filter.append(f"crop={w}:{h}:{x}:{y}")
+                frame_filters[frame_idx].append(f"crop={w}:{h}:{x}:{y}")
+        if force_scale:
+            for frame_idx, scale in enumerate(force_scale):
+                frame_filters[frame_idx].append(f"scale={scale[0]}:{scale[1]}")
+        return frame_filters
+
+    def _groupFramesBySegment(self, frames):
+        """ Groups frames that can be extracted in one decoder pass. Frames in the
+            same segment share a temporary video, which is decoded once. Frames that
+            are not covered by the segment index are seeked to individually.
+
+            Returns a list of (input file, seek time, [(frame index, frame offset)])
+            where frame offset is the number of decoded frames to skip.
+        """
+        segments_by_frame = {}
+        impactedSegments = self._getImpactedSegments(frames)
+        if impactedSegments:
+            for frame, frame_seg in impactedSegments:
+                # First two segments are the header, the third is the frame's moof.
+                if len(frame_seg) > 2:
+                    segments_by_frame[frame] = frame_seg
+
+        # Merge segments of frames sharing a moof into one temporary video.
+        segment_groups = {}
+        for frame_seg in segments_by_frame.values():
+            segment_groups.setdefault(frame_seg[2], set()).update(frame_seg)
+        lookup = {}
+        if segment_groups:
+            lookup = self.makeTemporaryVideos([(f"segment_{moof_idx}", sorted(segments))
+                                               for moof_idx, segments in segment_groups.items()])
+
+        inputs = []
+        input_lookup = {}
+        for frame_idx, frame in enumerate(frames):
+            if frame in segments_by_frame:
+                key = f"segment_{segments_by_frame[frame][2]}"
+                segment_frame_start, temp_video = lookup[key]
+                if key not in input_lookup:
+                    input_lookup[key] = len(inputs)
+                    inputs.append((temp_video, None, []))
+                inputs[input_lookup[key]][2].append((frame_idx, frame - segment_frame_start))
+            else:
+                # If we didn't make per segment mp4s, use the big one
+                inputs.append((self._video_file, self._frameToTimeStr(frame), [(frame_idx, 0)]))
+        return inputs
+
+    def _generateFrameImages(self, frames, rois=None, render_format="jpg", force_scale=None):
+        """ Generate an image for each requested frame and store in the working directory.
+
+            Frames are grouped by segment so each group of pictures is decoded once,
+            with every requested frame in it selected from that single pass.
+        """
+        frames=[int(frame) for frame in frames]
+        frame_filters = self._frameFilters(frames, rois, force_scale)
 
         logger.info(f"Processing {self._video_file}")
         args = ["ffmpeg"]
-        inputs = []
+        filters = []
         outputs = []
 
         # attempt to make a temporary file in a fast manner to speed up AWS access
-        impactedSegments = self._getImpactedSegments(frames)
-        lookup = {}
-        if impactedSegments:
-            lookup = self.makeTemporaryVideos(impactedSegments)
-
-        for frame_idx,frame in enumerate(frames):
-            outputs.extend(["-map", f"{frame_idx}:v","-frames:v", "1", "-q:v", "3"])
-            if crop_filter:
-                outputs.extend(["-vf", crop_filter[frame_idx]])
-
-            outputs.append(os.path.join(self._temp_dir,f"{frame_idx}.{render_format}"))
-            if frame in lookup:
-                inputs.extend(["-ss", self._frameToTimeStr(frame, lookup[frame][0]), "-i", lookup[frame][1]])
-            else:
-                # If we didn't make per segment mp4s, use the big one
-                inputs.extend(["-ss", self._frameToTimeStr(frame), "-i", self._video_file])
+        inputs = self._groupFramesBySegment(frames)
+        for input_idx, (input_file, seek, selected) in enumerate(inputs):
+            if seek:
+                args.extend(["-ss", seek])
+            args.extend(["-i", input_file])
+
+            # Decode the input once and split it to one branch per requested frame.
+            labels = [f"[in{input_idx}_{idx}]" for idx in range(len(selected))]
+            filters.append(f"[{input_idx}:v]split={len(selected)}{''.join(labels)}")
+            for label, (frame_idx, offset) in zip(labels, selected):
+                chain = [f"select=eq(n\\,{offset})", *frame_filters[frame_idx]]
+                filters.append(f"{label}{','.join(chain)}[out{frame_idx}]")
+                outputs.extend(["-map", f"[out{frame_idx}]", "-frames:v", "1", "-vsync", "0",
+                                "-q:v", "3",
+                                os.path.join(self._temp_dir,f"{frame_idx}.{render_format}")])
 
         # Now add all the cmds in
-        args.extend(inputs)
+        args.extend(["-filter_complex", ";".join(filters)])
         args.extend(outputs)
         logger.info(args)
         proc = subprocess.run(args, check=True, capture_output=True)
@@ -289,7 +422,7 @@ class MediaUtil:
 
         return output_file
 
-    def getAnimation(self,frames, roi, fps, render_format, force_scale):
+    def getAnimation(self,frames, roi, fps, render_format, force_scale=None):
         if self._generateFrameImages(frames, roi, render_format="jpg", force_scale=force_scale) == False:
             return None
 
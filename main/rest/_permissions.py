@@ -14,6 +14,7 @@ from ..models import Permission
 from ..models import Project
 from ..models import Membership
 from ..models import Algorithm
+from ..models import get_user_permission
 from ..kube import TatorTranscode
 from ..kube import TatorAlgorithm
 
@@ -37,8 +38,12 @@ class ProjectPermissionBase(BasePermission):
     def has_permission(self, request, view):
         # Get the project from the URL parameters
         if 'project' in view.kwargs:
-            project_id = view.kwargs['project']
-            project = get_object_or_404(Project, pk=int(project_id))
+            project = int(view.kwargs['project'])
+            granted = self._validate_project(request, project)
+            if not granted:
+                # Return 404 rather than 403 for projects that do not exist.
+                get_object_or_404(Project, pk=project)
+            return granted
         elif 'id' in view.kwargs:
             pk = view.kwargs['id']
             obj = get_object_or_404(view.get_queryset(), pk=pk)
@@ -83,18 +88,16 @@ class ProjectPermissionBase(BasePermission):
         if isinstance(request.user, AnonymousUser):
             granted = False
         else:
-            # Find membership for this user and project
-            membership = Membership.objects.filter(
-                user=request.user,
-                project=project
-            )
+            # Find permission for this user and project
+            if isinstance(project, Project):
+                project = project.pk
+            permission = get_user_permission(request.user.pk, project)
 
             # If user is not part of project, deny access
-            if membership.count() == 0:
+            if permission is None:
                 granted = False
             else:
                 # If user has insufficient permission, deny access
-                permission = membership[0].permission
                 insufficient = permission in self.insufficient_permissions
                 is_edit = request.method not in SAFE_METHODS
                 if is_edit and insufficient:
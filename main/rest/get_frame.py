@@ -6,6 +6,7 @@ from rest_framework import status
 from django.http import response
 
 from ..models import Media
+from ..cache import FrameCache
 from ..renderers import PngRenderer
 from ..renderers import JpegRenderer
 from ..renderers import GifRenderer
@@ -91,22 +92,33 @@ class GetFrameAPI(BaseDetailView):
 
 
 
+        animated = len(frames) > 1 and animate
+        if animated:
+            # Default to gif for animate, but mp4 is also supported
+            if self.request.accepted_renderer.format not in ['mp4', 'gif']:
+                self.request.accepted_renderer = GifRenderer()
+        render_format = self.request.accepted_renderer.format
+
+        # Check to see if we already rendered this.
+        frame_cache = FrameCache()
+        cache_params = {'frames': frames, 'tile': tile, 'animate': animate,
+                        'roi': roi_arg, 'quality': quality}
+        response_data = frame_cache.get(video, cache_params, render_format)
+        if response_data is not None:
+            return response_data
+
         with tempfile.TemporaryDirectory() as temp_dir:
             media_util = MediaUtil(video, temp_dir, quality)
-            if len(frames) > 1 and animate:
-                # Default to gif for animate, but mp4 is also supported
-                if any(x is self.request.accepted_renderer.format for x in ['mp4','gif']):
-                    pass
-                else:
-                    self.request.accepted_renderer = GifRenderer()
+            if animated:
                 gif_fp = media_util.getAnimation(frames, roi_arg, fps=animate,
-                                                 render_format=self.request.accepted_renderer.format)
+                                                 render_format=render_format)
                 with open(gif_fp, 'rb') as data_file:
                     response_data = data_file.read()
             else:
-                logger.info(f"Accepted format = {self.request.accepted_renderer.format}")
+                logger.info(f"Accepted format = {render_format}")
                 tiled_fp = media_util.getTileImage(frames, roi_arg, tile_size,
-                                                   render_format=self.request.accepted_renderer.format)
+                                                   render_format=render_format)
                 with open(tiled_fp, 'rb') as data_file:
                     response_data = data_file.read()
+        frame_cache.set(video, cache_params, render_format, response_data)
         return response_data
@@ -7,6 +7,8 @@ from ..models import Project
 from ..models import database_qs
 from ..models import database_query_ids
 from ..search import TatorSearch
+from ..cache import TatorCache
+from ..indexer import IndexQueue
 from ..schema import LeafSuggestionSchema
 from ..schema import LeafListSchema
 from ..schema import LeafDetailSchema
@@ -15,10 +17,12 @@ from ..schema import parse
 from ._base_views import BaseListView
 from ._base_views import BaseDetailView
 from ._leaf_query import get_leaf_queryset
+from ._leaf_query import get_leaf_count
 from ._attributes import AttributeFilterMixin
 from ._attributes import patch_attributes
 from ._attributes import bulk_patch_attributes
 from ._attributes import validate_attributes
+from ._attribute_router import get_attribute_filter
 from ._util import computeRequiredFields
 from ._util import check_required_fields
 from ._permissions import ProjectViewOnlyPermission
@@ -94,19 +98,31 @@ class LeafListAPI(BaseListView, AttributeFilterMixin):
 
     def _get(self, params):
         self.validate_attribute_filter(params)
+        cache = TatorCache()
+        response_data = cache.get_treeleaf_list_cache(params['project'], params)
+        if response_data is None:
+            response_data = self._get_list(params)
+            cache.set_treeleaf_list_cache(params['project'], params, response_data)
+        return response_data
+
+    def _get_list(self, params):
         postgres_params = ['project', 'type', 'operation']
-        use_es = any([key not in postgres_params for key in params])
+        attribute_filter = get_attribute_filter(self, Leaf, params, postgres_params)
+        use_es = (attribute_filter is None) and any([key not in postgres_params for key in params])
+        self.engine = 'elasticsearch' if use_es else 'postgres'
 
         # Get the leaf list.
-        if use_es:
+        if use_es and self.operation == 'count':
+            response_data = {'count': get_leaf_count(params)}
+        elif use_es:
             response_data = []
             leaf_ids, leaf_count, _ = get_leaf_queryset(params)
-            if self.operation == 'count':
-                response_data = {'count': len(leaf_ids)}
-            elif len(leaf_ids) > 0:
-                response_data = database_query_ids('main_leaf', leaf_ids, 'id')
+            if len(leaf_ids) > 0:
+                response_data = database_query_ids('main_leaf', leaf_ids)
         else:
             qs = Leaf.objects.filter(project=params['project'])
+            if attribute_filter:
+                qs = qs.filter(**attribute_filter)
             if 'type' in params:
                 qs = qs.filter(meta=params['type'])
             if self.operation == 'count':
@@ -154,18 +170,13 @@ class LeafListAPI(BaseListView, AttributeFilterMixin):
                 create_buffer = []
         leaves += Leaf.objects.bulk_create(create_buffer)
 
-        # Build ES documents.
-        ts = TatorSearch()
-        documents = []
-        for leaf in leaves:
-            documents += ts.build_document(leaf)
-            if len(documents) > 1000:
-                ts.bulk_add_documents(documents)
-                documents = []
-        ts.bulk_add_documents(documents)
+        # Queue created leaves for indexing. Index workers clear the list cache
+        # again once the documents are searchable.
+        ids = [leaf.id for leaf in leaves]
+        IndexQueue().enqueue('leaf', ids)
+        TatorCache().invalidate_treeleaf_list_cache(project.pk)
 
         # Return created IDs.
-        ids = [leaf.id for leaf in leaves]
         return {'message': f'Successfully created {len(ids)} leaves!', 'id': ids}
 
     def _delete(self, params):
@@ -175,6 +186,7 @@ class LeafListAPI(BaseListView, AttributeFilterMixin):
             qs = Leaf.objects.filter(pk__in=leaf_ids)
             qs._raw_delete(qs.db)
             TatorSearch().delete(self.kwargs['project'], query)
+            TatorCache().invalidate_treeleaf_list_cache(params['project'])
         return {'message': f'Successfully deleted {len(leaf_ids)} leaves!'}
 
     def _patch(self, params):
@@ -184,7 +196,8 @@ class LeafListAPI(BaseListView, AttributeFilterMixin):
             qs = Leaf.objects.filter(pk__in=leaf_ids)
             new_attrs = validate_attributes(params, qs[0])
             bulk_patch_attributes(new_attrs, qs)
-            TatorSearch().update(self.kwargs['project'], query, new_attrs)
+            IndexQueue().update(self.kwargs['project'], query, new_attrs,
+                                caches={'treeleaf': True})
         return {'message': f'Successfully updated {len(leaf_ids)} leaves!'}
 
     def get_queryset(self):
@@ -1,5 +1,6 @@
 import logging
 from django.db.models import Subquery
+from rest_framework.settings import api_settings
 
 from ..models import Localization
 from ..models import LocalizationType
@@ -11,7 +12,16 @@ from ..models import Project
 from ..models import Version
 from ..models import database_qs
 from ..models import database_query_ids
+from ..models import database_qs_stream
+from ..models import database_query_ids_stream
 from ..search import TatorSearch
+from ..indexer import IndexQueue
+from ..indexer import invalidate_list_caches
+from ..cache import TatorCache
+from ..renderers import streaming_response
+from ..renderers import get_arrow_columns
+from ..renderers import ArrowRenderer
+from ..renderers import ParquetRenderer
 from ..schema import LocalizationListSchema
 from ..schema import LocalizationDetailSchema
 from ..schema import parse
@@ -19,16 +29,73 @@ from ..schema import parse
 from ._base_views import BaseListView
 from ._base_views import BaseDetailView
 from ._annotation_query import get_annotation_queryset
+from ._annotation_query import get_annotation_count
+from ._annotation_query import get_annotation_id_batches
 from ._attributes import AttributeFilterMixin
 from ._attributes import patch_attributes
 from ._attributes import bulk_patch_attributes
 from ._attributes import validate_attributes
+from ._attribute_router import get_attribute_filter
 from ._util import computeRequiredFields
 from ._util import check_required_fields
 from ._permissions import ProjectEditPermission
 
 logger = logging.getLogger(__name__)
 
+def _cache_key(params):
+    """ Returns the (media_id, entity_type_id) a localization list query can be
+        cached under, or None if the query is not cacheable. Only queries
+        scoped to a single media and type are cached, as those are the groups
+        invalidated on write.
+    """
+    media_id = params.get('media_id', None)
+    entity_type_id = params.get('type', None)
+    if (media_id is None) or (len(media_id) != 1) or (entity_type_id is None):
+        return None
+    if 'media_query' in params:
+        return None
+    return (media_id[0], entity_type_id)
+
+def _list_caches(qs):
+    """ Returns list caches affected by a bulk operation on a localization
+        queryset, as taken by `invalidate_list_caches`. Must be called before
+        the queryset is deleted.
+    """
+    return {
+        'media': True,
+        'localization': list(qs.values_list('media', 'meta').distinct()),
+    }
+
+def _adjust_csv_fields(response_data):
+    """ Flattens attributes and replaces user and media IDs with email and media name
+        for csv output. Modifies the list in place and returns it.
+    """
+    user_ids = set([d['user'] for d in response_data])
+    users = list(User.objects.filter(id__in=user_ids).values('id','email'))
+    email_dict = {}
+    for user in users:
+        email_dict[user['id']] = user['email']
+
+    media_ids = set([d['media'] for d in response_data])
+    medias = list(Media.objects.filter(id__in=media_ids).values('id','name'))
+    filename_dict = {}
+    for media in medias:
+        filename_dict[media['id']] = media['name']
+
+    for element in response_data:
+        del element['meta']
+
+        oldAttributes = element['attributes']
+        del element['attributes']
+        element.update(oldAttributes)
+
+        user_id = element['user']
+        media_id = element['media']
+
+        element['user'] = email_dict[user_id]
+        element['media'] = filename_dict[media_id]
+    return response_data
+
 class LocalizationListAPI(BaseListView, AttributeFilterMixin):
     """ Interact with list of localizations.
 
@@ -42,36 +109,83 @@ class LocalizationListAPI(BaseListView, AttributeFilterMixin):
     schema = LocalizationListSchema()
     permission_classes = [ProjectEditPermission]
     http_method_names = ['get', 'post', 'patch', 'delete']
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [ArrowRenderer, ParquetRenderer]
     entity_type = LocalizationType # Needed by attribute filter mixin
 
     def _get(self, params):
         self.validate_attribute_filter(params)
-        postgres_params = ['project', 'media_id', 'type', 'version', 'modified', 'operation', 'format', 'excludeParents','frame']
-        use_es = any([key not in postgres_params for key in params])
+        response_format = self.request.accepted_renderer.format
+        if response_format in ['arrow', 'parquet']:
+            self.arrow_columns = get_arrow_columns(Localization, self.get_attribute_types(params))
+
+        # Stream large lists straight from the database if requested.
+        if (params.get('stream', 0)
+            and self.operation != 'count'
+            and response_format in ['json', 'csv']):
+            chunks = self._get_list(params, stream=True)
+            if response_format == 'csv':
+                chunks = (_adjust_csv_fields(chunk) for chunk in chunks)
+            return streaming_response(chunks, response_format)
+
+        # Get the localization list, from the cache if possible.
+        cache_key = _cache_key(params)
+        response_data = None
+        if cache_key is not None:
+            response_data = TatorCache().get_localization_list_cache(*cache_key, params)
+        if response_data is None:
+            response_data = self._get_list(params)
+            if cache_key is not None:
+                TatorCache().set_localization_list_cache(*cache_key, params, response_data)
+
+        # Adjust fields for csv output.
+        if response_format == 'csv' and self.operation != 'count':
+            _adjust_csv_fields(response_data)
+        return response_data
+
+    def _get_list(self, params, stream=False):
+        """ Returns the localization list. If `stream` is true, returns an iterable
+            of lists of localizations read from a server-side cursor instead.
+        """
+        postgres_params = ['project', 'media_id', 'type', 'version', 'modified', 'operation',
+                           'format', 'excludeParents', 'frame', 'stream']
+        attribute_filter = get_attribute_filter(self, Localization, params, postgres_params)
+        use_es = (attribute_filter is None) and any([key not in postgres_params for key in params])
+        self.engine = 'elasticsearch' if use_es else 'postgres'
 
         # Get the localization list.
-        if use_es:
+        if use_es and self.operation == 'count':
+            response_data = {'count': get_annotation_count(params['project'], params,
+                                                           'localization')}
+        elif use_es and stream and not params['excludeParents']:
+            # IDs are paged from elasticsearch as rows are streamed, rather
+            # than fetched up front.
+            batches = get_annotation_id_batches(params['project'], params, 'localization')
+            response_data = (chunk for ids in batches
+                             for chunk in database_query_ids_stream('main_localization', ids))
+        elif use_es:
+            # Excluding parents needs the full set of IDs.
             response_data = []
             annotation_ids, annotation_count, _ = get_annotation_queryset(
                 params['project'],
                 params,
                 'localization',
             )
-            if self.operation == 'count':
-                response_data = {'count': len(annotation_ids)}
-            elif len(annotation_ids) > 0:
+            if len(annotation_ids) > 0:
                 if params['excludeParents']:
                     qs = Localization.objects.filter(pk__in=annotation_ids)
                     parent_set = Localization.objects.filter(pk__in=Subquery(
                         qs.values('parent')))
                     result_set = qs.difference(parent_set).order_by('id')
-                    response_data = database_qs(result_set)
+                    if stream:
+                        response_data = database_qs_stream(result_set)
+                    else:
+                        response_data = database_qs(result_set)
                 else:
-                    response_data = database_query_ids('main_localization',
-                                                       annotation_ids,
-                                                       'id')
+                    response_data = database_query_ids('main_localization', annotation_ids)
         else:
             qs = Localization.objects.filter(project=params['project'])
+            if attribute_filter:
+                qs = qs.filter(**attribute_filter)
             if 'media_id' in params:
                 qs = qs.filter(media__in=params['media_id'])
             if 'type' in params:
@@ -90,35 +204,10 @@ class LocalizationListAPI(BaseListView, AttributeFilterMixin):
                     result_set = qs.difference(parent_set).order_by('id')
                 else:
                     result_set = qs.order_by('id')
-                response_data = database_qs(result_set)
-
-        # Adjust fields for csv output.
-        if self.request.accepted_renderer.format == 'csv' and self.operation != 'count':
-            # CSV creation requires a bit more
-            user_ids = set([d['user'] for d in response_data])
-            users = list(User.objects.filter(id__in=user_ids).values('id','email'))
-            email_dict = {}
-            for user in users:
-                email_dict[user['id']] = user['email']
-
-            media_ids = set([d['media'] for d in response_data])
-            medias = list(Media.objects.filter(id__in=media_ids).values('id','name'))
-            filename_dict = {}
-            for media in medias:
-                filename_dict[media['id']] = media['name']
-
-            for element in response_data:
-                del element['meta']
-
-                oldAttributes = element['attributes']
-                del element['attributes']
-                element.update(oldAttributes)
-
-                user_id = element['user']
-                media_id = element['media']
-
-                element['user'] = email_dict[user_id]
-                element['media'] = filename_dict[media_id]
+                if stream:
+                    response_data = database_qs_stream(result_set)
+                else:
+                    response_data = database_qs(result_set)
         return response_data
 
     def _post(self, params):
@@ -195,18 +284,18 @@ class LocalizationListAPI(BaseListView, AttributeFilterMixin):
                 create_buffer = []
         localizations += Localization.objects.bulk_create(create_buffer)
 
-        # Build ES documents.
-        ts = TatorSearch()
-        documents = []
-        for loc in localizations:
-            documents += ts.build_document(loc)
-            if len(documents) > 1000:
-                ts.bulk_add_documents(documents)
-                documents = []
-        ts.bulk_add_documents(documents)
+        # Queue ES documents to be built by the index workers.
+        ids = [loc.id for loc in localizations]
+        IndexQueue().enqueue('localization', ids)
+
+        # Clear list caches for the affected media. Index workers clear them
+        # again once the documents are searchable.
+        cache = TatorCache()
+        cache.invalidate_localization_list_caches(set([(loc.media_id, loc.meta_id)
+                                                       for loc in localizations]))
+        cache.invalidate_media_list_cache(project.pk)
 
         # Return created IDs.
-        ids = [loc.id for loc in localizations]
         return {'message': f'Successfully created {len(ids)} localizations!', 'id': ids}
 
     def _delete(self, params):
@@ -223,8 +312,10 @@ class LocalizationListAPI(BaseListView, AttributeFilterMixin):
 
             # Delete the localizations.
             qs = Localization.objects.filter(pk__in=annotation_ids)
+            caches = _list_caches(qs)
             qs._raw_delete(qs.db)
             TatorSearch().delete(self.kwargs['project'], query)
+            invalidate_list_caches(params['project'], caches)
         return {'message': f'Successfully deleted {len(annotation_ids)} localizations!'}
 
     def _patch(self, params):
@@ -239,7 +330,8 @@ class LocalizationListAPI(BaseListView, AttributeFilterMixin):
             new_attrs = validate_attributes(params, qs[0])
             bulk_patch_attributes(new_attrs, qs)
             qs.update(modified_by=self.request.user)
-            TatorSearch().update(self.kwargs['project'], query, new_attrs)
+            IndexQueue().update(self.kwargs['project'], query, new_attrs,
+                                caches=_list_caches(qs))
         return {'message': f'Successfully updated {len(annotation_ids)} localizations!'}
 
     def get_queryset(self):
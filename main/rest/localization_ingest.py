@@ -0,0 +1,397 @@
+import codecs
+import csv
+import datetime
+import io
+import logging
+import os
+
+import numpy as np
+import ujson
+from django.db import connection
+from django.db import transaction
+from django.utils import timezone
+from rest_framework.response import Response
+from rest_framework import status
+from dateutil.parser import parse as dateutil_parse
+
+from ..models import Localization
+from ..models import LocalizationType
+from ..models import Media
+from ..models import Project
+from ..models import Version
+from ..indexer import IndexQueue
+from ..cache import TatorCache
+from ..schema import LocalizationIngestSchema
+
+from ._base_views import BaseListView
+from ._permissions import ProjectEditPermission
+
+logger = logging.getLogger(__name__)
+
+INGEST_CHUNK_SIZE = int(os.getenv('TATOR_INGEST_CHUNK_SIZE', 10000))
+""" Number of rows validated and copied at a time. """
+
+NDJSON_TYPES = ('application/x-ndjson', 'application/jsonl', 'application/json')
+CSV_TYPES = ('text/csv',)
+
+REQUIRED_FIELDS = ('media_id', 'type', 'frame')
+
+FLOAT_FIELDS = {
+    'x': (0.0, 1.0),
+    'y': (0.0, 1.0),
+    'width': (0.0, 1.0),
+    'height': (0.0, 1.0),
+    'u': (-1.0, 1.0),
+    'v': (-1.0, 1.0),
+}
+""" Bounds of each float field, as in `LocalizationSpec`. """
+
+COPY_FIELDS = ('id', 'project', 'meta', 'media', 'version', 'parent', 'user', 'created_by',
+               'modified_by', 'created_datetime', 'modified_datetime', 'modified', 'frame',
+               'x', 'y', 'u', 'v', 'width', 'height', 'attributes')
+""" Localization fields written by COPY. Other fields are null. """
+
+BOOL_VALUES = {True: True, False: False, 'true': True, 'false': False,
+               'True': True, 'False': False, 'TRUE': True, 'FALSE': False}
+
+def _read_ndjson(stream):
+    """ Yields objects from a stream of newline delimited JSON.
+    """
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = ujson.loads(line)
+        except ValueError:
+            raise Exception(f"Line {number} is not valid JSON!")
+        if not isinstance(row, dict):
+            raise Exception(f"Line {number} is not a JSON object!")
+        yield row
+
+def _read_csv(stream):
+    """ Yields objects from a stream of CSV with a header row. Empty cells are
+        omitted.
+    """
+    reader = csv.DictReader(codecs.iterdecode(stream, 'utf-8'))
+    for row in reader:
+        yield {key: value for key, value in row.items() if value not in ('', None)}
+
+def _chunks(rows, chunk_size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def _row_number(offset, idx):
+    """ Returns the one-based row number of an element of a column. The offset
+        is either the index of the first row of the column or an array of the
+        row index of each element.
+    """
+    if isinstance(offset, np.ndarray):
+        return int(offset[idx]) + 1
+    return offset + idx + 1
+
+def _raise_first(bad, offset, message):
+    """ Raises an exception for the first row flagged in a boolean array.
+    """
+    indices = np.flatnonzero(bad)
+    if len(indices) > 0:
+        raise Exception(f"Row {_row_number(offset, indices[0])}: {message}")
+
+def _numeric_column(name, values, offset, integer=False, minimum=None, maximum=None):
+    """ Converts a column to a float array with nan for missing values, and
+        checks that present values are finite, integral if required, and within
+        bounds.
+    """
+    try:
+        arr = np.array([np.nan if value is None else value for value in values],
+                       dtype=np.float64)
+    except (TypeError, ValueError):
+        for idx, value in enumerate(values):
+            try:
+                float(value)
+            except (TypeError, ValueError):
+                raise Exception(f"Row {_row_number(offset, idx)}: invalid value {value} "
+                                f"for {name}!")
+        raise
+    present = ~np.isnan(arr)
+    with np.errstate(invalid='ignore'):
+        _raise_first(present & np.isinf(arr), offset, f"{name} must be finite!")
+        if integer:
+            _raise_first(present & (arr != np.floor(arr)), offset, f"{name} must be an integer!")
+        if minimum is not None:
+            _raise_first(present & (arr < minimum), offset, f"{name} is below minimum {minimum}!")
+        if maximum is not None:
+            _raise_first(present & (arr > maximum), offset, f"{name} is above maximum {maximum}!")
+    return arr, present
+
+def _require(name, present, offset):
+    _raise_first(~present, offset, f'Missing required field "{name}".')
+
+def _to_list(arr, present, integer=False):
+    """ Converts a validated float array to a list of python values.
+    """
+    convert = int if integer else float
+    return [convert(value) if ok else None for value, ok in zip(arr.tolist(), present.tolist())]
+
+def _bool_column(name, values, offset):
+    converted = [BOOL_VALUES.get(value, value) for value in values]
+    bad = np.array([value is not None and not isinstance(value, bool) for value in converted])
+    _raise_first(bad, offset, f"invalid boolean value for {name}!")
+    return converted
+
+def _check_membership(name, arr, known, offset):
+    bad = ~np.isin(arr, np.array(list(known), dtype=np.float64))
+    _raise_first(bad, offset, f"{name} does not exist in this project!")
+
+def _attribute_column(attr_type, values, offset, now):
+    """ Validates and converts the values of one attribute for a column of rows.
+        Missing values are filled with the default, or the current time for
+        datetimes that use it. Returns a list of values, with None for values
+        that should be omitted.
+    """
+    name = attr_type['name']
+    dtype = attr_type['dtype']
+    missing = np.array([value is None for value in values])
+    if missing.any():
+        if dtype == 'datetime':
+            if attr_type.get('use_current', False):
+                values = [now if value is None else value for value in values]
+            elif attr_type.get('required', True):
+                _raise_first(missing, offset, f'Missing attribute value for "{name}". Set '
+                                              f'`use_current` to True or supply a value.')
+        elif 'default' in attr_type:
+            values = [attr_type['default'] if value is None else value for value in values]
+        elif attr_type.get('required', True):
+            _raise_first(missing, offset, f'Missing attribute value for "{name}". Set a '
+                                          f'`default` on the attribute type or supply a value.')
+    if dtype == 'bool':
+        return _bool_column(name, values, offset)
+    elif dtype in ('int', 'float'):
+        integer = dtype == 'int'
+        arr, present = _numeric_column(name, values, offset, integer,
+                                       attr_type.get('minimum'), attr_type.get('maximum'))
+        return _to_list(arr, present, integer)
+    elif dtype == 'enum':
+        choices = set(attr_type['choices'])
+        bad = np.array([value is not None and value not in choices for value in values])
+        _raise_first(bad, offset, f"Invalid value for enum attribute {name}. Valid choices "
+                                  f"are: {attr_type['choices']}.")
+        return values
+    elif dtype == 'string':
+        return [None if value is None else str(value) for value in values]
+    elif dtype == 'datetime':
+        for idx, value in enumerate(values):
+            if value is not None:
+                try:
+                    dateutil_parse(value)
+                except (TypeError, ValueError, OverflowError):
+                    raise Exception(f"Row {_row_number(offset, idx)}: invalid value {value} for "
+                                    f"datetime attribute {name}!")
+        return values
+    elif dtype == 'geopos':
+        coords = []
+        for idx, value in enumerate(values):
+            if value is None:
+                coords.append((np.nan, np.nan))
+            elif isinstance(value, list) and len(value) == 2:
+                coords.append(tuple(value))
+            elif isinstance(value, str) and value.count('_') == 1:
+                lat, lon = value.split('_')
+                coords.append((lon, lat))
+            else:
+                raise Exception(f"Row {_row_number(offset, idx)}: invalid value {value} for "
+                                f"geoposition attribute {name}!")
+        lon, lon_present = _numeric_column(f'{name} longitude', [c[0] for c in coords],
+                                           offset, minimum=-180.0, maximum=180.0)
+        lat, _ = _numeric_column(f'{name} latitude', [c[1] for c in coords],
+                                 offset, minimum=-90.0, maximum=90.0)
+        return [[lo, la] if ok else None
+                for lo, la, ok in zip(lon.tolist(), lat.tolist(), lon_present.tolist())]
+    return values
+
+def _allocate_ids(cursor, count):
+    """ Reserves ids for new localizations from the table sequence.
+    """
+    cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+                   "FROM generate_series(1, %s)",
+                   [Localization._meta.db_table, count])
+    return [row[0] for row in cursor.fetchall()]
+
+def _append_ranges(ranges, ids):
+    """ Extends a list of inclusive [first, last] id ranges with ids.
+    """
+    for id_ in ids:
+        if ranges and ranges[-1][1] == id_ - 1:
+            ranges[-1][1] = id_
+        else:
+            ranges.append([id_, id_])
+
+class _IngestContext:
+    """ Foreign keys resolved while ingesting a stream, shared by all chunks.
+    """
+    def __init__(self, project, user):
+        self.project = project
+        self.user = user
+        self.metas = {obj.id: obj for obj
+                      in LocalizationType.objects.filter(project=project).iterator()}
+        self.media_ids = set()
+        self.version_ids = set(Version.objects.filter(project=project)
+                                              .values_list('id', flat=True))
+        self.default_version = self._get_default_version()
+        self.cache_keys = set()
+        self.ranges = []
+        self.count = 0
+
+    def _get_default_version(self):
+        version = Version.objects.filter(project=self.project, number=0).first()
+        if version is None:
+            version = Version.objects.create(
+                name="Baseline",
+                description="Initial version",
+                project=self.project,
+                number=0,
+            )
+            self.version_ids.add(version.id)
+        return version.id
+
+    def resolve_media(self, media_ids):
+        new_ids = set(media_ids) - self.media_ids
+        if new_ids:
+            self.media_ids.update(Media.objects.filter(project=self.project, pk__in=new_ids)
+                                               .values_list('id', flat=True))
+
+def _ingest_chunk(rows, offset, ctx, cursor):
+    """ Validates a chunk of rows column by column and loads it with COPY.
+    """
+    num_rows = len(rows)
+    columns = {}
+    for name in REQUIRED_FIELDS + ('version', 'parent', 'modified') + tuple(FLOAT_FIELDS):
+        columns[name] = [row.get(name) for row in rows]
+
+    # Validate fields.
+    meta, present = _numeric_column('type', columns['type'], offset, integer=True)
+    _require('type', present, offset)
+    media, present = _numeric_column('media_id', columns['media_id'], offset, integer=True)
+    _require('media_id', present, offset)
+    frame, present = _numeric_column('frame', columns['frame'], offset, integer=True, minimum=0)
+    _require('frame', present, offset)
+    version, version_present = _numeric_column('version', columns['version'], offset,
+                                               integer=True)
+    parent, parent_present = _numeric_column('parent', columns['parent'], offset,
+                                             integer=True)
+    floats = {name: _numeric_column(name, columns[name], offset, False, *bounds)
+              for name, bounds in FLOAT_FIELDS.items()}
+    modified = _bool_column('modified', columns['modified'], offset)
+
+    # Resolve foreign keys with set lookups.
+    _check_membership('type', meta, ctx.metas.keys(), offset)
+    ctx.resolve_media(np.unique(media).astype(np.int64).tolist())
+    _check_membership('media_id', media, ctx.media_ids, offset)
+    version[~version_present] = ctx.default_version
+    _check_membership('version', version, ctx.version_ids, offset)
+    if parent_present.any():
+        parent_ids = np.unique(parent[parent_present]).astype(np.int64).tolist()
+        parents = set(Localization.objects.filter(project=ctx.project, pk__in=parent_ids)
+                                          .values_list('id', flat=True))
+        missing = parent_present & ~np.isin(parent, np.array(list(parents), dtype=np.float64))
+        _raise_first(missing, offset, "parent does not exist in this project!")
+
+    # Validate attributes for each type in the chunk.
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    attributes = [{} for _ in range(num_rows)]
+    for meta_id in np.unique(meta).astype(np.int64).tolist():
+        indices = np.flatnonzero(meta == meta_id)
+        for attr_type in ctx.metas[meta_id].attribute_types or []:
+            name = attr_type['name']
+            values = _attribute_column(attr_type, [rows[idx].get(name) for idx in indices],
+                                       indices + offset, now)
+            for idx, value in zip(indices.tolist(), values):
+                if value is not None:
+                    attributes[idx][name] = value
+
+    # Write the chunk with COPY.
+    ids = _allocate_ids(cursor, num_rows)
+    created = timezone.now().isoformat()
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    meta_list = meta.astype(np.int64).tolist()
+    media_list = media.astype(np.int64).tolist()
+    version_list = version.astype(np.int64).tolist()
+    parent_list = _to_list(parent, parent_present, integer=True)
+    frame_list = frame.astype(np.int64).tolist()
+    float_lists = {name: _to_list(*floats[name]) for name in FLOAT_FIELDS}
+    user = ctx.user.pk
+    for idx in range(num_rows):
+        writer.writerow((
+            ids[idx], ctx.project.pk, meta_list[idx], media_list[idx], version_list[idx],
+            parent_list[idx], user, user, user, created, created, modified[idx],
+            frame_list[idx], float_lists['x'][idx], float_lists['y'][idx],
+            float_lists['u'][idx], float_lists['v'][idx], float_lists['width'][idx],
+            float_lists['height'][idx], ujson.dumps(attributes[idx]),
+        ))
+    buf.seek(0)
+    db_columns = ', '.join([f'"{Localization._meta.get_field(name).column}"'
+                            for name in COPY_FIELDS])
+    cursor.copy_expert(f'COPY "{Localization._meta.db_table}" ({db_columns}) '
+                       f'FROM STDIN WITH (FORMAT csv)', buf)
+
+    # Queue ES documents to be built by the index workers.
+    IndexQueue().enqueue('localization', ids)
+    ctx.cache_keys.update(zip(media_list, meta_list))
+    _append_ranges(ctx.ranges, ids)
+    ctx.count += num_rows
+
+class LocalizationIngestAPI(BaseListView):
+    """ Bulk ingest of localizations streamed as NDJSON or CSV.
+
+        Rows are read from the request stream in chunks. Each chunk is validated a
+        column at a time, foreign keys are checked with one query per chunk, and
+        rows are loaded with COPY. The whole request is a single transaction.
+    """
+    schema = LocalizationIngestSchema()
+    permission_classes = [ProjectEditPermission]
+    http_method_names = ['post']
+
+    def post(self, request, format=None, **kwargs):
+        # The body is streamed, so it is not parsed with the OpenAPI spec.
+        params = {
+            'project': int(kwargs['project']),
+            'content_type': request.content_type.split(';')[0].strip(),
+            'stream': request._request,
+        }
+        response_data = self._post(params)
+        return Response(response_data, status=status.HTTP_201_CREATED)
+
+    def _post(self, params):
+        content_type = params['content_type']
+        if content_type in NDJSON_TYPES:
+            rows = _read_ndjson(params['stream'])
+        elif content_type in CSV_TYPES:
+            rows = _read_csv(params['stream'])
+        else:
+            raise Exception(f"Unsupported content type {content_type}! Use one of "
+                            f"{NDJSON_TYPES + CSV_TYPES}.")
+        project = Project.objects.get(pk=params['project'])
+        with transaction.atomic():
+            ctx = _IngestContext(project, self.request.user)
+            with connection.cursor() as cursor:
+                for chunk in _chunks(rows, INGEST_CHUNK_SIZE):
+                    _ingest_chunk(chunk, ctx.count, ctx, cursor)
+        logger.info(f"Ingested {ctx.count} localizations into project {project.pk}.")
+
+        # Clear list caches for the affected media.
+        cache = TatorCache()
+        cache.invalidate_localization_list_caches(ctx.cache_keys)
+        cache.invalidate_media_list_cache(project.pk)
+
+        return {
+            'message': f'Successfully created {ctx.count} localizations!',
+            'count': ctx.count,
+            'id_ranges': ctx.ranges,
+        }
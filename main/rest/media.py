@@ -5,10 +5,18 @@ from django.db.models import Case, When
 from ..models import Media
 from ..models import MediaType
 from ..models import Localization
+from ..models import LocalizationType
 from ..models import State
 from ..models import database_qs
 from ..models import database_query_ids
+from ..models import invalidate_media_caches
+from ..models import adjust_project_totals
+from ..models import update_media_size
 from ..search import TatorSearch
+from ..indexer import IndexQueue
+from ..deleter import DeleteQueue
+from ..deleter import DELETE_PARENTS_PER_QUERY
+from ..cache import TatorCache
 from ..schema import MediaListSchema
 from ..schema import MediaDetailSchema
 from ..schema import parse
@@ -16,6 +24,7 @@ from ..schema import parse
 from ._base_views import BaseListView
 from ._base_views import BaseDetailView
 from ._media_query import get_media_queryset
+from ._media_query import get_media_count
 from ._attributes import AttributeFilterMixin
 from ._attributes import bulk_patch_attributes
 from ._attributes import patch_attributes
@@ -54,15 +63,20 @@ class MediaListAPI(BaseListView, AttributeFilterMixin):
             meaning they can be described by user defined attributes.
         """
         use_es = self.validate_attribute_filter(params)
-        response_data = []
-        media_ids, media_count, _ = get_media_queryset(
-            self.kwargs['project'],
-            params,
-        )
-        if self.operation == 'count':
-            response_data = {'count': len(media_ids)}
-        elif len(media_ids) > 0:
-            response_data = database_query_ids('main_media', media_ids, 'name')
+        cache = TatorCache()
+        response_data = cache.get_media_list_cache(params['project'], params)
+        if response_data is None and self.operation == 'count':
+            response_data = {'count': get_media_count(self.kwargs['project'], params)}
+            cache.set_media_list_cache(params['project'], params, response_data)
+        elif response_data is None:
+            response_data = []
+            media_ids, media_count, _ = get_media_queryset(
+                self.kwargs['project'],
+                params,
+            )
+            if len(media_ids) > 0:
+                response_data = database_query_ids('main_media', media_ids)
+            cache.set_media_list_cache(params['project'], params, response_data)
         return response_data
 
     def _delete(self, params):
@@ -81,36 +95,17 @@ class MediaListAPI(BaseListView, AttributeFilterMixin):
         )
         count = len(media_ids)
         if count > 0:
-            # Delete any state many-to-many relations to this media.
-            state_media_qs = State.media.through.objects.filter(media__in=media_ids)
-            state_media_qs._raw_delete(state_media_qs.db)
-
-            # Delete any states that now have null media many-to-many.
-            state_qs = State.objects.filter(project=params['project'], media__isnull=True)
-            state_qs._raw_delete(state_qs.db)
-
-            # Delete any localizations associated to this media
-            loc_qs = Localization.objects.filter(media__in=media_ids)
-            # Delete any state many to many relations to these localizations.
-            state_loc_qs = State.localizations.through.objects.filter(localization__in=loc_qs)
-            state_loc_qs._raw_delete(state_loc_qs.db)
-            loc_qs._raw_delete(loc_qs.db)
-
-            # Mark media for deletion by setting project to null.
-            qs = Media.objects.filter(pk__in=media_ids)
-            qs.update(project=None)
-
-            # Clear elasticsearch entries for both media and its children.
-            # Note that clearing children cannot be done using has_parent because it does
-            # not accept queries with size, and has_parent also does not accept ids queries.
-            TatorSearch().delete(self.kwargs['project'], query)
-            loc_ids = [f'box_{id_}' for id_ in loc_qs.iterator()] \
-                    + [f'line_{id_}' for id_ in loc_qs.iterator()] \
-                    + [f'dot_{id_}' for id_ in loc_qs.iterator()]
-            TatorSearch().delete(self.kwargs['project'], {'query': {'ids': {'values': loc_ids}}})
-            state_ids = [f'state_{_id}' for id_ in state_qs.iterator()]
-            TatorSearch().delete(self.kwargs['project'], {'query': {'ids': {'values': state_ids}}})
-        return {'message': f'Successfully deleted {count} medias!'}
+            # Hide the media from searches now, the rows, files and annotations
+            # are removed in batches by a delete worker.
+            for idx in range(0, count, DELETE_PARENTS_PER_QUERY):
+                doc_ids = [f'{dtype}_{id_}'
+                           for id_ in media_ids[idx:idx+DELETE_PARENTS_PER_QUERY]
+                           for dtype in ['image', 'video']]
+                IndexQueue().delete(self.kwargs['project'], {'query': {'ids': {'values': doc_ids}}},
+                                    caches={'media': True})
+            DeleteQueue().submit('media', params['project'], self.request.user,
+                                 media_ids=list(media_ids))
+        return {'message': f'Successfully queued {count} medias for deletion!'}
 
     def _patch(self, params):
         """ Update list of media.
@@ -132,7 +127,17 @@ class MediaListAPI(BaseListView, AttributeFilterMixin):
             qs = Media.objects.filter(pk__in=media_ids)
             new_attrs = validate_attributes(params, qs[0])
             bulk_patch_attributes(new_attrs, qs)
-            TatorSearch().update(self.kwargs['project'], query, new_attrs)
+
+            # Localization lists may be filtered on media attributes.
+            type_ids = list(LocalizationType.objects.filter(project=params['project'])\
+                                                    .values_list('id', flat=True))
+            caches = {
+                'media': True,
+                'localization': [(media_id, type_id)
+                                 for media_id in media_ids
+                                 for type_id in type_ids],
+            }
+            IndexQueue().update(self.kwargs['project'], query, new_attrs, caches=caches)
         return {'message': f'Successfully patched {count} medias!'}
         
 
@@ -194,6 +199,8 @@ class MediaDetailAPI(BaseDetailView):
             obj.last_edit_end = params['last_edit_end']
 
         obj.save()
+        if 'media_files' in params:
+            update_media_size(obj)
         return {'message': 'Media {params["id"]} successfully updated!'}
 
     def _delete(self, params):
@@ -203,7 +210,10 @@ class MediaDetailAPI(BaseDetailView):
             meaning they can be described by user defined attributes.
         """
         qs = Media.objects.filter(pk=params['id'])
-        TatorSearch().delete_document(qs[0])
+        media = qs[0]
+        TatorSearch().delete_document(media)
+        invalidate_media_caches(media)
+        adjust_project_totals(media.project_id, -1, -(media.total_size or 0))
         qs.update(project=None)
         return {'message': 'Media {params["id"]} successfully deleted!'}
 
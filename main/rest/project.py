@@ -3,10 +3,10 @@ from rest_framework.exceptions import PermissionDenied
 from ..models import Project
 from ..models import Membership
 from ..models import Permission
-from ..models import Media
 from ..serializers import ProjectSerializer
 from ..schema import ProjectListSchema
 from ..schema import ProjectDetailSchema
+from ..deleter import DeleteQueue
 
 from ._base_views import BaseListView
 from ._base_views import BaseDetailView
@@ -88,11 +88,10 @@ class ProjectDetailAPI(BaseDetailView):
         if self.request.user != project.creator:
             raise PermissionDenied
 
-        # Mark media for deletion rather than actually deleting it.
-        qs = Media.objects.filter(project=params['id'])
-        qs.update(project=None)
-        project.delete()
-        return {'message': f'Project {params["id"]} deleted successfully!'}
+        # Revoke access now, the data is removed by a delete worker.
+        Membership.objects.filter(project=project).delete()
+        DeleteQueue().submit('project', project.pk, self.request.user)
+        return {'message': f'Project {params["id"]} queued for deletion!'}
 
     def get_queryset(self):
         return Project.objects.all()
@@ -10,6 +10,7 @@ from PIL import Image
 from ..models import Media
 from ..models import MediaType
 from ..models import Project
+from ..models import update_media_size
 from ..consumers import ProgressProducer
 from ..schema import SaveImageSchema
 
@@ -120,6 +121,7 @@ class SaveImageAPI(BaseListView):
         with open(upload_path, 'rb') as f:
             media_obj.file.save(media_base, f, save=False)
         media_obj.save()
+        update_media_size(media_obj)
 
         # Send info to consumer.
         info = {
@@ -12,6 +12,7 @@ from ..models import Media
 from ..models import MediaType
 from ..models import getVideoDefinition
 from ..models import Project
+from ..models import update_media_size
 from ..consumers import ProgressProducer
 from ..schema import SaveVideoSchema
 
@@ -153,6 +154,7 @@ class SaveVideoAPI(BaseListView):
 
         media_element.media_files = media_files
         media_element.save()
+        update_media_size(media_element)
 
         response = {'message': "Video updated successfully!"}
 
@@ -314,6 +316,7 @@ class SaveVideoAPI(BaseListView):
 
         # Save the database record.
         media_obj.save()
+        update_media_size(media_obj)
 
         # Send a message saying upload successful.
         info = {
@@ -3,6 +3,7 @@ import datetime
 import itertools
 
 from django.contrib.postgres.aggregates import ArrayAgg
+from rest_framework.settings import api_settings
 import numpy as np
 
 from ..models import State
@@ -14,7 +15,15 @@ from ..models import Version
 from ..models import InterpolationMethods
 from ..models import database_qs
 from ..models import database_query_ids
+from ..models import database_qs_stream
+from ..models import database_query_ids_stream
 from ..search import TatorSearch
+from ..indexer import IndexQueue
+from ..cache import TatorCache
+from ..renderers import streaming_response
+from ..renderers import get_arrow_columns
+from ..renderers import ArrowRenderer
+from ..renderers import ParquetRenderer
 from ..schema import StateListSchema
 from ..schema import StateDetailSchema
 from ..schema import parse
@@ -22,16 +31,87 @@ from ..schema import parse
 from ._base_views import BaseListView
 from ._base_views import BaseDetailView
 from ._annotation_query import get_annotation_queryset
+from ._annotation_query import get_annotation_count
+from ._annotation_query import get_annotation_id_batches
 from ._attributes import AttributeFilterMixin
 from ._attributes import patch_attributes
 from ._attributes import bulk_patch_attributes
 from ._attributes import validate_attributes
+from ._attribute_router import get_attribute_filter
 from ._util import computeRequiredFields
 from ._util import check_required_fields
 from ._permissions import ProjectEditPermission
 
 logger = logging.getLogger(__name__)
 
+def _fill_many_to_many(response_data):
+    """ Copies localization and media IDs into a list of states. Modifies the list
+        in place and returns it.
+    """
+    state_ids = [state['id'] for state in response_data]
+    localizations = {obj['state_id']:obj['localizations'] for obj in
+        State.localizations.through.objects\
+        .filter(state__in=state_ids)\
+        .values('state_id').order_by('state_id')\
+        .annotate(localizations=ArrayAgg('localization_id')).iterator()}
+    media = {obj['state_id']:obj['media'] for obj in
+        State.media.through.objects\
+        .filter(state__in=state_ids)\
+        .values('state_id').order_by('state_id')\
+        .annotate(media=ArrayAgg('media_id')).iterator()}
+    for state in response_data:
+        state['localizations'] = localizations.get(state['id'], [])
+        state['media'] = media.get(state['id'], [])
+    return response_data
+
+def _is_latest_frame_type(params):
+    """ Returns true if the query is for a frame state type with latest interpolation,
+        which gets extra fields in csv output.
+    """
+    if 'type' not in params:
+        return False
+    type_object = StateType.objects.get(pk=params['type'])
+    return (type_object.association == 'Frame'
+            and type_object.interpolation == InterpolationMethods.LATEST)
+
+def _add_latest_csv_fields(response_data, next_frame=None):
+    """ Adds end frame and times to a list of latest interpolated frame states. The
+        end frame of the last state is `next_frame` if given, otherwise the number of
+        frames in the media.
+    """
+    for idx,el in enumerate(response_data):
+        mediaEl=Media.objects.get(pk=el['media'])
+        endFrame=0
+        if idx + 1 < len(response_data):
+            next_element=response_data[idx+1]
+            endFrame=next_element['frame']
+        elif next_frame is not None:
+            endFrame=next_frame
+        else:
+            endFrame=mediaEl.num_frames
+        el['media']=mediaEl.name
+
+        el['endFrame'] = endFrame
+        el['startSeconds'] = int(el['frame']) * mediaEl.fps
+        el['endSeconds'] = int(el['endFrame']) * mediaEl.fps
+    return response_data
+
+def _stream_latest_csv_fields(chunks):
+    """ Applies `_add_latest_csv_fields` to a stream of state lists. The end frame of
+        a state depends on the state after it, so the last state of each chunk is
+        held back until the next chunk arrives.
+    """
+    pending = None
+    for chunk in chunks:
+        if len(chunk) == 0:
+            continue
+        if pending is not None:
+            chunk = [pending] + chunk
+        pending = chunk.pop()
+        yield _add_latest_csv_fields(chunk, pending['frame'])
+    if pending is not None:
+        yield _add_latest_csv_fields([pending])
+
 class StateListAPI(BaseListView, AttributeFilterMixin):
     """ Interact with list of states.
 
@@ -51,29 +131,72 @@ class StateListAPI(BaseListView, AttributeFilterMixin):
     schema=StateListSchema()
     permission_classes = [ProjectEditPermission]
     http_method_names = ['get', 'post', 'patch', 'delete']
+    renderer_classes = api_settings.DEFAULT_RENDERER_CLASSES + [ArrowRenderer, ParquetRenderer]
     entity_type = StateType # Needed by attribute filter mixin
 
     def _get(self, params):
         self.validate_attribute_filter(params)
-        postgres_params = ['project', 'media_id', 'type', 'version', 'modified', 'operation']
-        use_es = any([key not in postgres_params for key in params])
+        response_format = self.request.accepted_renderer.format
+        if response_format in ['arrow', 'parquet']:
+            self.arrow_columns = get_arrow_columns(State, self.get_attribute_types(params))
+
+        # Stream large lists straight from the database if requested.
+        if (params.get('stream', 0)
+            and self.operation != 'count'
+            and response_format in ['json', 'csv']):
+            chunks = (_fill_many_to_many(chunk) for chunk in self._get_list(params, stream=True))
+            if response_format == 'csv' and _is_latest_frame_type(params):
+                chunks = _stream_latest_csv_fields(chunks)
+            return streaming_response(chunks, response_format)
 
         # Get the state list.
         t0 = datetime.datetime.now()
-        if use_es:
+        response_data = self._get_list(params)
+        t1 = datetime.datetime.now()
+        if self.operation != 'count':
+            _fill_many_to_many(response_data)
+        if (response_format == 'csv'
+            and self.operation != 'count'
+            and _is_latest_frame_type(params)):
+            _add_latest_csv_fields(response_data)
+        t2 = datetime.datetime.now()
+        logger.info(f"Number of states: {len(response_data)}")
+        logger.info(f"Time to get states: {t1-t0}")
+        logger.info(f"Time to get states many to many fields: {t2-t1}")
+        return response_data
+
+    def _get_list(self, params, stream=False):
+        """ Returns the state list without many to many fields. If `stream` is true,
+            returns an iterable of lists of states read from a server-side cursor
+            instead.
+        """
+        postgres_params = ['project', 'media_id', 'type', 'version', 'modified', 'operation',
+                           'stream']
+        attribute_filter = get_attribute_filter(self, State, params, postgres_params)
+        use_es = (attribute_filter is None) and any([key not in postgres_params for key in params])
+        self.engine = 'elasticsearch' if use_es else 'postgres'
+
+        if use_es and self.operation == 'count':
+            response_data = {'count': get_annotation_count(params['project'], params, 'state')}
+        elif use_es and stream:
+            # IDs are paged from elasticsearch as rows are streamed, rather
+            # than fetched up front.
+            batches = get_annotation_id_batches(params['project'], params, 'state')
+            response_data = (chunk for ids in batches
+                             for chunk in database_query_ids_stream('main_state', ids))
+        elif use_es:
             response_data = []
             annotation_ids, annotation_count, _ = get_annotation_queryset(
                 params['project'],
                 params,
                 'state',
             )
-            if self.operation == 'count':
-                response_data = {'count': len(annotation_ids)}
-            elif len(annotation_ids) > 0:
-                response_data = database_query_ids('main_state', annotation_ids, 'id')
-
+            if len(annotation_ids) > 0:
+                response_data = database_query_ids('main_state', annotation_ids)
         else:
             qs = State.objects.filter(project=params['project'])
+            if attribute_filter:
+                qs = qs.filter(**attribute_filter)
             if 'media_id' in params:
                 qs = qs.filter(media__in=params['media_id'])
             if 'type' in params:
@@ -84,48 +207,10 @@ class StateListAPI(BaseListView, AttributeFilterMixin):
                 qs = qs.exclude(modified=(not params['modified']))
             if self.operation == 'count':
                 response_data = {'count': qs.count()}
+            elif stream:
+                response_data = database_qs_stream(qs.order_by('id'))
             else:
                 response_data = database_qs(qs.order_by('id'))
-        t1 = datetime.datetime.now()
-        if self.operation != 'count':
-            # Get many to many fields.
-            state_ids = [state['id'] for state in response_data]
-            localizations = {obj['state_id']:obj['localizations'] for obj in
-                State.localizations.through.objects\
-                .filter(state__in=state_ids)\
-                .values('state_id').order_by('state_id')\
-                .annotate(localizations=ArrayAgg('localization_id')).iterator()}
-            media = {obj['state_id']:obj['media'] for obj in
-                State.media.through.objects\
-                .filter(state__in=state_ids)\
-                .values('state_id').order_by('state_id')\
-                .annotate(media=ArrayAgg('media_id')).iterator()}
-            # Copy many to many fields into response data.
-            for state in response_data:
-                state['localizations'] = localizations.get(state['id'], [])
-                state['media'] = media.get(state['id'], [])
-        if (self.request.accepted_renderer.format == 'csv'
-            and self.operation != 'count'
-            and 'type' in params):
-            type_object=StateType.objects.get(pk=params['type'])
-            if type_object.association == 'Frame' and type_object.interpolation == InterpolationMethods.LATEST:
-                for idx,el in enumerate(response_data):
-                    mediaEl=Media.objects.get(pk=el['media'])
-                    endFrame=0
-                    if idx + 1 < len(response_data):
-                        next_element=response_data[idx+1]
-                        endFrame=next_element['frame']
-                    else:
-                        endFrame=mediaEl.num_frames
-                    el['media']=mediaEl.name
-
-                    el['endFrame'] = endFrame
-                    el['startSeconds'] = int(el['frame']) * mediaEl.fps
-                    el['endSeconds'] = int(el['endFrame']) * mediaEl.fps
-        t2 = datetime.datetime.now()
-        logger.info(f"Number of states: {len(response_data)}")
-        logger.info(f"Time to get states: {t1-t0}")
-        logger.info(f"Time to get states many to many fields: {t2-t1}")
         return response_data
 
     def _post(self, params):
@@ -230,18 +315,15 @@ class StateListAPI(BaseListView, AttributeFilterMixin):
                 state.segments = [[int(segment[0]), int(segment[-1])] for segment in segments]
         State.objects.bulk_update(states, ['segments'])
 
-        # Build ES documents.
-        ts = TatorSearch()
-        documents = []
-        for state in states:
-            documents += ts.build_document(state)
-            if len(documents) > 1000:
-                ts.bulk_add_documents(documents)
-                documents = []
-        ts.bulk_add_documents(documents)
+        # Queue ES documents to be built by the index workers.
+        ids = [state.id for state in states]
+        IndexQueue().enqueue('state', ids)
+
+        # Media lists may be filtered on state attributes. Index workers clear
+        # them again once the documents are searchable.
+        TatorCache().invalidate_media_list_cache(project.pk)
 
         # Return created IDs.
-        ids = [state.id for state in states]
         return {'message': f'Successfully created {len(ids)} states!', 'id': ids}
 
     def _delete(self, params):
@@ -264,6 +346,7 @@ class StateListAPI(BaseListView, AttributeFilterMixin):
             qs = State.objects.filter(pk__in=annotation_ids)
             qs._raw_delete(qs.db)
             TatorSearch().delete(self.kwargs['project'], query)
+            TatorCache().invalidate_media_list_cache(params['project'])
         return {'message': f'Successfully deleted {len(annotation_ids)} states!'}
 
     def _patch(self, params):
@@ -278,7 +361,8 @@ class StateListAPI(BaseListView, AttributeFilterMixin):
             new_attrs = validate_attributes(params, qs[0])
             bulk_patch_attributes(new_attrs, qs)
             qs.update(modified_by=self.request.user)
-            TatorSearch().update(self.kwargs['project'], query, new_attrs)
+            IndexQueue().update(self.kwargs['project'], query, new_attrs,
+                                caches={'media': True})
         return {'message': f'Successfully updated {len(annotation_ids)} states!'}
 
     def get_queryset(self):
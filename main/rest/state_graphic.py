@@ -6,6 +6,7 @@ from rest_framework import status
 from django.http import response
 
 from ..models import State
+from ..cache import FrameCache
 from ..renderers import PngRenderer
 from ..renderers import JpegRenderer
 from ..renderers import GifRenderer
@@ -62,6 +63,21 @@ class StateGraphicAPI(BaseDetailView):
         localizations = state.localizations.all()
         frames = [l.frame for l in localizations]
         roi = [(l.width, l.height, l.x, l.y) for l in localizations]
+        render_format = self.request.accepted_renderer.format
+        if mode == "animate" and render_format not in ['mp4', 'gif']:
+            render_format = 'gif'
+
+        # Check to see if we already rendered this. Frames and rois are part of
+        # the key so edits to the localizations produce a new render.
+        frame_cache = FrameCache()
+        cache_params = {'mode': mode, 'fps': fps, 'forceScale': force_scale,
+                        'frames': frames, 'roi': roi}
+        response_data = frame_cache.get(video, cache_params, render_format)
+        if response_data is not None:
+            if mode == "animate":
+                self.request.accepted_renderer = GifRenderer()
+            return response_data
+
         with tempfile.TemporaryDirectory() as temp_dir:
             media_util = MediaUtil(video, temp_dir)
             if mode == "animate":
@@ -102,4 +118,5 @@ class StateGraphicAPI(BaseDetailView):
                                                    force_scale=force_scale)
                 with open(tiled_fp, 'rb') as data_file:
                     response_data = data_file.read()
+        frame_cache.set(video, cache_params, render_format, response_data)
         return response_data
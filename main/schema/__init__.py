@@ -10,6 +10,7 @@ from .leaf_type import LeafTypeListSchema
 from .leaf_type import LeafTypeDetailSchema
 from .localization import LocalizationListSchema
 from .localization import LocalizationDetailSchema
+from .localization_ingest import LocalizationIngestSchema
 from .localization_type import LocalizationTypeListSchema
 from .localization_type import LocalizationTypeDetailSchema
 from .media import MediaListSchema
@@ -44,4 +45,5 @@ from .user import CurrentUserSchema
 from .version import VersionListSchema
 from .version import VersionDetailSchema
 from ._parse import parse
+from ._parse import load_validator
 from ._generator import CustomGenerator
@@ -57,3 +57,17 @@ annotation_filter_parameter_schema = [
         'schema': {'type': 'integer'},
     },
 ]
+
+annotation_stream_parameter_schema = [
+    {
+        'name': 'stream',
+        'in': 'query',
+        'required': False,
+        'description': 'Set to 1 to stream the response in chunks read from a server-side '
+                       'cursor. Only applies to json and csv output. Use this for large '
+                       'exports; responses are not cached. (0 or 1)',
+        'schema': {'type': 'integer',
+                   'minimum': 0,
+                   'maximum': 1},
+    },
+]
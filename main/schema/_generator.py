@@ -79,6 +79,7 @@ class CustomGenerator(SchemaGenerator):
                 'ColorMap': color_map,
                 'CreateResponse': create_response,
                 'CreateListResponse': create_list_response,
+                'CreateRangeResponse': create_range_response,
                 'MessageResponse': message_response,
                 'NotFoundResponse': not_found_response,
                 'BadRequestResponse': bad_request_response,
@@ -21,3 +21,11 @@ def message_with_id_list_schema(name):
             '$ref': '#/components/schemas/CreateListResponse',
         }}},
     }
+
+def message_with_id_range_schema(name):
+    return {
+        'description': f'Successful creation of {name}.',
+        'content': {'application/json': {'schema': {
+            '$ref': '#/components/schemas/CreateRangeResponse',
+        }}},
+    }
@@ -1,5 +1,10 @@
 import logging
+import glob
+import json
+import os
+import re
 
+import fastjsonschema
 from openapi_core import create_spec
 from openapi_core.validation.request.validators import RequestValidator
 from openapi_core.contrib.django import DjangoOpenAPIRequest
@@ -8,17 +13,188 @@ from ._generator import CustomGenerator
 
 logger = logging.getLogger(__name__)
 
-def parse(request):
-    """ Parses a request using Tator's generated OpenAPI spec.
+SPEC_PATH = os.getenv('TATOR_PARSER_SPEC',
+                      os.path.join(os.path.dirname(__file__), 'parser_spec.json'))
+""" Location of the parser spec prebuilt by the `buildparserspec` command. """
+
+DRAFT4 = 'http://json-schema.org/draft-04/schema#'
+
+UNMARSHALLED_KEYS = ('format', 'x-model', 'discriminator')
+""" Keywords that make openapi-core convert values rather than just validate
+    them. Bodies whose schemas use these always take the openapi-core path.
+"""
+
+_route_regex = re.compile(r'<(?:\w+:)?(\w+)>')
+
+def build_spec():
+    """ Generates the OpenAPI spec used for parsing requests.
+    """
+    generator = CustomGenerator(title='Tator REST API')
+    return generator.get_schema(parser=True)
+
+def load_spec():
+    """ Loads the prebuilt parser spec, or generates it if it is missing or
+        older than the schema modules.
+    """
+    if os.path.exists(SPEC_PATH):
+        built = os.path.getmtime(SPEC_PATH)
+        sources = glob.glob(os.path.join(os.path.dirname(__file__), '**', '*.py'),
+                            recursive=True)
+        if all([os.path.getmtime(path) <= built for path in sources]):
+            with open(SPEC_PATH, 'r') as f:
+                return json.load(f)
+        logger.info(f"Parser spec at {SPEC_PATH} is stale, regenerating...")
+    return build_spec()
+
+def _to_json_schema(schema):
+    """ Converts an OpenAPI schema object to a draft 4 JSON schema.
+    """
+    if isinstance(schema, list):
+        return [_to_json_schema(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    out = {}
+    for key, value in schema.items():
+        if key in ('nullable', 'example', 'examples', 'description'):
+            continue
+        if key in ('properties', 'schemas'):
+            out[key] = {name: _to_json_schema(item) for name, item in value.items()}
+        elif key in ('default', 'enum'):
+            out[key] = value
+        else:
+            out[key] = _to_json_schema(value)
+    if schema.get('nullable', False):
+        if 'type' in out:
+            out['type'] = [out['type'], 'null']
+            if 'enum' in out:
+                out['enum'] = out['enum'] + [None]
+        else:
+            out = {'anyOf': [{'type': 'null'}, out]}
+    return out
+
+def _is_compilable(schema, components, seen=None, in_choice=False):
+    """ Returns whether validating a body against this schema would leave it
+        unchanged by openapi-core, apart from property defaults outside of
+        oneOf/anyOf/allOf.
+    """
+    if seen is None:
+        seen = set()
+    if isinstance(schema, list):
+        return all([_is_compilable(item, components, seen, in_choice) for item in schema])
+    if not isinstance(schema, dict):
+        return True
+    if any([key in schema for key in UNMARSHALLED_KEYS]):
+        return False
+    if in_choice and 'default' in schema:
+        return False
+    ref = schema.get('$ref')
+    if ref is not None:
+        if ref in seen:
+            return True
+        seen.add(ref)
+        name = ref.split('/')[-1]
+        if name not in components:
+            return False
+        return _is_compilable(components[name], components, seen, in_choice)
+    for key, value in schema.items():
+        if key in ('description', 'example', 'examples', 'default', 'enum'):
+            continue
+        choice = in_choice or key in ('oneOf', 'anyOf', 'allOf')
+        if key == 'properties':
+            value = list(value.values())
+        if not _is_compilable(value, components, seen, choice):
+            return False
+    return True
+
+def compile_body_validators(spec):
+    """ Compiles a validator for each JSON array request body in the spec.
+        Returns a dict keyed by (path, method).
+    """
+    components = spec.get('components', {}).get('schemas', {})
+    converted = _to_json_schema({'schemas': components})
+    validators = {}
+    for path, operations in spec.get('paths', {}).items():
+        for method, operation in operations.items():
+            if not isinstance(operation, dict):
+                continue
+            content = operation.get('requestBody', {}).get('content', {})
+            schema = content.get('application/json', {}).get('schema')
+            if schema is None or schema.get('type') != 'array':
+                continue
+            if not _is_compilable(schema, components):
+                logger.info(f"Body of {method.upper()} {path} is not compilable.")
+                continue
+            definition = {
+                '$schema': DRAFT4,
+                **_to_json_schema(schema),
+                'components': converted,
+            }
+            validators[(path, method.lower())] = fastjsonschema.compile(
+                definition, use_default=True)
+    return validators
+
+def load_validator():
+    """ Builds the openapi-core validator and compiled body validators. Called
+        at worker startup so the first request does not pay for it.
     """
     if parse.validator is None:
-        generator = CustomGenerator(title='Tator REST API')
-        spec = generator.get_schema(parser=True)
-        openapi_spec = create_spec(spec)
-        parse.validator = RequestValidator(openapi_spec)
+        spec = load_spec()
+        parse.validator = RequestValidator(create_spec(spec))
+        parse.body_validators = compile_body_validators(spec)
+        logger.info(f"Compiled {len(parse.body_validators)} request body validators.")
+
+def _openapi_request(request):
     openapi_request = DjangoOpenAPIRequest(request)
     if openapi_request.mimetype.startswith('application/json'):
         openapi_request.mimetype = 'application/json'
+    return openapi_request
+
+def _spec_path(request):
+    """ Returns the spec path of the route that matched a request.
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None or not match.route:
+        return None
+    return '/' + _route_regex.sub(r'{\1}', match.route)
+
+def _parse_bulk(request):
+    """ Validates a JSON list body with a compiled validator. Path and query
+        parameters are still parsed by openapi-core, using a body holding only
+        the first element. Returns None if the request cannot take this path
+        or fails validation, so errors are always reported by openapi-core.
+    """
+    if not request.content_type.startswith('application/json'):
+        return None
+    key = (_spec_path(request), request.method.lower())
+    body_validator = parse.body_validators.get(key)
+    if body_validator is None:
+        return None
+    try:
+        body = json.loads(request.body)
+        if not isinstance(body, list) or len(body) == 0:
+            return None
+        body = body_validator(body)
+    except (ValueError, fastjsonschema.JsonSchemaException):
+        return None
+    openapi_request = _openapi_request(request)
+    openapi_request.body = json.dumps(body[:1])
+    result = parse.validator.validate(openapi_request)
+    if result.errors:
+        return None
+    return {
+        **result.parameters.path,
+        **result.parameters.query,
+        'body': body,
+    }
+
+def parse(request):
+    """ Parses a request using Tator's generated OpenAPI spec.
+    """
+    load_validator()
+    out = _parse_bulk(request)
+    if out is not None:
+        return out
+    openapi_request = _openapi_request(request)
     result = parse.validator.validate(openapi_request)
     result.raise_for_errors()
     out = {
@@ -33,3 +209,4 @@ def parse(request):
     return out
 
 parse.validator = None
+parse.body_validators = {}
@@ -67,6 +67,7 @@ from ._color import alpha_range
 from ._color import color_map
 from ._common import create_response
 from ._common import create_list_response
+from ._common import create_range_response
 from ._common import message_response
 from ._common import attribute_bulk_update
 from ._errors import not_found_response
@@ -27,6 +27,31 @@ create_list_response = {
     },
 }
 
+create_range_response = {
+    'type': 'object',
+    'properties': {
+        'message': {
+            'type': 'string',
+            'description': 'Message indicating successful creation.',
+        },
+        'count': {
+            'type': 'integer',
+            'description': 'Number of created objects.',
+        },
+        'id_ranges': {
+            'type': 'array',
+            'description': 'Inclusive [first, last] ranges of unique integers identifying '
+                           'created objects, in input order.',
+            'items': {
+                'type': 'array',
+                'minItems': 2,
+                'maxItems': 2,
+                'items': {'type': 'integer'},
+            },
+        },
+    },
+}
+
 message_response = {
     'type': 'object',
     'properties': {
@@ -0,0 +1,61 @@
+from textwrap import dedent
+
+from rest_framework.schemas.openapi import AutoSchema
+
+from ._message import message_with_id_range_schema
+from ._errors import error_responses
+
+class LocalizationIngestSchema(AutoSchema):
+    def get_operation(self, path, method):
+        operation = super().get_operation(path, method)
+        if method == 'POST':
+            operation['operationId'] = 'IngestLocalizations'
+        operation['tags'] = ['Tator']
+        return operation
+
+    def get_description(self, path, method):
+        return dedent("""\
+        Bulk ingest of localizations.
+
+        Accepts any number of localizations streamed as newline delimited JSON
+        (`application/x-ndjson`) or CSV with a header row (`text/csv`). Each row has the
+        fields of a `LocalizationSpec`, with attribute values as additional keys or columns.
+        Empty CSV cells are treated as missing values. Rows are validated and loaded in
+        chunks, and either all rows are created or none are. Ranges of created IDs are
+        returned instead of a list of IDs.
+        """)
+
+    def _get_path_parameters(self, path, method):
+        return [{
+            'name': 'project',
+            'in': 'path',
+            'required': True,
+            'description': 'A unique integer identifying a project.',
+            'schema': {'type': 'integer'},
+        }]
+
+    def _get_filter_parameters(self, path, method):
+        return []
+
+    def _get_request_body(self, path, method):
+        body = {}
+        if method == 'POST':
+            body = {'content': {
+                'application/x-ndjson': {
+                    'schema': {'type': 'string'},
+                    'example': '{"media_id": 1, "type": 1, "frame": 0, "x": 0.1, "y": 0.2, '
+                               '"width": 0.3, "height": 0.4, "Species": "Tuna"}\n',
+                },
+                'text/csv': {
+                    'schema': {'type': 'string'},
+                    'example': 'media_id,type,frame,x,y,width,height,Species\n'
+                               '1,1,0,0.1,0.2,0.3,0.4,Tuna\n',
+                },
+            }}
+        return body
+
+    def _get_responses(self, path, method):
+        responses = error_responses()
+        if method == 'POST':
+            responses['201'] = message_with_id_range_schema('localizations')
+        return responses
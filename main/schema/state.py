@@ -7,6 +7,7 @@ from ._message import message_with_id_list_schema
 from ._message import message_schema
 from ._attributes import attribute_filter_parameter_schema
 from ._annotation_query import annotation_filter_parameter_schema
+from ._annotation_query import annotation_stream_parameter_schema
 
 boilerplate = dedent("""\
 A state is a description of a collection of other objects. The objects a state describes
@@ -66,6 +67,8 @@ class StateListSchema(AutoSchema):
         params = []
         if method in ['GET', 'PATCH', 'DELETE']:
             params = annotation_filter_parameter_schema + attribute_filter_parameter_schema
+        if method == 'GET':
+            params = params + annotation_stream_parameter_schema
         return params
 
     def _get_request_body(self, path, method):
@@ -1,15 +1,38 @@
+import json
 import logging
 import os
+import time
 from copy import deepcopy
+from uuid import uuid1
+from concurrent.futures import ThreadPoolExecutor
 from elasticsearch import Elasticsearch
+from elasticsearch.exceptions import NotFoundError
 from elasticsearch.helpers import bulk
 
+from .cache import TatorCache
+
 logger = logging.getLogger(__name__)
 
 # Used for duplicate ID storage
 id_bits=448
 id_mask=(1 << id_bits) - 1
 
+# Number of threads used to read media file sizes
+FILE_SIZE_THREADS=int(os.getenv('TATOR_FILE_SIZE_THREADS', 8))
+
+# Seconds between checks for an index rebuild in progress
+REBUILD_CHECK_INTERVAL=int(os.getenv('TATOR_REBUILD_CHECK_INTERVAL', 10))
+
+# Largest number of distinct entities counted exactly by a cardinality aggregation
+CARDINALITY_PRECISION=40000
+
+# Painless script stored for bulk attribute updates, parameterized by values
+UPDATE_SCRIPT=('for (entry in params.attrs.entrySet()) '
+               '{ ctx._source[entry.getKey()] = entry.getValue(); }')
+
+# Sort value elasticsearch uses for documents missing a long field
+missing_sort_value=(1 << 63) - 1
+
 def mediaFileSizes(file):
     total_size = 0
     download_size = None
@@ -48,6 +71,14 @@ def mediaFileSizes(file):
                 download_size = file.file.size
     return (total_size, download_size)
 
+def mediaStoredSizes(file):
+    """ Returns sizes stored on a media. Sizes are computed from files only for
+        media that have not been sized yet.
+    """
+    if file.total_size is not None:
+        return (file.total_size, file.download_size)
+    return mediaFileSizes(file)
+
 def drop_dupes(ids):
     """ Drops duplicates in a list without changing the order.
     """
@@ -66,6 +97,8 @@ class TatorSearch:
         cls.prefix = os.getenv('ELASTICSEARCH_PREFIX')
         if cls.prefix is None:
             cls.prefix = ''
+        cls._rebuild_targets = {}
+        cls._update_script_ready = False
         cls.es = Elasticsearch(
             [os.getenv('ELASTICSEARCH_HOST')],
             timeout=60,
@@ -74,46 +107,66 @@ class TatorSearch:
         )
 
     def index_name(self, project):
+        """ Returns the name of the alias pointing to the index of a project.
+        """
         return f'{self.prefix}project_{project}'
 
-    def create_index(self, project):
-        index = self.index_name(project)
-        if not self.es.indices.exists(index):
-            self.es.indices.create(
-                index,
-                body={
-                    'settings': {
-                        'number_of_shards': 1,
-                        'number_of_replicas': 1,
-                        'analysis': {
-                            'normalizer': {
-                                'lower_normalizer': {
-                                    'type': 'custom',
-                                    'char_filter': [],
-                                    'filter': ['lowercase', 'asciifolding'],
-                                },
+    def rebuild_alias_name(self, project):
+        """ Returns the name of the alias pointing to an index being rebuilt.
+        """
+        return f'{self.prefix}project_{project}_rebuild'
+
+    def _new_index_name(self, project):
+        return f'{self.index_name(project)}_{uuid1().hex}'
+
+    def _indices(self, name):
+        """ Returns names of the indices behind an alias or index.
+        """
+        try:
+            return list(self.es.indices.get_alias(index=name).keys())
+        except NotFoundError:
+            return []
+
+    def _create_physical_index(self, index, aliases):
+        self.es.indices.create(
+            index,
+            body={
+                'settings': {
+                    'number_of_shards': 1,
+                    'number_of_replicas': 1,
+                    'analysis': {
+                        'normalizer': {
+                            'lower_normalizer': {
+                                'type': 'custom',
+                                'char_filter': [],
+                                'filter': ['lowercase', 'asciifolding'],
                             },
                         },
                     },
-                    'mappings': {
-                        'properties': {
-                            '_media_relation': {
-                                'type': 'join',
-                                'relations': {
-                                    'media': 'annotation',
-                                }
-                            },
-                            'tator_media_name': {'type': 'text'},
-                            '_exact_name': {'type': 'keyword', 'normalizer': 'lower_normalizer'},
-                            '_md5': {'type': 'keyword'},
-                            '_meta': {'type': 'integer'},
-                            '_dtype': {'type': 'keyword'},
-                            'tator_user_sections': {'type': 'keyword'},
-                        }
-                    },
                 },
-            )
-        # Mappings that were added later
+                'mappings': {
+                    'properties': {
+                        '_media_relation': {
+                            'type': 'join',
+                            'relations': {
+                                'media': 'annotation',
+                            }
+                        },
+                        'tator_media_name': {'type': 'text'},
+                        '_exact_name': {'type': 'keyword', 'normalizer': 'lower_normalizer'},
+                        '_md5': {'type': 'keyword'},
+                        '_meta': {'type': 'integer'},
+                        '_dtype': {'type': 'keyword'},
+                        'tator_user_sections': {'type': 'keyword'},
+                    }
+                },
+                'aliases': {alias: {} for alias in aliases},
+            },
+        )
+        self._put_later_mappings(index)
+
+    def _put_later_mappings(self, index):
+        """ Mappings that were added later. """
         self.es.indices.put_mapping(
             index=index,
             body={'properties': {
@@ -131,12 +184,112 @@ class TatorSearch:
             }},
         )
 
+    def create_index(self, project):
+        """ Creates the index of a project behind an alias if it does not exist.
+            Projects indexed before aliases were used keep an index named like
+            the alias until they are rebuilt.
+        """
+        alias = self.index_name(project)
+        if self.es.indices.exists(alias):
+            self._put_later_mappings(alias)
+        else:
+            self._create_physical_index(self._new_index_name(project), [alias])
+
     def delete_index(self, project):
-        index = self.index_name(project)
-        if self.es.indices.exists(index):
-            self.es.indices.delete(index)
+        indices = self._indices(self.index_name(project))
+        indices += self._indices(self.rebuild_alias_name(project))
+        if indices:
+            self.es.indices.delete(','.join(set(indices)))
+
+    def write_indices(self, project):
+        """ Returns the indices that writes to a project go to. While the index
+            of a project is being rebuilt this includes the new index. Rebuilds
+            are looked up at most every `REBUILD_CHECK_INTERVAL` seconds.
+        """
+        alias = self.index_name(project)
+        now = time.time()
+        cached = self._rebuild_targets.get(alias)
+        if cached is None or now - cached[0] > REBUILD_CHECK_INTERVAL:
+            cached = (now, self._indices(self.rebuild_alias_name(project)))
+            self._rebuild_targets[alias] = cached
+        return [alias] + cached[1]
+
+    def dual_write(self, actions):
+        """ Generator that yields bulk actions, plus copies of them for the
+            index being rebuilt if there is one. Deletes are also recorded
+            for the rebuild.
+        """
+        for action in actions:
+            yield action
+            project = int(action['_index'][len(f'{self.prefix}project_'):])
+            for index in self.write_indices(project)[1:]:
+                if action.get('_op_type') == 'delete':
+                    TatorCache.rds.sadd(self.deleted_ids_key(index), action['_id'])
+                yield {**action, '_index': index}
+
+    def deleted_ids_key(self, index):
+        """ Returns the redis set of document IDs deleted while an index is
+            being rebuilt.
+        """
+        return f'{index}_deleted_ids'
 
-    def create_mapping(self, entity_type):
+    def deleted_queries_key(self, index):
+        """ Returns the redis list of delete queries run while an index is
+            being rebuilt.
+        """
+        return f'{index}_deleted_queries'
+
+    def _record_deletes(self, project, doc_ids=None, query=None):
+        """ Records deletes made while the index of a project is rebuilt, so
+            they can be replayed on documents built from rows read before the
+            delete.
+        """
+        for index in self.write_indices(project)[1:]:
+            if doc_ids:
+                TatorCache.rds.sadd(self.deleted_ids_key(index), *doc_ids)
+            if query is not None:
+                TatorCache.rds.rpush(self.deleted_queries_key(index), json.dumps(query))
+
+    def begin_rebuild(self, project, entity_types):
+        """ Creates a new index for a project with mappings for the given entity
+            types and starts dual writing to it. Returns the name of the new
+            index, or of the index already being rebuilt.
+        """
+        rebuild_alias = self.rebuild_alias_name(project)
+        indices = self._indices(rebuild_alias)
+        if indices:
+            return indices[0]
+        index = self._new_index_name(project)
+        self._create_physical_index(index, [])
+        for entity_type in entity_types:
+            self.create_mapping(entity_type, index)
+        self.es.indices.put_alias(index=index, name=rebuild_alias)
+        return index
+
+    def finish_rebuild(self, project):
+        """ Atomically points the alias of a project at the rebuilt index and
+            deletes the old index.
+        """
+        alias = self.index_name(project)
+        rebuild_alias = self.rebuild_alias_name(project)
+        index = self._indices(rebuild_alias)[0]
+        self.es.indices.refresh(index)
+        actions = [
+            {'remove': {'index': index, 'alias': rebuild_alias}},
+            {'add': {'index': index, 'alias': alias}},
+        ]
+        # A legacy index named like the alias is removed the same way.
+        actions += [{'remove_index': {'index': old}} for old in self._indices(alias)]
+        self.es.indices.update_aliases(body={'actions': actions})
+
+    def create_mapping(self, entity_type, index=None):
+        """ Adds mappings for attribute types of an entity type to the index of
+            its project, or to the given index.
+        """
+        if index is None:
+            indices = self.write_indices(entity_type.project.pk)
+        else:
+            indices = [index]
         if entity_type.attribute_types:
             for attribute_type in entity_type.attribute_types:
                 if attribute_type['dtype'] == 'bool':
@@ -153,12 +306,13 @@ class TatorSearch:
                     dtype='date'
                 elif attribute_type['dtype'] == 'geopos':
                     dtype='geo_point'
-                self.es.indices.put_mapping(
-                    index=self.index_name(entity_type.project.pk),
-                    body={'properties': {
-                        attribute_type['name']: {'type': dtype},
-                    }},
-                )
+                for index in indices:
+                    self.es.indices.put_mapping(
+                        index=index,
+                        body={'properties': {
+                            attribute_type['name']: {'type': dtype},
+                        }},
+                    )
 
     def bulk_add_documents(self, listOfDocs):
         bulk(self.es, listOfDocs, raise_on_error=False)
@@ -167,18 +321,21 @@ class TatorSearch:
         """ Indicies an element into ES """
         docs = self.build_document(entity, 'single')
         for doc in docs:
-            logger.info(f"Making Doc={doc}")
-            res = self.es.index(index=self.index_name(entity.project.pk),
-                                id=doc['_id'],
-                                refresh=wait,
-                                routing=1,
-                                body={**doc['_source']})
-
-    def build_document(self, entity, mode='index'):
+            for index in self.write_indices(entity.project_id):
+                res = self.es.index(index=index,
+                                    id=doc['_id'],
+                                    refresh=wait,
+                                    routing=1,
+                                    body={**doc['_source']})
+
+    def build_document(self, entity, mode='index', file_sizes=None, treeleaf_depth=None,
+                       treeleaf_path=None):
         """ Returns a list of documents representing the entity to be
             used with the es.helpers.bulk functions
             if mode is 'single', then one can use the 'doc' member
             as the parameters to the es.index function.
+            File sizes of media and depth and path of leaves are computed
+            if not given.
         """
         aux = {}
         aux['_meta'] = entity.meta.pk
@@ -193,7 +350,9 @@ class TatorSearch:
             aux['_md5'] = entity.md5
 
             # Get total size and download size of this file.
-            total_size, download_size = mediaFileSizes(entity)
+            if file_sizes is None:
+                file_sizes = mediaStoredSizes(entity)
+            total_size, download_size = file_sizes
             aux['_total_size'] = total_size
             aux['_download_size'] = download_size
 
@@ -206,21 +365,18 @@ class TatorSearch:
                 'name': 'annotation',
                 'parent': f"{entity.media.meta.dtype}_{entity.media.pk}",
             }
-            if entity.version:
-                aux['_annotation_version'] = entity.version.pk
+            if entity.version_id:
+                aux['_annotation_version'] = entity.version_id
             aux['_modified'] = entity.modified
             aux['_modified_datetime'] = entity.modified_datetime.isoformat()
             aux['_modified_by'] = str(entity.modified_by)
-            aux['_user'] = entity.user.pk
+            aux['_user'] = entity.user_id
             aux['_email'] = entity.user.email
             aux['_meta'] = entity.meta.pk
             aux['_frame'] = entity.frame
             aux['_x'] = entity.x
             aux['_y'] = entity.y
-            if entity.thumbnail_image:
-                aux['_thumbnail_image'] = entity.thumbnail_image.pk
-            else:
-                aux['_thumbnail_image'] = None
+            aux['_thumbnail_image'] = entity.thumbnail_image_id
             if entity.meta.dtype == 'box':
                 aux['_width'] = entity.width
                 aux['_height'] = entity.height
@@ -230,13 +386,13 @@ class TatorSearch:
             elif entity.meta.dtype == 'dot':
                 pass
         elif entity.meta.dtype in ['state']:
-            media = entity.media.all()
-            if media.exists():
+            media = list(entity.media.all())
+            if media:
                 aux['_media_relation'] = {
                     'name': 'annotation',
                     'parent': f"{media[0].meta.dtype}_{media[0].pk}",
                 }
-                for media_idx in range(1, media.count()):
+                for media_idx in range(1, len(media)):
                     duplicate = deepcopy(aux)
                     duplicate['_media_relation'] = {
                         'name': 'annotation',
@@ -256,16 +412,20 @@ class TatorSearch:
                     duplicates.append(duplicate)
             except:
                 pass
-            if entity.version:
-                aux['_annotation_version'] = entity.version.pk
+            if entity.version_id:
+                aux['_annotation_version'] = entity.version_id
             aux['_modified'] = entity.modified
             aux['_modified_datetime'] = entity.modified_datetime.isoformat()
             aux['_modified_by'] = str(entity.modified_by)
         elif entity.meta.dtype in ['leaf']:
             aux['_exact_treeleaf_name'] = entity.name
             aux['tator_treeleaf_name'] = entity.name
-            aux['_treeleaf_depth'] = entity.depth()
-            aux['_treeleaf_path'] = entity.computePath()
+            if treeleaf_depth is None:
+                treeleaf_depth = entity.depth()
+            if treeleaf_path is None:
+                treeleaf_path = entity.computePath()
+            aux['_treeleaf_depth'] = treeleaf_depth
+            aux['_treeleaf_path'] = treeleaf_path
         if entity.attributes is None:
             entity.attributes = {}
             entity.save()
@@ -281,7 +441,7 @@ class TatorSearch:
                     corrected_attributes[key] = f"{value[1]},{value[0]}"
         results=[]
         results.append({
-            '_index':self.index_name(entity.project.pk),
+            '_index':self.index_name(entity.project_id),
             '_op_type': mode,
             '_source': {
                 **corrected_attributes,
@@ -300,7 +460,7 @@ class TatorSearch:
             # 256 duplicates for a given type
             duplicate_id = entity.pk + ((idx + 1) << id_bits)
             results.append({
-            '_index':self.index_name(entity.project.pk),
+            '_index':self.index_name(entity.project_id),
             '_op_type': mode,
             '_source': {
                 **corrected_attributes,
@@ -312,10 +472,107 @@ class TatorSearch:
         return results
 
 
+    def build_documents(self, qs, mode='index', chunk_size=500):
+        """ Generator that yields documents for all entities in a queryset of
+            media, localizations, states or leaves. Documents are the same as
+            those from `build_document`, but related rows are fetched a chunk
+            at a time, entity types are fetched once, and media file sizes are
+            read in parallel.
+        """
+        # Imported here because models imports this module.
+        from .models import Media, Localization, State, Leaf, Depth
+        model = qs.model
+        type_model = model._meta.get_field('meta').related_model
+        metas = {}
+        def _set_metas(entities):
+            missing = set(entity.meta_id for entity in entities) - set(metas)
+            if missing:
+                metas.update({meta.pk: meta for meta in type_model.objects.filter(pk__in=missing)})
+            for entity in entities:
+                entity.meta = metas[entity.meta_id]
+        media_metas = {}
+        def _set_media_metas(media):
+            missing = set(medium.meta_id for medium in media) - set(media_metas)
+            if missing:
+                media_metas.update({meta.pk: meta for meta in
+                                    Media._meta.get_field('meta').related_model.objects
+                                    .filter(pk__in=missing)})
+            for medium in media:
+                medium.meta = media_metas[medium.meta_id]
+
+        if model is Media:
+            qs = qs.select_related('project')
+        elif model is Localization:
+            qs = qs.select_related('project', 'media', 'user', 'modified_by')
+        elif model is State:
+            qs = qs.select_related('project', 'modified_by', 'extracted')\
+                   .prefetch_related('media')
+        elif model is Leaf:
+            qs = qs.select_related('project').annotate(treeleaf_depth=Depth('path'))
+        leaf_names = {}
+
+        last = None
+        while True:
+            chunk = qs.order_by('pk')
+            if last is not None:
+                chunk = chunk.filter(pk__gt=last)
+            chunk = list(chunk[:chunk_size])
+            if not chunk:
+                break
+            last = chunk[-1].pk
+
+            # Entities without attributes are saved with empty attributes.
+            missing_attributes = [entity.pk for entity in chunk if entity.attributes is None]
+            if missing_attributes:
+                model.objects.filter(pk__in=missing_attributes).update(attributes={})
+                for entity in chunk:
+                    if entity.attributes is None:
+                        entity.attributes = {}
+
+            _set_metas(chunk)
+            extra = [{} for _ in chunk]
+            if model is Media:
+                with ThreadPoolExecutor(max_workers=FILE_SIZE_THREADS) as executor:
+                    for kwargs, sizes in zip(extra, executor.map(mediaStoredSizes, chunk)):
+                        kwargs['file_sizes'] = sizes
+            elif model is Localization:
+                _set_media_metas([entity.media for entity in chunk])
+            elif model is State:
+                media = [medium for entity in chunk for medium in entity.media.all()]
+                media += [entity.extracted for entity in chunk if entity.extracted]
+                _set_media_metas(media)
+            elif model is Leaf:
+                # Fetch names of all ancestors a level at a time.
+                missing = set(entity.parent_id for entity in chunk)
+                while missing:
+                    missing = missing - set(leaf_names) - {None}
+                    ancestors = Leaf.objects.filter(pk__in=missing).values_list('pk', 'name', 'parent')
+                    missing = set()
+                    for pk, name, parent in ancestors:
+                        leaf_names[pk] = (name, parent)
+                        missing.add(parent)
+                for entity, kwargs in zip(chunk, extra):
+                    path = []
+                    parent = entity.parent_id
+                    while parent is not None:
+                        name, parent = leaf_names[parent]
+                        path.append(name)
+                    path = path[::-1] + [entity.name]
+                    if entity.project:
+                        path = [entity.project.name] + path
+                    path = [part.replace(" ","_").replace("-","_").replace("(","_").replace(")","_")
+                            for part in path]
+                    kwargs['treeleaf_depth'] = entity.treeleaf_depth
+                    kwargs['treeleaf_path'] = '.'.join(path)
+            for entity, kwargs in zip(chunk, extra):
+                for doc in self.build_document(entity, mode, **kwargs):
+                    yield doc
+
     def delete_document(self, entity):
-        index = self.index_name(entity.project.pk)
-        if self.es.exists(index=index, id=f'{entity.meta.dtype}_{entity.pk}'):
-            self.es.delete(index=index, id=f'{entity.meta.dtype}_{entity.pk}')
+        doc_id = f'{entity.meta.dtype}_{entity.pk}'
+        self._record_deletes(entity.project_id, doc_ids=[doc_id])
+        for index in self.write_indices(entity.project_id):
+            self.es.delete(index=index, id=doc_id, ignore=404)
 
     def search_raw(self, project, query):
         return self.es.search(
@@ -324,81 +581,155 @@ class TatorSearch:
             stored_fields=[],
         )
 
-    def search(self, project, query):
-        if 'sort' not in query:
-            query['sort'] = {'_doc': 'asc'}
-        size = query.get('size', None)
-        if (size is None) or (size >= 10000):
-            query['size'] = 10000
+    def search_ids(self, project, query, batch_size=10000):
+        """ Generator that yields lists of IDs matching a query, in sort order.
+
+            Results are paged with `search_after` on the query sort plus
+            `_postgres_id` as a tiebreaker, so no scroll context is held open
+            and callers can start consuming IDs before the search completes.
+            Only sort values and document IDs are fetched. Duplicate documents
+            (states associated with multiple media) sort adjacently and are
+            dropped. The query passed in is not modified.
+        """
+        body = dict(query)
+        sort = query.get('sort', None)
+        if isinstance(sort, dict):
+            sort = [{key: sort[key]} for key in sort if key != '_doc']
+        elif sort is None:
+            sort = []
+        if not any(['_postgres_id' in field for field in sort]):
+            sort.append({'_postgres_id': 'asc'})
+        body['sort'] = sort
+        body['_source'] = False
+        remaining = query.get('size', None)
+        last_id = None
+        while (remaining is None) or (remaining > 0):
+            page_size = batch_size if remaining is None else min(batch_size, remaining)
+            body['size'] = page_size
             result = self.es.search(
                 index=self.index_name(project),
-                body=query,
-                scroll='1m',
-                stored_fields=[],
+                body=body,
+                filter_path=['hits.hits._id', 'hits.hits.sort'],
             )
-            scroll_id = result['_scroll_id']
-            result = result['hits']
-            data = result['hits']
-            count = result['total']['value']
-
-            if size:
-                count = size
-            ids = drop_dupes([int(obj['_id'].split('_')[1]) & id_mask for obj in data])
-            while len(ids) < count:
-                result = self.es.scroll(
-                    scroll_id=scroll_id,
-                    scroll='1m',
-                )
-                ids += drop_dupes([int(obj['_id'].split('_')[1]) & id_mask for obj in result['hits']['hits']])
-            ids = ids[:count]
-            self.es.clear_scroll(scroll_id)
-        else:
-            # TODO: This will NOT return the requested number of results if there are
-            # duplicates in the dataset.
-            result = self.search_raw(project, query)
-            result = result['hits']
-            data = result['hits']
-            count = result['total']['value']
-            ids = drop_dupes([int(obj['_id'].split('_')[1]) & id_mask for obj in data])
-        return ids, count
-
-    def count(self, project, query):
+            hits = result.get('hits', {}).get('hits', [])
+            ids = []
+            for hit in hits:
+                id_ = hit['sort'][-1]
+                if (id_ is None) or (abs(id_) >= missing_sort_value):
+                    # Document was indexed without _postgres_id.
+                    id_ = int(hit['_id'].split('_')[1]) & id_mask
+                if id_ != last_id:
+                    ids.append(id_)
+                    last_id = id_
+            if remaining is not None:
+                ids = ids[:remaining]
+                remaining -= len(ids)
+            if ids:
+                yield ids
+            if len(hits) < page_size:
+                break
+            body.pop('from', None)
+            body['search_after'] = hits[-1]['sort']
+
+    def search(self, project, query):
+        """ Returns a list of all IDs matching a query and the number of IDs.
+            Use `search_ids` to consume large result sets in batches.
+        """
+        ids = []
+        for batch in self.search_ids(project, query):
+            ids += batch
+        return ids, len(ids)
+
+    def count(self, project, query, distinct=False):
+        """ Returns the number of entities matching a query without fetching
+            hits, honoring the `from` and `size` of the query.
+            If `distinct` is true, documents sharing a `_postgres_id` (states
+            associated with multiple media) are counted once with a cardinality
+            aggregation, which is exact up to `CARDINALITY_PRECISION` entities
+            and approximate above that.
+        """
         index = self.index_name(project)
-        return self.es.count(index=index, body=query)['count']
+        body = {}
+        if 'query' in query:
+            body['query'] = query['query']
+        if distinct:
+            body['size'] = 0
+            body['aggs'] = {'ids': {'cardinality': {
+                'field': '_postgres_id',
+                'precision_threshold': CARDINALITY_PRECISION,
+            }}}
+            result = self.es.search(index=index, body=body,
+                                    filter_path=['aggregations.ids.value'])
+            count = result['aggregations']['ids']['value']
+        else:
+            count = self.es.count(index=index, body=body)['count']
+        count = max(0, count - query.get('from', 0))
+        if 'size' in query:
+            count = min(count, query['size'])
+        return count
 
     def refresh(self, project):
         """Force refresh on an index.
         """
         self.es.indices.refresh(index=self.index_name(project))
 
-    def delete(self, project, query):
-        """Bulk delete on search results.
+    def delete(self, project, query, wait_for_completion=True):
+        """Bulk delete on search results. The affected shards are refreshed
+           once the delete completes. If `wait_for_completion` is false, the
+           delete runs as an elasticsearch task and its id is returned.
         """
-        self.es.delete_by_query(
-            index=self.index_name(project),
+        self._record_deletes(project, query=query)
+        response = self.es.delete_by_query(
+            index=','.join(self.write_indices(project)),
             body=query,
             conflicts='proceed',
+            refresh=True,
+            wait_for_completion=wait_for_completion,
         )
+        return response.get('task')
+
+    def update_script_id(self):
+        """ Returns the id of the stored script used for bulk attribute updates.
+        """
+        return f'{self.prefix}update_attributes'
+
+    def _put_update_script(self):
+        """ Stores the script used for bulk attribute updates. It is compiled
+            once by elasticsearch and reused with different params.
+        """
+        if not TatorSearch._update_script_ready:
+            self.es.put_script(id=self.update_script_id(), body={'script': {
+                'lang': 'painless',
+                'source': UPDATE_SCRIPT,
+            }})
+            TatorSearch._update_script_ready = True
 
-    def update(self, project, query, attrs):
-        """Bulk update on search results.
+    def update(self, project, query, attrs, wait_for_completion=True):
+        """Bulk update on search results. Attribute values are passed as params
+           of a stored script. If `wait_for_completion` is false, the update runs
+           as an elasticsearch task and its id is returned.
         """
-        query['script'] = ''
-        for key in attrs:
-            val = attrs[key]
-            if isinstance(val, bool):
-                if val:
-                    val = 'true'
-                else:
-                    val = 'false'
+        values = {}
+        for key, val in attrs.items():
             if isinstance(val, list): # This is a list geopos type
                 lon, lat = val # Lists are lon first
                 val = f'{lat},{lon}' # Convert to string geopos type, lat first
-            query['script'] += f"ctx._source.{key}='{val}';"
-        self.es.update_by_query(
-            index=self.index_name(project),
-            body=query,
+            values[key] = val
+        self._put_update_script()
+        body = {
+            **query,
+            'script': {
+                'id': self.update_script_id(),
+                'params': {'attrs': values},
+            },
+        }
+        response = self.es.update_by_query(
+            index=','.join(self.write_indices(project)),
+            body=body,
             conflicts='proceed',
+            refresh=True,
+            wait_for_completion=wait_for_completion,
         )
+        return response.get('task')
 
 TatorSearch.setup_elasticsearch()
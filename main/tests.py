@@ -17,10 +17,17 @@ from rest_framework import status
 from rest_framework.test import APITestCase
 
 from dateutil.parser import parse as dateutil_parse
+import pyarrow as pa
 
 from .models import *
 
 from .search import TatorSearch
+from .indexer import IndexQueue
+from .util import updateProjectTotals
+from .util import _replay_deletes
+from .rest._attribute_catalog import get_attribute_catalog
+from .schema import parse
+from .schema import load_validator
 
 logger = logging.getLogger(__name__)
 
@@ -458,6 +465,73 @@ class AttributeMediaTestMixin:
         )
         self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+class ArrowTestMixin:
+    def test_arrow(self):
+        url = f'/rest/{self.list_uri}/{self.project.pk}?type={self.entity_type.pk}'
+        response = self.client.get(url + '&format=json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        expected = json.loads(response.content)
+        response = self.client.get(url + '&format=arrow')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        table = pa.ipc.open_stream(pa.py_buffer(response.content)).read_all()
+        self.assertEqual(table.num_rows, len(expected))
+        self.assertEqual(sorted(table.column('id').to_pylist()),
+                         sorted([e['id'] for e in expected]))
+        self.assertEqual(table.schema.field('int_test').type, pa.int64())
+        self.assertEqual(table.schema.field('float_test').type, pa.float64())
+        self.assertEqual(table.schema.field('bool_test').type, pa.bool_())
+
+class StreamTestMixin:
+    def test_stream(self):
+        url = f'/rest/{self.list_uri}/{self.project.pk}?type={self.entity_type.pk}&format=json'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        expected = json.loads(response.content)
+        response = self.client.get(url + '&stream=1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        streamed = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(streamed, expected)
+
+class AttributeRouterTestMixin:
+    def test_attribute_router(self):
+        for entity in self.entities:
+            response = self.client.patch(f'/rest/{self.detail_uri}/{entity.pk}',
+                                         {'attributes': {'int_test': random.randint(-5, 5)}},
+                                         format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        TatorSearch().refresh(self.project.pk)
+        url = (f'/rest/{self.list_uri}/{self.project.pk}?type={self.entity_type.pk}'
+               f'&attribute_gte=int_test::0&attribute_null=float_test::true&format=json')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Tator-Engine'], 'postgres')
+        postgres_ids = sorted([entity['id'] for entity in response.data])
+        # Parameters unknown to the postgres path route to elasticsearch.
+        response = self.client.get(url + '&after=0')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Tator-Engine'], 'elasticsearch')
+        self.assertEqual(sorted([entity['id'] for entity in response.data]), postgres_ids)
+
+class CountTestMixin:
+    def test_count(self):
+        for query in ['&after=0', '&after=0&stop=2']:
+            url = f'/rest/{self.list_uri}/{self.project.pk}?type={self.entity_type.pk}{query}'
+            response = self.client.get(url, format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            expected = len(response.data)
+            response = self.client.get(url + '&operation=count', format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['count'], expected)
+
+class BuildDocumentsTestMixin:
+    def test_build_documents(self):
+        ts = TatorSearch()
+        model = type(self.entities[0])
+        qs = model.objects.filter(pk__in=[entity.pk for entity in self.entities])
+        expected = [doc for entity in qs.order_by('pk') for doc in ts.build_document(entity)]
+        self.assertEqual(list(ts.build_documents(qs, chunk_size=4)), expected)
+
 class AttributeTestMixin:
     def test_query_no_attributes(self):
         response = self.client.get(
@@ -469,6 +543,22 @@ class AttributeTestMixin:
         for this_id, rest_id in zip(sorted(this_ids), sorted(rest_ids)):    
             self.assertEqual(this_id, rest_id)
 
+    def test_list_cache_invalidation(self):
+        url = f'/rest/{self.list_uri}/{self.project.pk}?type={self.entity_type.pk}&format=json'
+        response = self.client.get(url)
+        self.assertEqual(len(response.data), len(self.entities))
+        # Repeat the request so it is served from cache, then create an entity.
+        response = self.client.get(url)
+        self.assertEqual(len(response.data), len(self.entities))
+        new_entity = self.create_entity()
+        TatorSearch().refresh(self.project.pk)
+        response = self.client.get(url)
+        self.assertEqual(len(response.data), len(self.entities) + 1)
+        new_entity.delete()
+        TatorSearch().refresh(self.project.pk)
+        response = self.client.get(url)
+        self.assertEqual(len(response.data), len(self.entities))
+
     def test_multiple_attribute(self):
         response = self.client.get(
             f'/rest/{self.list_uri}/{self.project.pk}'
@@ -521,6 +611,32 @@ class AttributeTestMixin:
             self.assertEqual(response.status_code, status.HTTP_200_OK)
             self.assertEqual(response.data['attributes']['bool_test'], test_val)
 
+    def test_list_patch_multiple(self):
+        attrs = {'bool_test': True, 'int_test': 7, 'string_test': 'it\'s "quoted"'}
+        for entity in self.entities:
+            response = self.client.patch(f'/rest/{self.detail_uri}/{entity.pk}',
+                                         {'attributes': {'float_test': 0.5}},
+                                         format='json')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.patch(
+            f'/rest/{self.list_uri}/{self.project.pk}'
+            f'?type={self.entity_type.pk}',
+            {'attributes': attrs},
+            format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for entity in self.entities:
+            response = self.client.get(f'/rest/{self.detail_uri}/{entity.pk}')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            for key, val in attrs.items():
+                self.assertEqual(response.data['attributes'][key], val)
+            self.assertEqual(response.data['attributes']['float_test'], 0.5)
+        TatorSearch().refresh(self.project.pk)
+        response = self.client.get(
+            f'/rest/{self.list_uri}/{self.project.pk}'
+            f'?type={self.entity_type.pk}&attribute_contains=string_test::quoted')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), len(self.entities))
+
     def test_list_delete(self):
         test_val = random.random() > 0.5
         to_delete = [self.create_entity() for _ in range(5)]
@@ -971,7 +1087,48 @@ class ProjectDeleteTestCase(APITestCase):
                 state.media.add(media)
 
     def test_delete(self):
-        self.client.delete(f'/rest/Project/{self.project.pk}')
+        self.client.force_authenticate(self.user)
+        response = self.client.delete(f'/rest/Project/{self.project.pk}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(Project.objects.filter(pk=self.project.pk).exists())
+        self.assertFalse(Media.objects.filter(pk__in=[v.pk for v in self.videos]).exists())
+        self.assertFalse(Localization.objects.filter(pk__in=[b.pk for b in self.boxes]).exists())
+        self.assertFalse(State.objects.filter(pk__in=[s.pk for s in self.states]).exists())
+        self.assertFalse(DeleteJob.objects.filter(project=self.project.pk).exists())
+
+    def test_media_list_delete(self):
+        self.client.force_authenticate(self.user)
+        create_test_membership(self.user, self.project)
+        TatorSearch().refresh(self.project.pk)
+        response = self.client.delete(f'/rest/Medias/{self.project.pk}?type={self.video_type.pk}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(Project.objects.filter(pk=self.project.pk).exists())
+        self.assertFalse(Media.objects.filter(pk__in=[v.pk for v in self.videos]).exists())
+        self.assertFalse(Localization.objects.filter(pk__in=[b.pk for b in self.boxes]).exists())
+        self.assertFalse(State.objects.filter(pk__in=[s.pk for s in self.states]).exists())
+        self.assertFalse(DeleteJob.objects.filter(project=self.project.pk).exists())
+        TatorSearch().refresh(self.project.pk)
+        response = self.client.get(f'/rest/Medias/{self.project.pk}?type={self.video_type.pk}')
+        self.assertEqual(len(response.data), 0)
+
+    def test_project_totals(self):
+        self.project.refresh_from_db()
+        self.assertEqual(self.project.num_files, len(self.videos))
+        for video in self.videos:
+            update_media_size(video)
+        expected_size = sum([video.total_size for video in self.videos[1:]])
+        self.client.force_authenticate(self.user)
+        create_test_membership(self.user, self.project)
+        response = self.client.delete(f'/rest/Media/{self.videos[0].pk}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.project.refresh_from_db()
+        self.assertEqual(self.project.num_files, len(self.videos) - 1)
+        self.assertEqual(self.project.size, expected_size)
+        Project.objects.filter(pk=self.project.pk).update(num_files=0, size=0)
+        updateProjectTotals(sample_size=0)
+        self.project.refresh_from_db()
+        self.assertEqual(self.project.num_files, len(self.videos) - 1)
+        self.assertEqual(self.project.size, expected_size)
 
 class AlgorithmLaunchTestCase(
         APITestCase,
@@ -1013,6 +1170,8 @@ class AlgorithmTestCase(
 class VideoTestCase(
         APITestCase,
         AttributeTestMixin,
+        BuildDocumentsTestMixin,
+        CountTestMixin,
         AttributeMediaTestMixin,
         PermissionListMembershipTestMixin,
         PermissionDetailMembershipTestMixin,
@@ -1082,6 +1241,11 @@ class ImageTestCase(
 class LocalizationBoxTestCase(
         APITestCase,
         AttributeTestMixin,
+        AttributeRouterTestMixin,
+        BuildDocumentsTestMixin,
+        CountTestMixin,
+        StreamTestMixin,
+        ArrowTestMixin,
         AttributeMediaTestMixin,
         DefaultCreateTestMixin,
         PermissionCreateTestMixin,
@@ -1143,6 +1307,61 @@ class LocalizationBoxTestCase(
     def tearDown(self):
         self.project.delete()
 
+    def test_query_ids(self):
+        ids = [entity.pk for entity in self.entities][::-1]
+        rows = database_query_ids('main_localization', ids)
+        self.assertEqual([row['id'] for row in rows], ids)
+        rows = database_query_ids('main_localization', ids, 'id')
+        self.assertEqual([row['id'] for row in rows], sorted(ids))
+        chunks = list(database_query_ids_stream('main_localization', ids, chunk_size=2))
+        self.assertEqual([row['id'] for chunk in chunks for row in chunk], ids)
+
+    def test_bulk_parse(self):
+        load_validator()
+        self.assertIn(('/rest/Localizations/{project}', 'post'), parse.body_validators)
+        endpoint = f'/rest/{self.list_uri}/{self.project.pk}'
+        create_json = [dict(self.create_json[0]) for _ in range(10)]
+        response = self.client.post(endpoint, create_json, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(len(response.data['id']), 10)
+        create_json[5]['x'] = 2.0
+        response = self.client.post(endpoint, create_json, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_ingest(self):
+        endpoint = f'/rest/LocalizationIngest/{self.project.pk}'
+        body = '\n'.join([json.dumps(self.create_json[0]) for _ in range(5)])
+        response = self.client.post(endpoint, body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['count'], 5)
+        ids = [id_ for first, last in response.data['id_ranges']
+               for id_ in range(first, last + 1)]
+        self.assertEqual(len(ids), 5)
+        for loc in Localization.objects.filter(pk__in=ids):
+            self.assertEqual(loc.attributes['int_test'], 1)
+            self.assertEqual(loc.media.pk, self.media_entities[0].pk)
+        media_id = self.media_entities[0].pk
+        body = (f'media_id,type,frame,x,int_test,geoposition_test\n'
+                f'{media_id},{self.entity_type.pk},0,0.1,2,10.0_20.0\n'
+                f'{media_id},{self.entity_type.pk},1,,3,\n')
+        response = self.client.post(endpoint, body, content_type='text/csv')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        first, last = response.data['id_ranges'][0]
+        loc = Localization.objects.get(pk=first)
+        self.assertEqual(loc.attributes['int_test'], 2)
+        self.assertEqual(loc.attributes['geoposition_test'], [20.0, 10.0])
+        loc = Localization.objects.get(pk=last)
+        self.assertIsNone(loc.x)
+        self.assertEqual(loc.attributes['geoposition_test'], [-179.0, -89.0])
+        # Ingest is all or nothing.
+        count = Localization.objects.filter(project=self.project).count()
+        body = (f'media_id,type,frame,x\n'
+                f'{media_id},{self.entity_type.pk},0,0.1\n'
+                f'{media_id},{self.entity_type.pk},0,1.5\n')
+        response = self.client.post(endpoint, body, content_type='text/csv')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Localization.objects.filter(project=self.project).count(), count)
+
 class LocalizationLineTestCase(
         APITestCase,
         AttributeTestMixin,
@@ -1272,6 +1491,11 @@ class LocalizationDotTestCase(
 class StateTestCase(
         APITestCase,
         AttributeTestMixin,
+        AttributeRouterTestMixin,
+        BuildDocumentsTestMixin,
+        CountTestMixin,
+        StreamTestMixin,
+        ArrowTestMixin,
         AttributeMediaTestMixin,
         DefaultCreateTestMixin,
         PermissionCreateTestMixin,
@@ -1338,9 +1562,22 @@ class StateTestCase(
     def tearDown(self):
         self.project.delete()
 
+    def test_count_multiple_media(self):
+        state = self.entities[0]
+        state.media.set(self.media_entities[:2])
+        state.save()
+        TatorSearch().refresh(self.project.pk)
+        url = f'/rest/{self.list_uri}/{self.project.pk}?type={self.entity_type.pk}&operation=count'
+        response = self.client.get(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], len(self.entities))
+
 class LeafTestCase(
         APITestCase,
         AttributeTestMixin,
+        AttributeRouterTestMixin,
+        BuildDocumentsTestMixin,
+        CountTestMixin,
         DefaultCreateTestMixin,
         PermissionCreateTestMixin,
         PermissionListTestMixin,
@@ -1383,6 +1620,123 @@ class LeafTestCase(
     def tearDown(self):
         self.project.delete()
 
+class IndexOutboxTestCase(APITestCase):
+    def setUp(self):
+        self.user = create_test_user()
+        self.project = create_test_project(self.user)
+        self.entity_type = LeafType.objects.create(
+            project=self.project,
+            attribute_types=create_test_attribute_types(),
+        )
+        self.leaf = create_test_leaf('leaf0', self.entity_type, self.project)
+
+    def tearDown(self):
+        self.project.delete()
+
+    def test_coalesce(self):
+        for value in range(3):
+            Leaf.objects.filter(pk=self.leaf.pk).update(attributes={'int_test': value})
+            IndexOutbox.objects.create(model='leaf', entity_id=self.leaf.pk,
+                                       project=self.project.pk, dtype='leaf', op='index')
+        # Deleting a document that does not exist is not a failure.
+        IndexOutbox.objects.create(model='leaf', entity_id=self.leaf.pk + 1000000,
+                                   project=self.project.pk, dtype='leaf', op='delete')
+        self.assertEqual(IndexQueue().drain_outbox(), 4)
+        self.assertEqual(IndexOutbox.objects.count(), 0)
+        ts = TatorSearch()
+        ts.refresh(self.project.pk)
+        doc = ts.es.get(index=ts.index_name(self.project.pk), id=f'leaf_{self.leaf.pk}', routing=1)
+        self.assertEqual(doc['_source']['int_test'], 2)
+
+    def test_claimed(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        stale = now - datetime.timedelta(hours=1)
+        IndexOutbox.objects.create(model='leaf', entity_id=self.leaf.pk, project=self.project.pk,
+                                   dtype='leaf', op='index', claimed_datetime=now)
+        self.assertEqual(IndexQueue().drain_outbox(), 0)
+        IndexOutbox.objects.update(claimed_datetime=stale)
+        self.assertEqual(IndexQueue().drain_outbox(), 1)
+        self.assertEqual(IndexOutbox.objects.count(), 0)
+
+class IndexRebuildTestCase(APITestCase):
+    def setUp(self):
+        self.user = create_test_user()
+        self.project = create_test_project(self.user)
+        self.entity_type = LeafType.objects.create(
+            project=self.project,
+            attribute_types=create_test_attribute_types(),
+        )
+        self.leaf = create_test_leaf('leaf0', self.entity_type, self.project)
+
+    def tearDown(self):
+        self.project.delete()
+
+    def test_rebuild(self):
+        ts = TatorSearch()
+        alias = ts.index_name(self.project.pk)
+        old_index = ts._indices(alias)
+        index = ts.begin_rebuild(self.project.pk, [self.entity_type])
+        TatorSearch._rebuild_targets.clear()
+        # Changes during the rebuild go to both indices.
+        leaf = create_test_leaf('leaf1', self.entity_type, self.project)
+        ts.refresh(self.project.pk)
+        ts.es.get(index=old_index[0], id=f'leaf_{leaf.pk}', routing=1)
+        ts.es.get(index=index, id=f'leaf_{leaf.pk}', routing=1)
+        ts.finish_rebuild(self.project.pk)
+        TatorSearch._rebuild_targets.clear()
+        self.assertEqual(ts._indices(alias), [index])
+        self.assertFalse(ts.es.indices.exists(old_index[0]))
+        self.assertEqual(ts._indices(ts.rebuild_alias_name(self.project.pk)), [])
+
+    def test_delete_during_rebuild(self):
+        ts = TatorSearch()
+        index = ts.begin_rebuild(self.project.pk, [self.entity_type])
+        TatorSearch._rebuild_targets.clear()
+        # The leaf is deleted after its range was read, so the build
+        # recreates it from the stale row.
+        ts.delete_document(self.leaf)
+        ts.es.index(index=index, id=f'leaf_{self.leaf.pk}', routing=1,
+                    body=ts.build_document(self.leaf)[0]['_source'], refresh=True)
+        _replay_deletes(self.project.pk, index)
+        ts.es.indices.refresh(index)
+        self.assertFalse(ts.es.exists(index=index, id=f'leaf_{self.leaf.pk}', routing=1))
+        ts.finish_rebuild(self.project.pk)
+        TatorSearch._rebuild_targets.clear()
+
+class AttributeCatalogTestCase(APITestCase):
+    def setUp(self):
+        self.user = create_test_user()
+        self.project = create_test_project(self.user)
+        self.media_type = MediaType.objects.create(
+            name="video",
+            dtype='video',
+            project=self.project,
+            attribute_types=create_test_attribute_types(),
+        )
+
+    def tearDown(self):
+        self.project.delete()
+
+    def test_invalidate(self):
+        catalog = get_attribute_catalog(self.project.pk)
+        self.assertEqual(catalog.relation('int_test'), 'media')
+        self.assertEqual(catalog.get_entity_type(MediaType, self.media_type.pk), self.media_type)
+        self.assertIs(get_attribute_catalog(self.project.pk), catalog)
+        state_type = StateType.objects.create(
+            name="states",
+            dtype='state',
+            project=self.project,
+            association='Media',
+            attribute_types=create_test_attribute_types(),
+        )
+        state_type_id = state_type.pk
+        catalog = get_attribute_catalog(self.project.pk)
+        self.assertEqual(catalog.relation('int_test'), 'annotation')
+        state_type.delete()
+        catalog = get_attribute_catalog(self.project.pk)
+        self.assertEqual(catalog.relation('int_test'), 'media')
+        self.assertIsNone(catalog.get_entity_type(StateType, state_type_id))
+
 class LeafTypeTestCase(
         APITestCase,
         PermissionCreateTestMixin,
@@ -1632,6 +1986,18 @@ class ProjectTestCase(APITestCase):
             if expected_status == status.HTTP_200_OK:
                 del self.entities[0]
 
+    def test_membership_revoked(self):
+        # Permission is cached after the first request and must be invalidated
+        # when the membership is removed.
+        endpoint = f'/rest/{self.detail_uri}/{self.entities[0].pk}'
+        response = self.client.get(endpoint)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        response = self.client.get(endpoint)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        Membership.objects.filter(project=self.entities[0], user=self.user).delete()
+        response = self.client.get(endpoint)
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
     def test_delete_non_creator(self):
         other_user = User.objects.create(
             username="other",
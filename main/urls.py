@@ -108,6 +108,10 @@ urlpatterns += [
         'rest/Localization/<int:id>',
         LocalizationDetailAPI.as_view(),
     ),
+    path(
+        'rest/LocalizationIngest/<int:project>',
+        LocalizationIngestAPI.as_view(),
+    ),
     path(
         'rest/LocalizationTypes/<int:project>',
         LocalizationTypeListAPI.as_view(),
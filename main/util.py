@@ -3,20 +3,36 @@ import os
 import time
 import subprocess
 import json
+import multiprocessing
+import random
+from collections import defaultdict
 
 from progressbar import progressbar,ProgressBar
 
 from main.models import *
 from main.search import TatorSearch
-from main.search import mediaFileSizes
+from main.search import REBUILD_CHECK_INTERVAL
+from main.cache import TatorCache
 
 from django.conf import settings
+from django.db import connections
 from django.db.models import F
+from django.db.models import Min
+from django.db.models import Max
+from django.db.models import Count
+from django.db.models import Sum
 
 from elasticsearch.helpers import streaming_bulk
+from elasticsearch.helpers import scan
 
 logger = logging.getLogger(__name__)
 
+PROJECT_TOTALS_SAMPLE_SIZE = int(os.getenv('TATOR_PROJECT_TOTALS_SAMPLE_SIZE', 100))
+PROJECT_TOTALS_BACKFILL_SIZE = int(os.getenv('TATOR_PROJECT_TOTALS_BACKFILL_SIZE', 1000))
+""" Number of media whose files are checked for size drift, and number of
+    media that have not been sized yet that are sized, per reconciliation.
+"""
+
 """ Utility scripts for data management in django-shell """
 
 def clearDataAboutMedia(id):
@@ -33,22 +49,50 @@ def clearDataAboutMedia(id):
     qs=Localization.objects.filter(media=id)
     qs.delete()
 
-def updateProjectTotals(force=False):
-    projects=Project.objects.all()
-    for project in projects:
-        temp_files = TemporaryFile.objects.filter(project=project)
-        files = Media.objects.filter(project=project)
-        if (files.count() + temp_files.count() != project.num_files) or force:
-            project.num_files = files.count() + temp_files.count()
-            project.size = 0
-            for file in temp_files:
-                if file.path:
-                    if os.path.exists(file.path):
-                        project.size += os.path.getsize(file.path)
-            for file in files:
-                project.size += mediaFileSizes(file)[0]
-            logger.info(f"Updating {project.name}: Num files = {project.num_files}, Size = {project.size}")
-            project.save()
+def updateProjectTotals(sample_size=PROJECT_TOTALS_SAMPLE_SIZE,
+                        backfill_size=PROJECT_TOTALS_BACKFILL_SIZE):
+    """ Reconciles project file counts and sizes, which are otherwise kept as
+        counters. Only a sample of media files are checked on disk for drift in
+        stored sizes, plus a limited number of media that have not been sized
+        yet. Project totals are then compared against sums of stored sizes.
+    """
+    unsized = Media.objects.filter(project__isnull=False, total_size__isnull=True)\
+                           .order_by('id')[:backfill_size]
+    for media in unsized:
+        update_media_size(media)
+
+    bounds = Media.objects.filter(total_size__isnull=False).aggregate(Min('id'), Max('id'))
+    if bounds['id__min'] is not None:
+        ids = [random.randint(bounds['id__min'], bounds['id__max']) for _ in range(sample_size)]
+        sampled = Media.objects.filter(pk__in=ids, project__isnull=False,
+                                       total_size__isnull=False)
+        for media in sampled:
+            old_size = media.total_size
+            update_media_size(media)
+            if media.total_size != old_size:
+                logger.warning(f"Size of media {media.id} drifted from {old_size} to "
+                               f"{media.total_size}.")
+
+    media_totals = {row['project']: row for row in
+                    Media.objects.filter(project__isnull=False).values('project')\
+                                 .annotate(num_files=Count('id'), size=Sum('total_size'))}
+    temp_totals = {row['project']: row for row in
+                   TemporaryFile.objects.values('project')\
+                                        .annotate(num_files=Count('id'), size=Sum('size'))}
+    for project in Project.objects.all():
+        num_files = 0
+        size = 0
+        for totals in [media_totals, temp_totals]:
+            if project.id in totals:
+                num_files += totals[project.id]['num_files']
+                size += totals[project.id]['size'] or 0
+        if num_files != project.num_files or size != project.size:
+            # Only replace counters that were not adjusted since they were read.
+            updated = Project.objects.filter(pk=project.pk, num_files=project.num_files,
+                                             size=project.size)\
+                                     .update(num_files=num_files, size=size)
+            if updated:
+                logger.info(f"Updating {project.name}: Num files = {num_files}, Size = {size}")
 
 def waitForMigrations():
     """Sleeps until database objects can be accessed.
@@ -60,7 +104,8 @@ def waitForMigrations():
         except:
             time.sleep(10)
 
-def buildSearchIndices(project_number, section, mode='index'):
+def buildSearchIndices(project_number, section, mode='index', processes=1,
+                       range_size=100000, restart=False, index=None):
     """ Builds search index for a project.
         section must be one of:
         'index' - create the index for the project if it does not exist
@@ -69,6 +114,10 @@ def buildSearchIndices(project_number, section, mode='index'):
         'states' - create documents for states
         'localizations' - create documents for localizations
         'treeleaves' - create documents for treeleaves
+        Documents are built for ranges of `range_size` IDs across `processes`
+        worker processes. Completed ranges are recorded in redis, so an
+        interrupted build resumes where it left off unless `restart` is set.
+        Documents are written to the project's index unless `index` is given.
     """
     project_name = Project.objects.get(pk=project_number).name
     logger.info(f"Building search indices for project {project_number}: {project_name}")
@@ -97,49 +146,177 @@ def buildSearchIndices(project_number, section, mode='index'):
         logger.info("Build mappings complete!")
         return
 
-    class DeferredCall:
-        def __init__(self, qs):
-            self._qs = qs
-        def __call__(self):
-            for entity in self._qs.iterator():
-                for doc in TatorSearch().build_document(entity, mode):
-                    yield doc
-
-    if section == 'media':
-        # Create media documents
-        logger.info("Building media documents...")
-        qs = Media.objects.filter(project=project_number)
-
-    if section == 'localizations':
-        # Create localization documents
-        logger.info("Building localization documents")
-        qs = Localization.objects.filter(project=project_number)
-
-    if section == 'states':
-        # Create state documents
-        logger.info("Building state documents...")
-        qs = State.objects.filter(project=project_number)
-
-    if section == 'treeleaves':
-        # Create treeleaf documents
-        logger.info("Building tree leaf documents...")
-        qs = Leaf.objects.filter(project=project_number)
-
-    batch_size = 500
+    logger.info(f"Building {section} documents...")
+    model = INDEX_SECTIONS[section]
+    qs = model.objects.filter(project=project_number)
+    bounds = qs.aggregate(Min('pk'), Max('pk'))
+    if bounds['pk__min'] is None:
+        logger.info("Nothing to index!")
+        return
+    ranges = [(start, min(start + range_size, bounds['pk__max'] + 1))
+              for start in range(bounds['pk__min'], bounds['pk__max'] + 1, range_size)]
+
+    # Completed ranges are checkpointed so an interrupted run can resume.
+    rds = TatorCache.rds
+    ts = TatorSearch()
+    if index is None:
+        index = ts.index_name(project_number)
+    checkpoint_key = f'{ts.prefix}reindex_{index}_{section}'
+    settings_key = f'{ts.prefix}reindex_settings_{index}'
+    if restart:
+        rds.delete(checkpoint_key)
+    done = set(int(start) for start in rds.smembers(checkpoint_key))
+    ranges = [(start, stop) for start, stop in ranges if start not in done]
+    logger.info(f"Indexing {len(ranges)} ID ranges, {len(done)} already complete.")
+
+    # Disable refresh and replicas while loading. Original settings are kept in
+    # redis so they survive a crash before they are restored.
+    if not rds.exists(settings_key):
+        current = ts.es.indices.get_settings(index=index)
+        current = list(current.values())[0]['settings']['index']
+        rds.hmset(settings_key, {
+            'refresh_interval': current.get('refresh_interval', '1s'),
+            'number_of_replicas': current.get('number_of_replicas', '1'),
+        })
+    ts.es.indices.put_settings(index=index, body={'index': {
+        'refresh_interval': '-1',
+        'number_of_replicas': 0,
+    }})
+
+    total = qs.count()
     count = 0
+    failed = 0
     bar = ProgressBar(redirect_stderr=True, redirect_stdout=True)
-    dc = DeferredCall(qs)
-    total = qs.count()
     bar.start(max_value=total)
-    for ok, result in streaming_bulk(TatorSearch().es, dc(),chunk_size=batch_size, raise_on_error=False):
-        action, result = result.popitem()
+    # Child processes must open their own database connections.
+    connections.close_all()
+    try:
+        with multiprocessing.Pool(processes, initializer=_init_index_worker) as pool:
+            args = [(section, project_number, mode, index, start, stop) for start, stop in ranges]
+            for start, range_count, range_failed in pool.imap_unordered(_index_range, args):
+                rds.sadd(checkpoint_key, start)
+                count += range_count
+                failed += range_failed
+                bar.update(min(count, total))
+        bar.finish()
+        rds.delete(checkpoint_key)
+    finally:
+        original = {key.decode(): val.decode() for key, val in rds.hgetall(settings_key).items()}
+        ts.es.indices.put_settings(index=index, body={'index': original})
+        rds.delete(settings_key)
+    logger.info(f"Indexed {count} entities, {failed} documents failed.")
+
+INDEX_SECTIONS = {
+    'media': Media,
+    'localizations': Localization,
+    'states': State,
+    'treeleaves': Leaf,
+}
+
+DTYPE_MODELS = {
+    'box': Localization,
+    'line': Localization,
+    'dot': Localization,
+    'state': State,
+    'leaf': Leaf,
+}
+
+def _init_index_worker():
+    """ Gives each worker process its own elasticsearch client.
+    """
+    TatorSearch.setup_elasticsearch()
+
+def _index_range(args):
+    """ Indexes entities of a project section with IDs in [start, stop) and
+        returns start, number of entities and number of failed documents.
+    """
+    section, project_number, mode, index, start, stop = args
+    qs = INDEX_SECTIONS[section].objects.filter(project=project_number, pk__gte=start,
+                                                pk__lt=stop)
+    ts = TatorSearch()
+    def _documents():
+        for doc in ts.build_documents(qs, mode):
+            doc['_index'] = index
+            yield doc
+    failed = 0
+    for ok, result in streaming_bulk(ts.es, _documents(), chunk_size=500,
+                                     raise_on_error=False, max_retries=3):
         if not ok:
-            print(f"Failed to {action} document! {result}")
-        bar.update(min(count, total))
-        count += 1
-        if count > total:
-            print(f"Count exceeds list size by {total - count}")
-    bar.finish()
+            action, result = result.popitem()
+            # Documents created by dual writes during a rebuild are newer.
+            if action == 'create' and result.get('status') == 409:
+                continue
+            logger.warning(f"Failed to {action} document! {result}")
+            failed += 1
+    count = qs.count()
+    connections.close_all()
+    return start, count, failed
+
+def _replay_deletes(project_number, index):
+    """ Deletes documents from a rebuilt index whose entities were deleted
+        while the index was loaded, since a range may have been read before
+        the delete. Documents matching recorded delete queries are only
+        removed if their entity no longer exists.
+    """
+    ts = TatorSearch()
+    rds = TatorCache.rds
+    ids_key = ts.deleted_ids_key(index)
+    queries_key = ts.deleted_queries_key(index)
+    doc_ids = [doc_id.decode() for doc_id in rds.smembers(ids_key)]
+    actions = [{
+        '_op_type': 'delete',
+        '_index': index,
+        '_id': doc_id,
+        '_routing': 1,
+    } for doc_id in doc_ids]
+    for query in rds.lrange(queries_key, 0, -1):
+        query = json.loads(query)
+        hits = defaultdict(dict)
+        for hit in scan(ts.es, index=index, query={'query': query['query'],
+                                                   '_source': ['_dtype', '_postgres_id']}):
+            model = DTYPE_MODELS.get(hit['_source']['_dtype'], Media)
+            hits[model][hit['_id']] = hit['_source']['_postgres_id']
+        for model, docs in hits.items():
+            existing = set(model.objects.filter(pk__in=set(docs.values()))\
+                                        .values_list('pk', flat=True))
+            actions += [{
+                '_op_type': 'delete',
+                '_index': index,
+                '_id': doc_id,
+                '_routing': 1,
+            } for doc_id, id_ in docs.items() if id_ not in existing]
+    deleted = 0
+    for ok, result in streaming_bulk(ts.es, actions, chunk_size=500, raise_on_error=False):
+        if ok:
+            deleted += 1
+        elif result['delete'].get('status') != 404:
+            logger.warning(f"Failed to delete document! {result}")
+    rds.delete(ids_key, queries_key)
+    logger.info(f"Removed {deleted} documents deleted during the rebuild.")
+
+def rebuildSearchIndex(project_number, processes=4, range_size=100000):
+    """ Rebuilds the search index of a project without interrupting searches.
+        Documents are built into a new index while changes are written to both
+        indices, then the project's alias is swapped to the new index and the
+        old index is deleted. An interrupted rebuild resumes when rerun.
+    """
+    ts = TatorSearch()
+    entity_types = []
+    for type_model in [MediaType, LocalizationType, StateType, LeafType]:
+        entity_types += list(type_model.objects.filter(project=project_number))
+    index = ts.begin_rebuild(project_number, entity_types)
+    logger.info(f"Rebuilding project {project_number} into {index}...")
+
+    # Wait until all processes have seen the rebuild and are writing to both
+    # indices, so no change is missed by both the writers and the build.
+    time.sleep(REBUILD_CHECK_INTERVAL)
+    for section in INDEX_SECTIONS:
+        buildSearchIndices(project_number, section, 'create', processes, range_size,
+                           index=index)
+    # Deletes made after this point find their documents in the new index.
+    _replay_deletes(project_number, index)
+    ts.finish_rebuild(project_number)
+    logger.info(f"Project {project_number} now searches {index}.")
 
 def makeDefaultVersion(project_number):
     """ Creates a default version for a project and sets all localizations
@@ -12,9 +12,8 @@ from django.contrib.auth.models import AnonymousUser
 from rest_framework.authentication import TokenAuthentication
 from .models import Project
 from .models import Media
-from .models import Membership
+from .models import get_user_permission
 from .notify import Notify
-from .cache import TatorCache
 
 import os
 import logging
@@ -77,28 +76,13 @@ class AnnotationView(ProjectBase, TemplateView):
         return context
 
 
-def validate_project(user, project):
-    # We only cache 'True' effectively with this logic
-    granted = TatorCache().get_cred_cache(user.id, project.id)
-    if granted:
-        return granted
-
+def validate_project(user, project_id):
     if isinstance(user, AnonymousUser):
         granted = False
     else:
-        # Find membership for this user and project
-        membership = Membership.objects.filter(
-            user=user,
-            project=project
-        )
-
-        # If user is not part of project, deny access
-        if membership.count() == 0:
-            granted = False
-        else:
-            #Only cache granted attempts
-            granted = True
-            TatorCache().set_cred_cache(user.id, project.id, granted)
+        # Membership lookups are cached per process and in redis, see
+        # `get_user_permission`.
+        granted = get_user_permission(user.id, project_id) is not None
     return granted
 
 class AuthProjectView(View):
@@ -134,7 +118,7 @@ class AuthProjectView(View):
             project_id = comps[2]
             if project_id.isdigit() is False:
                 project_id = comps[3]
-            project = Project.objects.get(pk=project_id)
+            project = int(project_id)
             authorized = validate_project(user, project)
         except Exception as e:
             logger.info(f"ERROR: {e}")
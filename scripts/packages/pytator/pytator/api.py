@@ -41,6 +41,12 @@ try:
 except:
     print("Couldn't required libraries (might be in setup.py)")
 
+try:
+    import pyarrow as pa
+except:
+    # Dataframes are built from JSON instead.
+    pa = None
+
 class APIElement:
     """ Base API element that provides generic capability to any of the
         derived endpoint objects. Each Element is instantiated per project
@@ -49,6 +55,9 @@ class APIElement:
     :param api: Tuple provided from :class:`pytator.Tator` object construction, represents the Tator webservice endpoint, authorization token, and project number.
     :param str endpoint: Name of the endpoint provided from derived class.
     """
+    arrow_supported = False
+    """ Whether the list endpoint can return Arrow tables. """
+
     def __init__(self, api, list_endpoint, detail_endpoint):
         """ Construct an API element. Constructed by :class:`pytator.Tator`
         """
@@ -115,13 +124,40 @@ class APIElement:
            else:
                return None
 
+        If pyarrow is installed and the endpoint supports it, elements are
+        instead downloaded in Arrow format and loaded directly into a
+        DataFrame, with one typed column per attribute.
+
         """
+        if self.arrow_supported and pa is not None:
+            return self.arrowDataframe(params)
         allObjects=self.filter(params)
         if allObjects:
             return pd.DataFrame(data=allObjects,
                                 columns=allObjects[0].keys())
         else:
             return None
+
+    def arrowDataframe(self, params):
+        """ Given a filter object, return the matching elements as a
+        pd.DataFrame or None, using the Arrow format. Attributes are
+        flattened into columns typed according to their attribute type.
+        """
+        arrowParams = dict(params or {})
+        arrowParams['format'] = 'arrow'
+        ep = self.url + "/" + self.endpoint + "/" + self.project
+        response=requests.get(ep,
+                              params=arrowParams,
+                              headers=self.headers)
+        if response.status_code != 200:
+            print(f"ERROR {response.status_code}: got {response.text}")
+            return None
+        reader = pa.ipc.open_stream(pa.py_buffer(response.content))
+        table = reader.read_all()
+        if table.num_rows == 0:
+            return None
+        return table.to_pandas()
+
     def all(self):
         """ Get list of all the elements of an endpoint as a list
 
@@ -708,10 +744,14 @@ class State(APIElement):
         # TODO: Should we return something more than 200 back from serfver?
         return code == 200
 
+    arrow_supported = True
+
     def dataframe(self, params):
         """ State objects are nested, this function will flatten them prior to
             conversion to a dataframe. Otherwise the same as the parent function
          """
+        if pa is not None:
+            return self.arrowDataframe(params)
         allObjects=self.filter(params)
         if allObjects:
             columns = set(allObjects[0].keys())
@@ -774,6 +814,8 @@ class Localization(APIElement):
     Localizations are boxes, lines, or dots made by annotators on images or
     videos.
     """
+    arrow_supported = True
+
     def __init__(self, api):
          super().__init__(api, "Localizations", "Localization")
 
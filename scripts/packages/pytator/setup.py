@@ -17,6 +17,7 @@ setup(
                       'pandas>=0.24.2',
                       'opencv-python>=4.1.0',
                       'numpy>=1.16.0'],
+    extras_require={'arrow': ['pyarrow>=0.17.0']},
 
     # metadata to display on PyPI
     author="CVision AI",
@@ -15,3 +15,19 @@ def test_get_frame(url, token, project, video):
         assert_vector_equal(frame_data.shape, (720,1280,3))
     
 
+
+def test_get_frame_same_segment(url, token, project, video):
+    tator = pytator.Tator(url, token, project)
+
+    # Frames sharing a segment are extracted in one pass, check they match
+    # frames extracted individually.
+    frames = [50,51,52]
+    code,frame_bgr = tator.GetFrame.get_bgr(video, frames)
+    assert(code == 200)
+    assert(len(frame_bgr) == 3)
+    for frame, frame_data in zip(frames, frame_bgr):
+        code,single_bgr = tator.GetFrame.get_bgr(video, [frame])
+        assert(code == 200)
+        assert_vector_equal(frame_data.shape, single_bgr[0].shape)
+        diff = abs(frame_data.astype(float) - single_bgr[0].astype(float)).mean()
+        assert(diff < 5.0)
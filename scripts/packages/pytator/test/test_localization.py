@@ -87,6 +87,9 @@ def test_localization_crud(url, token, project, video_type, video, box_type):
     boxes = tator.Localization.filter(params)
     dataframe = tator.Localization.dataframe(params)
     assert(len(boxes)==len(dataframe))
+    if pytator.api.pa is not None:
+        assert(dataframe['test_int'].dtype == 'int64')
+        assert(dataframe['test_float'].dtype == 'float64')
     for box in boxes:
         assert_close_enough(bulk_patch, box, exclude)
     
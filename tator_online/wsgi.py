@@ -17,3 +17,7 @@ from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tator_online.settings')
 application = get_wsgi_application()
+
+# Build request validators before serving the first request.
+from main.schema import load_validator
+load_validator()